@@ -0,0 +1,387 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2026 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Scale benchmark for the marshal agent scan.
+
+Runs Agent.scan() against in-process stand-ins: an S3 client holding N
+synthetic objects, an IMS HTTP server with M images (and their manifests in
+S3), a sparse-file s3fs mount, and either the in-memory LIO backend or a
+fake TARGETCLI_BIN driving a generated saveconfig.json. Each size runs in
+its own process so peak RSS is per size.
+
+    python3 bench/scale.py --images 100,1000,5000,20000 --backend targetcli
+"""
+
+import argparse
+import base64
+import collections
+import http.server
+import io
+import json
+import logging
+import os
+import resource
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+MARSHAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "marshal")
+sys.path.insert(0, MARSHAL)
+
+import botocore.exceptions
+
+import lib.config as config
+import lib.auth as auth
+import lib.cache as cache
+import lib.ims as ims
+import lib.lio as lio
+import lib.planner as planner
+
+BUCKET = "boot-images"
+IQN = "iqn.2023-06.csm.iscsi:bench"
+
+COUNTS = collections.Counter()
+COUNTS_LOCK = threading.Lock()
+
+def count(what: str, n: int = 1):
+    with COUNTS_LOCK:
+        COUNTS[what] += n
+
+## --------------------------------------------------------------
+## Stand-ins
+## --------------------------------------------------------------
+
+class _Popen(subprocess.Popen):
+
+    """Count every process the agent spawns"""
+
+    def __init__(self, *args, **kwargs):
+        count("spawns")
+        super().__init__(*args, **kwargs)
+
+subprocess.Popen = _Popen
+
+class FakeS3Client:
+
+    """The subset of a boto3 S3 client the agent uses, over a dict"""
+
+    def __init__(self, objects: dict, page_size: int = 1000):
+        self.objects = objects # key -> (size, etag, body)
+        self.page_size = page_size
+
+    def get_paginator(self, operation: str):
+        assert operation == "list_objects_v2"
+        return types.SimpleNamespace(paginate=self._paginate)
+
+    def _paginate(self, Bucket: str, Prefix: str = ""):
+        keys = sorted([k for k in self.objects if k.startswith(Prefix or "")])
+        for i in range(0, max(1, len(keys)), self.page_size):
+            count("s3_list_pages")
+            yield { "Contents" : [ { "Key" : k, "Size" : self.objects[k][0], "ETag" : f'"{self.objects[k][1]}"' }
+                                   for k in keys[i:i + self.page_size] ] }
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        count("s3_heads")
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({ "Error" : { "Code" : "404" } }, "HeadObject")
+        size, etag, _ = self.objects[Key]
+        return { "ContentLength" : size, "ETag" : f'"{etag}"' }
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        count("s3_gets")
+        if Key not in self.objects:
+            raise botocore.exceptions.ClientError({ "Error" : { "Code" : "NoSuchKey" } }, "GetObject")
+        return { "Body" : io.BytesIO(self.objects[Key][2]) }
+
+class FakeImsServer(http.server.ThreadingHTTPServer):
+
+    """IMS image listing with ETag support"""
+
+    def __init__(self, images: list):
+        self.body = json.dumps(images).encode()
+        self.etag = f'"{len(images)}-{hash(self.body)}"'
+        super().__init__(("127.0.0.1", 0), FakeImsHandler)
+
+class FakeImsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        count("ims_requests")
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.send_header("ETag", self.server.etag)
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+FAKE_TARGETCLI = """#!{python}
+# Fake targetcli: applies batch (stdin) or single (argv) commands to the
+# saveconfig.json kept by the in-memory LIO backend
+
+import json, sys
+sys.path.insert(0, {marshal!r})
+import lib.lio as lio
+
+SAVE_FILE = {save_file!r}
+
+with open(SAVE_FILE) as f:
+    backend = lio.FakeBackend(target_config=json.load(f))
+
+commands = [" ".join(sys.argv[1:])] if len(sys.argv) > 1 else sys.stdin.read().splitlines()
+status = 0
+
+for line in commands:
+    words = line.split()
+    try:
+        if words[:2] == ["/backstores/fileio", "create"]:
+            backend._create_fileio_backstore(words[2], words[3], words[7])
+        elif words[:2] == ["/backstores/fileio", "delete"]:
+            backend._delete_fileio_backstore(words[2])
+        elif len(words) == 3 and words[0].endswith("/tpg1/luns") and words[1] == "create":
+            backend._create_lun(words[2].split("/")[-1], words[0].split("/")[2])
+        elif len(words) > 1 and words[0].endswith("/tpg1") and words[1] == "enable":
+            backend._tpg(words[0].split("/")[2])["enable"] = True
+        elif len(words) > 1 and words[0].endswith("/tpg1") and words[1] == "disable":
+            backend._tpg(words[0].split("/")[2])["enable"] = False
+    except Exception as err:
+        print(err, file=sys.stderr)
+        status = 1
+
+with open(SAVE_FILE, "w") as f:
+    json.dump(backend.target_config, f)
+
+sys.exit(status)
+"""
+
+def fake_jwt(lifetime: int = 86400) -> str:
+    def b64(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+    return f"{b64({'alg' : 'none'})}.{b64({'exp' : time.time() + lifetime})}.bench"
+
+## --------------------------------------------------------------
+## Synthetic inventory
+## --------------------------------------------------------------
+
+def build_inventory(workdir: str, images: int, pe_images: int, projected: float, stale: int):
+
+    """Create the S3 objects, IMS images, s3fs files and initial LIO state.
+    A fraction of the images starts out projected, plus stale backstores
+    for images that no longer exist."""
+
+    mount = os.path.join(workdir, "s3fs")
+    objects = dict()
+    ims_images = []
+
+    def add_object(key: str, size: int, etag: str, body: bytes = b""):
+        objects[key] = (size, etag, body)
+        path = os.path.join(mount, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    for i in range(pe_images):
+        add_object(f"PE/CPE-bench-{i}.x86_64.squashfs", (i + 1) << 20, f"pe{i:030d}")
+
+    backend = lio.FakeBackend(iqn=IQN)
+
+    for i in range(images):
+        image_id = f"00000000-0000-4000-8000-{i:012d}"
+        rootfs_etag = f"{i:032x}"
+        rootfs_path = f"s3://{BUCKET}/{image_id}/rootfs"
+        manifest = {
+            "version" : "1.0",
+            "artifacts" : [
+                { "link" : { "path" : rootfs_path, "etag" : rootfs_etag, "type" : "s3" },
+                  "type" : planner.ROOTFS_ARTIFACT_TYPE },
+                { "link" : { "path" : f"s3://{BUCKET}/{image_id}/kernel", "etag" : f"k{i:031x}", "type" : "s3" },
+                  "type" : "application/vnd.cray.image.kernel" }
+            ]
+        }
+        body = json.dumps(manifest).encode()
+        add_object(f"{image_id}/manifest.json", len(body), f"m{i:031x}", body)
+        add_object(f"{image_id}/rootfs", (i % 64 + 1) << 20, rootfs_etag)
+        ims_images.append({
+            "id" : image_id,
+            "name" : f"bench-{i}",
+            "created" : "2026-01-01T00:00:00+00:00",
+            "arch" : "x86_64",
+            "metadata" : { "sbps-project" : "true" },
+            "link" : { "path" : f"s3://{BUCKET}/{image_id}/manifest.json", "etag" : f"m{i:031x}", "type" : "s3" }
+        })
+
+        if i < images * projected:
+            projection = planner.rootfs_projection(rootfs_path, rootfs_etag,
+                                                   { f"{image_id}/rootfs" : types.SimpleNamespace(
+                                                       size=objects[f"{image_id}/rootfs"][0], etag=rootfs_etag) },
+                                                   BUCKET, mount)
+            backend._create_fileio_backstore(projection.product, projection.dev, projection.wwn)
+            backend._create_lun(projection.product, IQN)
+
+    for i in range(stale):
+        path = os.path.join(mount, f"gone-{i}", "rootfs")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "wb").close()
+        product = lio.generate_lun_product(path)
+        backend._create_fileio_backstore(product, path, lio.generate_lun_wwn(path))
+        backend._create_lun(product, IQN)
+
+    save_file = os.path.join(workdir, "saveconfig.json")
+    with open(save_file, "w") as f:
+        json.dump(backend.target_config, f)
+
+    return objects, ims_images, mount, save_file, backend
+
+## --------------------------------------------------------------
+## Benchmark
+## --------------------------------------------------------------
+
+def run_size(args) -> dict:
+
+    """Run args.scans scans at one size in this process, return the report"""
+
+    # Imported here so stand-ins replace subprocess.Popen first
+    from bin.agent import Agent
+
+    workdir = tempfile.mkdtemp(prefix="sbps-bench-")
+    objects, ims_images, mount, save_file, fake = build_inventory(workdir, args.images, args.pe_images,
+                                                                  args.projected, args.stale)
+
+    targetcli = os.path.join(workdir, "targetcli")
+    with open(targetcli, "w") as f:
+        f.write(FAKE_TARGETCLI.format(python=sys.executable, marshal=os.path.abspath(MARSHAL), save_file=save_file))
+    os.chmod(targetcli, os.stat(targetcli).st_mode | stat.S_IXUSR)
+
+    config.KV.update({
+        'S3_BUCKET' : BUCKET,
+        'SQUASHFS_S3FS_MOUNT' : mount,
+        'LIO_SAVE_FILE' : save_file,
+        'TARGETCLI_BIN' : targetcli,
+        'IMS_TAGGING' : args.tagging,
+        'S3_INVENTORY_MODE' : args.inventory,
+        'MANIFEST_WORKERS' : args.workers,
+        'TRACE_OUTPUT' : '',
+    })
+
+    server = FakeImsServer(ims_images)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    backend = fake if args.backend == "fake" else lio.get_backend(args.backend, IQN)
+    s3_client = FakeS3Client(objects)
+
+    agent = Agent("bench",
+                  backend=backend,
+                  s3_clients=types.SimpleNamespace(get=lambda: s3_client),
+                  ims_client=ims.ImsClient(f"http://127.0.0.1:{server.server_address[1]}/apis/ims/v3/images"),
+                  svids=auth.SvidProvider(fetch=fake_jwt),
+                  manifest_cache=cache.ManifestCache(max(4096, args.images),
+                                                     os.path.join(workdir, "manifests") if args.disk_cache else None),
+                  target_service=types.SimpleNamespace(ensure_active=lambda: None, invalidate=lambda: None),
+                  label_watcher=types.SimpleNamespace(labelled=True))
+
+    scans = []
+    for n in range(args.scans):
+        COUNTS.clear()
+        started = time.perf_counter()
+        result = agent.scan()
+        elapsed = time.perf_counter() - started
+        scans.append(dict(COUNTS, scan=n + 1, ok=result.ok, changed=result.changed, wall_s=round(elapsed, 3)))
+
+    server.shutdown()
+
+    lio_save = backend.load_config()
+
+    return {
+        "images" : args.images,
+        "s3_objects" : len(objects),
+        "backend" : backend.name,
+        "backstores" : len(list(lio.extract_fileio_backstores(lio_save))),
+        "peak_rss_mb" : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "scans" : scans
+    }
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", default="100,1000,5000,20000",
+                        help="comma separated IMS image counts to sweep")
+    parser.add_argument("--pe-images", type=int, default=20)
+    parser.add_argument("--projected", type=float, default=0.5,
+                        help="fraction of images already projected before the first scan")
+    parser.add_argument("--stale", type=int, default=10,
+                        help="backstores for images that no longer exist")
+    parser.add_argument("--scans", type=int, default=2,
+                        help="scans per size, the first is cold, later ones warm")
+    parser.add_argument("--backend", choices=["fake", "targetcli"], default="targetcli")
+    parser.add_argument("--inventory", choices=["full", "scoped"], default="full")
+    parser.add_argument("--tagging", action="store_true")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--disk-cache", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print JSON reports instead of a table")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+
+    if args.child:
+        args.images = int(args.images)
+        json.dump(run_size(args), sys.stdout)
+        return
+
+    reports = []
+    for images in [int(i) for i in args.images.split(",")]:
+        argv = [f"--images={images}", f"--pe-images={args.pe_images}", f"--projected={args.projected}",
+                f"--stale={args.stale}", f"--scans={args.scans}", f"--backend={args.backend}",
+                f"--inventory={args.inventory}", f"--workers={args.workers}"]
+        argv += [f for f, on in (("--tagging", args.tagging), ("--disk-cache", args.disk_cache),
+                                 ("--verbose", args.verbose)) if on]
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"] + argv,
+                           stdout=subprocess.PIPE, check=True)
+        reports.append(json.loads(p.stdout))
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        print()
+        return
+
+    columns = ["images", "s3_objects", "backstores", "scan", "ok", "changed", "wall_s", "peak_rss_mb", "spawns",
+               "s3_list_pages", "s3_heads", "s3_gets", "ims_requests"]
+    print(" ".join([f"{c:>13}" for c in columns]))
+    for r in reports:
+        for s in r["scans"]:
+            row = dict(r, **s)
+            print(" ".join([f"{str(row.get(c, 0)):>13}" for c in columns]))
+
+if __name__ == "__main__":
+    main()
@@ -23,10 +23,11 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
 import logging
-import hashlib
-import json
-import os
+import requests
+import signal
 import time
 import urllib3
 urllib3.disable_warnings()
@@ -34,18 +35,605 @@ import urllib.parse
 
 import lib.config as config
 import lib.auth as auth
+import lib.cache as cache
+import lib.fingerprint as fingerprint
 import lib.s3 as s3
 import lib.ims as ims
+import lib.k8s as k8s
+import lib.metrics as metrics
+import lib.trace as trace
 import lib.lio as lio
+import lib.planner as planner
+import lib.prefetch as prefetch
+import lib.ratelimit as ratelimit
+import lib.recording as recording
+import lib.s3fs as s3fs
+import lib.scheduler as sched
+import lib.snapshot as snapshot
 import subprocess
+import threading
 import sys
 
-def main():
+ScanResult = collections.namedtuple("ScanResult", ["ok", "changed", "cheap", "labelled"])
+
+class Agent:
+
+    """Scan state and backends of the agent. scan() runs one scan; main()
+    builds an Agent from config and runs scans on the scheduler. Any
+    dependency can be passed in (e.g., stand-ins for benchmarks)."""
+
+    def __init__(self, hostname: str, backend: lio.LioBackend = None,
+                 s3_clients: s3.S3ClientHolder = None, ims_client: ims.ImsClient = None,
+                 svids: auth.SvidProvider = None, manifest_cache: cache.ManifestCache = None,
+                 target_service: lio.TargetService = None, label_watcher = None,
+                 isfile = None):
+
+        self.hostname = hostname
+
+        # Retrieving IQN as /etc/target/saveconfig.json will not exist initially
+        self.iqn = f'iqn.2023-06.csm.iscsi:{hostname}'
+
+        self.backend = backend or lio.get_backend(config.KV['LIO_BACKEND'], self.iqn)
+
+        if manifest_cache is None:
+            try:
+                manifest_cache = cache.ManifestCache(config.KV['MANIFEST_CACHE_SIZE'],
+                                                     config.KV['MANIFEST_CACHE_DIR'])
+            except Exception as err:
+                logging.warning(f"Unable to use {config.KV['MANIFEST_CACHE_DIR']} for manifests, caching in memory only, received -> {str(err)}")
+                manifest_cache = cache.ManifestCache(config.KV['MANIFEST_CACHE_SIZE'])
+        self.manifest_cache = manifest_cache
+
+        self.fingerprints = fingerprint.ScanFingerprints(config.KV['FULL_SCAN_INTERVAL'])
+
+        self.svids = svids or auth.SvidProvider(refresh_margin=config.KV['SPIRE_REFRESH_MARGIN'])
+
+        # Client-side rate limits and per-scan request budgets for S3 and IMS,
+        # shared by every thread of the agent
+
+        self.s3_limiter = ratelimit.Limiter("s3", config.KV['S3_RATE'],
+                                            config.KV['S3_BURST'] or None,
+                                            config.KV['S3_REQUEST_BUDGET'])
+        self.ims_limiter = ratelimit.Limiter("ims", config.KV['IMS_RATE'],
+                                             config.KV['IMS_BURST'] or None,
+                                             config.KV['IMS_REQUEST_BUDGET'])
+
+        # Ask IMS for projectable images only, when tagging is used and the
+        # server is found to apply the query the way the tag check does.
+        # Results are still filtered locally.
+
+        if ims_client is None:
+            ims_query = None
+            if config.KV['IMS_TAGGING'] and config.KV['IMS_QUERY']:
+                ims_query = dict(urllib.parse.parse_qsl(config.KV['IMS_QUERY']))
+
+            ims_client = ims.ImsClient(urllib.parse.urljoin(config.KV['API_GATEWAY'],
+                                                            config.KV['IMS_URI']),
+                                       config.KV['IMS_TIMEOUT'],
+                                       config.KV['IMS_RETRIES'],
+                                       params=ims_query,
+                                       page_size=config.KV['IMS_PAGE_SIZE'],
+                                       limiter=self.ims_limiter,
+                                       matches=ims.is_marked_for_projection)
+        self.ims_client = ims_client
+
+        self.s3_clients = s3_clients or s3.S3ClientHolder(config.KV['S3_PROTO'] + '://' + config.KV['S3_HOST'],
+                                                          config.KV['S3_CREDENTIAL_FILE'],
+                                                          max(10, config.KV['MANIFEST_WORKERS']),
+                                                          self.s3_limiter,
+                                                          config.KV['S3_MAX_ATTEMPTS'])
+
+        self.target_service = target_service or lio.TargetService(config.KV['TARGET_STATUS_TTL'])
+
+        self.label_watcher = label_watcher
+        self.was_labelled = None
+
+        # s3fs lookups (rootfs present, backstore dev still there), isfile
+        # answers whether a path is a file, None if unknown
+
+        self.s3fs = s3fs.S3fsProbe(isfile or s3fs.isfile,
+                                   config.KV['S3FS_PROBE_WORKERS'],
+                                   config.KV['S3FS_PROBE_TIMEOUT'],
+                                   config.KV['S3FS_PROBE_TTL'])
+
+        # Optionally warm the s3fs cache for new projections
+
+        self.prefetcher = None
+        if config.KV['PREFETCH']:
+            self.prefetcher = prefetch.Prefetcher(config.KV['PREFETCH_WORKERS'],
+                                                  config.KV['PREFETCH_LEADING_BYTES'],
+                                                  config.KV['PREFETCH_BANDWIDTH'])
+
+        # Optionally share the resolved projection set: a publisher writes it
+        # after each full scan, consumers reconcile LIO from it alone
+
+        self.publisher = None
+        self.consumer = None
+
+        if config.KV['SNAPSHOT_MODE'] in ('publish', 'consume'):
+            store = snapshot.open_store(config.KV['SNAPSHOT_LOCATION'], self.s3_clients, config.KV['KUBECONFIG'])
+            if config.KV['SNAPSHOT_MODE'] == 'publish':
+                self.publisher = snapshot.SnapshotPublisher(store, hostname,
+                                                            config.KV['SQUASHFS_S3FS_MOUNT'],
+                                                            config.KV['SNAPSHOT_MAX_AGE'] / 3)
+            else:
+                self.consumer = snapshot.SnapshotConsumer(store, config.KV['SNAPSHOT_MAX_AGE'])
+        elif config.KV['SNAPSHOT_MODE'] != 'none':
+            raise ValueError(f"Unknown snapshot mode {config.KV['SNAPSHOT_MODE']}")
+
+        # Projection ledger entries of the last full scan, persisted by main()
+
+        self.ledger = None
+
+        # Each scan is traced as a tree: phases under the scan, and backend calls
+        # (S3, IMS, SPIRE, targetcli) under their phase
+
+        self.phases = metrics.PhaseTimer(listeners=[trace.lap])
+
+    def _failed(self, cheap: bool = False) -> ScanResult:
+        self.phases.stop()
+        trace.end_scan(error="scan failed")
+        metrics.SCANS.inc(result="failed")
+        return ScanResult(False, False, cheap, True)
+
+    def _done(self, changed: bool, labelled: bool = True) -> ScanResult:
+        self.phases.stop()
+        trace.end_scan()
+        if labelled:
+            metrics.mark_successful_scan()
+        return ScanResult(True, changed, False, labelled)
+
+    def labelled(self) -> bool:
+
+        """Whether the node has the 'iscsi=sbps' label. The label watch answers
+        from memory, kubectl is used until it has synced."""
+
+        if self.label_watcher is not None and self.label_watcher.labelled is not None:
+            return self.label_watcher.labelled
+
+        cmd = "kubectl get nodes --selector='iscsi=sbps,kubernetes.io/hostname="+self.hostname+"' -o jsonpath='{.items[*].metadata.name}' --kubeconfig "+config.KV['KUBECONFIG']
+        iscsi_nodes, _ = run_command(cmd)
+        return bool(iscsi_nodes)
+
+    def scan(self) -> ScanResult:
+
+        """Run a single scan and report how it went"""
+
+        backend = self.backend
+        phases = self.phases
+
+        trace.begin_scan(hostname=self.hostname)
+        phases.start("label_check")
+
+        self.s3_limiter.begin_scan()
+        self.ims_limiter.begin_scan()
+
+        concurrent_inputs = config.KV['SCAN_MODE'] == 'concurrent'
+
+        # Check whether node has 'iscsi=sbps' label. If its there, ensure 'target' service is running
+        # and proceed for projecting images, else stop the 'target' service.
+        # Without a synced label watch, the (kubectl) label check overlaps
+        # fetching the scan inputs in concurrent mode.
+
+        pool = None
+        tasks = None
+
+        if concurrent_inputs and (self.label_watcher is None or self.label_watcher.labelled is None):
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="scan")
+            tasks = self._submit_inputs(pool)
+            labelled = self.labelled()
+        else:
+            labelled = self.labelled()
+
+        if labelled:
+            logging.info(f"Node has iSCSI label")
+            self.target_service.ensure_active()
+
+            if self.was_labelled is False:
+                logging.info(f"Node regained iSCSI label, enabling the target port")
+                try:
+                    backend.enable_target(self.iqn)
+                    metrics.LIO_OPERATIONS.inc(op="enable_target", result="ok")
+                except Exception as err:
+                    metrics.LIO_OPERATIONS.inc(op="enable_target", result="error")
+                    logging.warning(f"Unable to enable the target port, received -> {str(err)}")
+
+            self.was_labelled = True
+        else:
+            logging.info(f"Node does not have iSCSI label, disabling the target port")
+            if pool is not None:
+                _cancel(pool, tasks)
+            backend.disable_target(self.iqn)
+            metrics.LIO_OPERATIONS.inc(op="disable_target", result="ok")
+            self.target_service.invalidate()
+            self.was_labelled = False
+            return self._done(changed=False, labelled=False)
+
+        logging.info("START SCAN")
+        ## ----------------------------------------------------------
+        ## Pre-flight for all types of image projection
+        ## ----------------------------------------------------------        
+
+        # Gather the S3 inventory, LIO state and IMS inventory, one after the
+        # other or all at once
+
+        if concurrent_inputs:
+            if pool is None:
+                pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="scan")
+                tasks = self._submit_inputs(pool)
+            phases.start("inputs")
+            results = _join(pool, tasks, config.KV['SCAN_INPUT_TIMEOUT'])
+        else:
+            results = dict()
+            for name, task in self._input_tasks():
+                results[name] = _run(task, phases)
+
+        if self.consumer is not None:
+            return self._scan_snapshot(results)
+
+        try:
+            s3_client, s3_index, scoped = _result(results["s3"])
+            lio_save, target_iqn = _result(results["lio"])
+        except ScanInputError as err:
+            logging.error(str(err))
+            return self._failed(cheap=err.cheap)
+
+        fileio_backstores = count_projected(lio_save)
+
+        ## ----------------------------------------------------------
+        ## Programming Environment Image Synchronization Logic
+        ## ----------------------------------------------------------
+
+        phases.start("pe_reconcile")
+
+        desired = planner.pe_projections(s3_index,
+                                         config.KV['S3_BUCKET'],
+                                         config.KV['SQUASHFS_S3FS_MOUNT'])
+        logging.info(f"Counted {len(desired)} S3, PE images in boot-images bucket.")
+
+        ## ----------------------------------------------------------
+        ## Rootfs Image Synchronization Logic
+        ## ----------------------------------------------------------
+
+        # Without the IMS image inventory only additions are applied,
+        # nothing is removed.
+
+        try:
+            ims_images = _result(results["ims"])
+        except ScanInputError as err:
+            logging.error(str(err))
+            reconcile(backend, desired, fileio_backstores, target_iqn, prune=False, probe=self.s3fs,
+                      prefetcher=self.prefetcher)
+            return self._failed()
+
+        phases.start("rootfs_reconcile")
+
+        # Skip the heavy phases (manifests, s3fs checks, LIO changes) when
+        # none of the scan inputs changed since the last complete scan
+
+        inputs = [ fingerprint.s3_index_digest(s3_index),
+                   fingerprint.ims_images_digest(ims_images),
+                   config.KV['IMS_TAGGING'],
+                   config.KV['S3_INVENTORY_MODE'] ]
+
+        if self.fingerprints.unchanged(fingerprint.digest(inputs, backend.state_token())):
+            self._publish()
+            metrics.SCANS.inc(result="skipped")
+            logging.info(f"Scan inputs unchanged since the last complete scan, skipping reconciliation. Scan counts: {dict(self.fingerprints.stats)}")
+            logging.info("END SCAN")
+            return self._done(changed=False)
+
+        logging.info(f"Starting rootfs image reconciliation. Scan counts: {dict(self.fingerprints.stats)}")
+
+        metrics.SCANS.inc(result="full")
+
+        try:
+            candidates, complete = resolve_rootfs_projections(s3_client, s3_index, ims_images,
+                                                              self.manifest_cache, scoped, phases)
+        except Exception as err:
+            logging.error(f"Unable to look up rootfs S3 objects, received -> {str(err)}")
+            reconcile(backend, desired, fileio_backstores, target_iqn, prune=False, probe=self.s3fs,
+                      prefetcher=self.prefetcher)
+            return self._failed()
+
+        self.manifest_cache.retain(set([(i["link"]["path"], i["link"].get("etag")) for i in ims_images]))
+        logging.info(f"Manifest cache stats: {dict(self.manifest_cache.stats)}")
+
+        # Consumers check the published projections against their own s3fs
+
+        self._publish(desired + candidates, complete)
+
+        rootfs, present = present_projections(candidates, self.s3fs)
+        complete = complete and len(rootfs) == len(candidates) and None not in present.values()
+
+        desired.extend(rootfs)
+
+        return self._apply(desired, complete, present, inputs, fileio_backstores, target_iqn)
+
+    def _scan_snapshot(self, results: dict) -> ScanResult:
+
+        """Reconcile LIO from a published snapshot, the rest of a consumer's scan"""
+
+        backend = self.backend
+
+        try:
+            shared = _result(results["snapshot"])
+            lio_save, target_iqn = _result(results["lio"])
+        except ScanInputError as err:
+            logging.error(str(err))
+            return self._failed(cheap=err.cheap)
+
+        fileio_backstores = count_projected(lio_save)
+
+        self.phases.start("rootfs_reconcile")
+
+        inputs = [ shared.digest, config.KV['SQUASHFS_S3FS_MOUNT'] ]
+
+        if self.fingerprints.unchanged(fingerprint.digest(inputs, backend.state_token())):
+            metrics.SCANS.inc(result="skipped")
+            logging.info(f"Snapshot {shared.digest[:12]} unchanged since the last complete scan, skipping reconciliation. Scan counts: {dict(self.fingerprints.stats)}")
+            logging.info("END SCAN")
+            return self._done(changed=False)
+
+        logging.info(f"Starting reconciliation from snapshot {shared.digest[:12]} published by {shared.publisher} {shared.age():.0f}s ago. Scan counts: {dict(self.fingerprints.stats)}")
+
+        metrics.SCANS.inc(result="full")
+
+        # PE projections come straight from the S3 listing, rootfs ones (with
+        # an etag) are checked on this node's s3fs like in a full scan
+
+        published = shared.projections(config.KV['SQUASHFS_S3FS_MOUNT'])
+        desired = [ p for p in published if p.etag is None ]
+        candidates = [ p for p in published if p.etag is not None ]
+
+        rootfs, present = present_projections(candidates, self.s3fs)
+        complete = shared.complete and len(rootfs) == len(candidates) and None not in present.values()
+
+        desired.extend(rootfs)
+
+        return self._apply(desired, complete, present, inputs, fileio_backstores, target_iqn)
+
+    def _apply(self, desired: list, complete: bool, present: dict, inputs: list,
+               fileio_backstores: list, target_iqn: str) -> ScanResult:
+
+        """Apply the desired projections to LIO, pruning everything else, and
+        remember the scan inputs when nothing is left to retry"""
+
+        backend = self.backend
+
+        self.phases.start("lio_apply")
+
+        plan = reconcile(backend, desired, fileio_backstores, target_iqn, prune=True,
+                         probe=self.s3fs, present=present, prefetcher=self.prefetcher)
+
+        try:
+            self.ledger = lio.ledger_entries(desired, backend.load_config())
+        except Exception as err:
+            logging.warning(f"Unable to build the projection ledger, received -> {str(err)}")
+
+        # Only remember scans that left nothing to retry, the LIO part of
+        # the fingerprint is taken after this scan's own changes
+
+        if complete and not plan.failed:
+            try:
+                self.fingerprints.record(fingerprint.digest(inputs, backend.state_token()))
+            except Exception as err:
+                logging.warning(f"Unable to fingerprint LIO state, received -> {str(err)}")
+        else:
+            self.fingerprints.invalidate()
+
+        logging.info("END SCAN")
+
+        return self._done(changed=len(plan) > 0)
+
+    def _publish(self, projections: list = None, complete: bool = True):
+
+        """Publish the projection set when publishing, or only show the
+        last snapshot is still current when projections is None"""
+
+        if self.publisher is None:
+            return
+
+        try:
+            if projections is None:
+                self.publisher.keepalive()
+            else:
+                self.publisher.publish(projections, complete)
+        except Exception as err:
+            logging.warning(f"Unable to publish the projection snapshot to {self.publisher.store.location}, received -> {str(err)}")
+
+    def _input_tasks(self) -> list:
+
+        """The independent scan inputs, as (name, function) in the order
+        sequential scans fetch them. Consumers only need the snapshot and
+        the LIO state."""
+
+        if self.consumer is not None:
+            return [ ("snapshot", self._snapshot),
+                     ("lio", self._lio_state) ]
+
+        return [ ("s3", self._s3_inventory),
+                 ("lio", self._lio_state),
+                 ("ims", self._ims_inventory) ]
+
+    def _submit_inputs(self, pool: concurrent.futures.ThreadPoolExecutor) -> dict:
+        phases = _ConcurrentPhases()
+        return { name : pool.submit(_run, task, phases, True) for name, task in self._input_tasks() }
+
+    def _s3_inventory(self, phases) -> tuple:
+
+        """Return (s3_client, s3_index, scoped)"""
+
+        # Reuse the S3 client from previous scans, credentials are reloaded
+        # from file (and the client recreated) only when the file changes
+
+        phases.start("credentials")
+
+        try:
+            s3_client = self.s3_clients.get()
+        except Exception as err:
+            raise ScanInputError(f"Unable to retrieve S3 credentials or create S3 client, received -> {str(err)}", cheap=True)
+
+        # Attempt to query S3 objects from the configured bucket. In scoped mode
+        # only PE images are listed, rootfs objects are checked individually
+        # once the IMS manifests name them.
+
+        phases.start("s3_list")
+
+        scoped = config.KV['S3_INVENTORY_MODE'] == 'scoped'
+
+        try:
+            s3_index = s3.list_bucket_objects(s3_client,
+                                                config.KV['S3_BUCKET'],
+                                                "PE/" if scoped else None)
+        except Exception as err:
+            raise ScanInputError(f"Unable to list S3 objects, received -> {str(err)}")
+
+        logging.info(f"Counted {len(s3_index)} S3 objects in {config.KV['S3_BUCKET']} bucket{' under PE/' if scoped else ''}.")
+
+        return s3_client, s3_index, scoped
+
+    def _lio_state(self, phases) -> tuple:
+
+        """Return (lio_save, target_iqn), LIO targets and LUNs from the
+        target save configuration (JSON) or configfs"""
+
+        phases.start("lio_load")
+
+        try:
+            lio_save = self.backend.load_config()
+        except FileNotFoundError:
+            raise ScanInputError(f"LIO state does not exist at {self.backend.source}, aborting", cheap=True)
+        except Exception as err:
+            raise ScanInputError(f"Unable to load LIO configuration, received -> {str(err)}", cheap=True)
+
+        target_iqn = lio.get_lio_target_iqn(lio_save)
+        if target_iqn is None:
+            raise ScanInputError(f"Unable to get server target IQN from {self.backend.source}, aborting", cheap=True)
+
+        logging.info(f"Detected {target_iqn} as LIO server IQN")
+
+        return lio_save, target_iqn
+
+    def _snapshot(self, phases) -> snapshot.Snapshot:
+
+        """Return the published projection snapshot"""
+
+        phases.start("snapshot_fetch")
+
+        try:
+            return self.consumer.fetch()
+        except Exception as err:
+            raise ScanInputError(f"Unable to use the projection snapshot from {self.consumer.store.location}, received -> {str(err)}")
+
+    def _ims_inventory(self, phases) -> list:
+
+        """Return the IMS image inventory"""
+
+        phases.start("ims_fetch")
+
+        try:
+            self.svids.get() # use Spire Auth, cached and refreshed before expiry
+        except Exception as err:
+            raise ScanInputError(f"Unable to retrieve a spire token, received -> {str(err)}")
+
+        logging.info(f"Using IMS URL: {self.ims_client.ims_url}")
+
+        try:
+            ims_images = list_ims_images(self.ims_client, self.svids)
+        except Exception as err:
+            raise ScanInputError(f"Unable to list IMS images, received -> {str(err)}")
+
+        logging.info(f"Counted {len(ims_images)} IMS images.")
+
+        return ims_images
+
+class ScanInputError(Exception):
+
+    """A scan input could not be fetched, cheap if retrying soon may help"""
+
+    def __init__(self, message: str, cheap: bool = False):
+        super().__init__(message)
+        self.cheap = cheap
+
+class _ConcurrentPhases:
+
+    """Stand-in for the phase timer on input threads: times each phase into
+    the same histogram, traced under the running 'inputs' phase"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self, phase: str):
+        self.stop()
+        self.local.span = trace.span(phase)
+        self.local.span.__enter__()
+        self.local.timer = metrics.SCAN_PHASE_SECONDS.time(phase=phase)
+        self.local.timer.__enter__()
+
+    def stop(self):
+        if getattr(self.local, "timer", None) is not None:
+            self.local.timer.__exit__(None, None, None)
+            self.local.span.__exit__(None, None, None)
+        self.local.timer = None
+        self.local.span = None
+
+def _run(task, phases, stop: bool = False):
+
+    """Run an input task, returning its result or the ScanInputError it
+    raised. stop ends the task's last phase (input threads)."""
+
+    try:
+        return task(phases)
+    except ScanInputError as err:
+        return err
+    finally:
+        if stop:
+            phases.stop()
+
+def _join(pool: concurrent.futures.ThreadPoolExecutor, tasks: dict, timeout: float) -> dict:
+
+    """Wait up to timeout seconds for all input tasks, then abandon the
+    pool. Tasks still running are reported as failed (threads cannot be
+    interrupted, they finish in the background and their results are
+    dropped)."""
+
+    concurrent.futures.wait(tasks.values(), timeout=timeout)
+    results = dict()
+    for name, future in tasks.items():
+        if future.done():
+            results[name] = future.result()
+        else:
+            future.cancel()
+            results[name] = ScanInputError(f"Timed out after {timeout}s fetching the {name} scan input")
+    pool.shutdown(wait=False)
+    return results
+
+def _cancel(pool: concurrent.futures.ThreadPoolExecutor, tasks: dict):
+    for future in tasks.values():
+        future.cancel()
+    pool.shutdown(wait=False)
+
+def _result(value):
+    if isinstance(value, ScanInputError):
+        raise value
+    return value
+
+def main(argv: list = None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true')
     parser.add_argument('-q', '--quiet', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--once', action='store_true',
+                        help='run a single scan and exit, non-zero if the scan failed')
+    parser.add_argument('--record', metavar='DIR',
+                        help='run a single scan and save everything it consumed to DIR')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='run a single scan against a recording, LIO is not touched')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        args.once = True
 
     log_format = "%(filename)s:%(funcName)s:%(lineno)s %(levelname)s %(asctime)s %(message)s"
 
@@ -60,6 +648,9 @@ def main():
                 datefmt="%Y-%m-%dT%H:%M:%S%z",
                 level=logging.INFO)
 
+    if args.replay:
+        sys.exit(replay(args.replay))
+
     for k,v in config.KV.items():
         logging.info(f"config K:{k}, V: {str(v)}")
 
@@ -69,8 +660,90 @@ def main():
         logging.error(f"hostname retrieval failed, exiting..")
         sys.exit(1)
 
-    # Retrieving IQN as /etc/target/saveconfig.json will not exist initially
-    IQN = f'iqn.2023-06.csm.iscsi:{hostname}'
+    try:
+        agent = Agent(hostname)
+    except Exception as err:
+        logging.error(f"Unable to initialize the agent ({config.KV['LIO_BACKEND']} LIO backend), received -> {str(err)}")
+        sys.exit(1)
+
+    logging.info(f"Using {agent.backend.name} LIO backend")
+
+    # Record a single, full scan, with call timings traced into the recording
+
+    recorder = None
+    if args.record:
+        recorder = recording.Recorder(args.record)
+        agent.s3_clients = recorder.s3_clients(agent.s3_clients)
+        agent.ims_client = recorder.ims_client(agent.ims_client)
+        agent.backend = recorder.backend(agent.backend)
+        agent.manifest_cache = recorder.manifest_cache(agent.manifest_cache)
+        agent.s3fs.check = recorder.isfile(agent.s3fs.check)
+        if not config.KV['TRACE_OUTPUT']:
+            config.KV['TRACE_OUTPUT'] = args.record
+
+    scheduler = sched.Scheduler(config.KV['SCAN_FREQUENCY'],
+                                idle_interval=config.KV['SCAN_IDLE_FREQUENCY'],
+                                retry_interval=config.KV['SCAN_RETRY_FREQUENCY'],
+                                watch_paths=[config.KV['LIO_SAVE_FILE'],
+                                             config.KV['S3_CREDENTIAL_FILE']])
+    scheduler.install_signal_handler()
+
+    # Exit normally on SIGTERM (systemctl stop), so at-exit cleanup runs,
+    # e.g., removing the Kubernetes client key material
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Optional Prometheus metrics, scan phases are timed back to back
+
+    if config.KV['METRICS_PORT'] and not args.once:
+        try:
+            metrics.start_http_server(config.KV['METRICS_PORT'], config.KV['METRICS_ADDR'])
+            logging.info(f"Serving metrics on port {config.KV['METRICS_PORT']}")
+        except Exception as err:
+            logging.error(f"Unable to start metrics listener, received -> {str(err)}")
+
+    manifest_cache = agent.manifest_cache
+    for stat in ("hits", "disk_hits", "misses", "evictions"):
+        metrics.MANIFEST_CACHE.set_function(lambda stat=stat: manifest_cache.stats[stat], stat=stat)
+    metrics.MANIFEST_CACHE.set_function(lambda: len(manifest_cache.entries), stat="entries")
+
+    # Follow the node label through the Kubernetes API, label changes wake
+    # the agent up immediately
+
+    if config.KV['K8S_LABEL_WATCH'] and not args.once:
+        try:
+            agent.label_watcher = k8s.NodeLabelWatcher(k8s.KubeApi.from_kubeconfig(config.KV['KUBECONFIG']),
+                                                       hostname,
+                                                       on_change=lambda labelled: scheduler.wake("node label change"))
+            agent.label_watcher.start()
+        except Exception as err:
+            logging.warning(f"Unable to watch node labels, using kubectl, received -> {str(err)}")
+            agent.label_watcher = None
+
+    # Warm start: when the projection ledger matches live LIO, projections
+    # are served as they are and target.service is not restarted. A mismatch
+    # (e.g., a failed delete, backstores left alone while s3fs was unknown)
+    # never adds a restart, the saved initialized flag stands.
+
+    lio.load_state()
+
+    try:
+        valid = lio.validate_ledger(agent.backend.load_config())
+    except Exception as err:
+        logging.warning(f"Unable to validate the projection ledger, received -> {str(err)}")
+        valid = None
+
+    if valid:
+        logging.info(f"Projection ledger matches live LIO ({len(lio.state['projections'])} projections), skipping target.service restart")
+        lio.state["initialized"] = True
+    elif valid is False:
+        logging.info(f"Projection ledger does not match live LIO, reconciling on the first scan")
+
+    # Nodes restarted together (e.g., after an upgrade) start their scan
+    # cycles at different times
+
+    if not args.once and config.KV['SCAN_START_SPREAD'] > 0:
+        scheduler.sleep(scheduler.stagger(hostname, config.KV['SCAN_START_SPREAD']))
 
     ## --------------------------------------------------------------
     ## Main Agent Loop
@@ -78,341 +751,277 @@ def main():
 
     while True:
 
-        # Check whether node has 'iscsi=sbps' label. If its there, ensure 'target' service is running
-        # and proceed for projecting images, else stop the 'target' service.
+        result = agent.scan()
 
-        cmd = "kubectl get nodes --selector='iscsi=sbps,kubernetes.io/hostname="+hostname+"' -o jsonpath='{.items[*].metadata.name}' --kubeconfig /etc/kubernetes/admin.conf"
+        if result.ok and result.labelled:
 
-        iscsi_nodes, _ = run_command(cmd)
+            # Restart the target service only once after the first SCAN is complete
+            if not lio.state["initialized"]:
+                # one-time initialization
+                logging.info(f"Restart target.service")
+                lio.tgt_service_restart()
+
+            if agent.ledger is not None:
+                try:
+                    if lio.update_ledger(agent.ledger):
+                        logging.info(f"Updated projection ledger, {len(agent.ledger)} projections")
+                except Exception as err:
+                    logging.warning(f"Unable to save the projection ledger, received -> {str(err)}")
+
+        if recorder is not None:
+            recorder.save(hostname)
 
-        if iscsi_nodes:
-            logging.info(f"Node has iSCSI label: {iscsi_nodes}")
-            tgt_status, _  = run_command("systemctl is-active target.service")
+        if args.once:
+            sys.exit(0 if result.ok else 1)
 
-            if tgt_status != "active":
-                logging.info(f"Target service is not active, starting")
-                subprocess.run(["systemctl", "start", "target.service"], check=True)
+        if result.ok:
+            scheduler.sleep(scheduler.success(changed=result.changed))
         else:
-            logging.info(f"Node does not have iSCSI label, disabling the target port")
-            lio.disable_target(IQN)
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
+            scheduler.sleep(scheduler.failure(cheap=result.cheap))
 
-        logging.info("START SCAN")
-        ## ----------------------------------------------------------
-        ## Pre-flight for all types of image projection
-        ## ----------------------------------------------------------        
+def replay(directory: str) -> int:
 
-        # Attempt to load S3 credentials from file, and then create a client
+    """Run a single full scan against a recording made with --record and
+    report what it would have changed. Returns the exit status."""
 
-        try:
-            s3_key_id, s3_access_key = auth.get_s3fs_creds(config.KV['S3_CREDENTIAL_FILE'])
-        except Exception as err:
-            logging.error(f"Unable to retrieve S3 credentials, received -> {str(err)}")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
-        
-        try:
-            s3_host = config.KV['S3_PROTO'] + '://' + config.KV['S3_HOST']
-            s3_client = s3.get_s3_client(s3_host, 
-                                         s3_key_id, 
-                                         s3_access_key)
-        except Exception as err:
-            logging.error(f"Unable to create S3 client, received -> {str(err)}")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
+    stand_ins = recording.load(directory)
 
-        # Attempt to query S3 objects from the configured bucket
+    # Nothing outside the recording is read or written: no snapshot is
+    # published to, or consumed from, the live store, and the images are
+    # not prefetched from the live s3fs mount
 
-        try:
-            s3_objects = s3.list_bucket_objects(s3_client, config.KV['S3_BUCKET'])
-        except Exception as err:
-            logging.error(f"Unable to list S3 objects, received -> {str(err)}")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
+    config.KV['SNAPSHOT_MODE'] = 'none'
+    config.KV['PREFETCH'] = False
 
-        logging.info(f"Counted {len(s3_objects)} S3 objects in {config.KV['S3_BUCKET']} bucket.")
+    agent = Agent(stand_ins.hostname,
+                  backend=stand_ins.backend,
+                  s3_clients=stand_ins.s3_clients,
+                  ims_client=stand_ins.ims_client,
+                  svids=stand_ins.svids,
+                  manifest_cache=cache.ManifestCache(config.KV['MANIFEST_CACHE_SIZE']),
+                  target_service=stand_ins.target_service,
+                  label_watcher=stand_ins.label_watcher,
+                  isfile=stand_ins.isfile)
 
-        # Load and process LIO targets and LUNs from the target
-        # save configuration file (JSON)
+    started = time.perf_counter()
+    result = agent.scan()
+    elapsed = time.perf_counter() - started
 
-        lio_save = None
-        if os.path.isfile(config.KV['LIO_SAVE_FILE']):
-            with open(config.KV['LIO_SAVE_FILE'], 'r') as f:
-                lio_save = json.load(f)
-        else:
-            logging.error(f"LIO Save file does not exist at {config.KV['LIO_SAVE_FILE']}, aborting")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
+    logging.info(f"Replayed scan of {stand_ins.hostname} from {directory} in {elapsed:.3f}s, "
+                 f"ok: {result.ok}, changed: {result.changed}, LIO operations: {dict(stand_ins.backend.calls)}")
 
-        target_iqn = lio.get_lio_target_iqn(lio_save)
-        if target_iqn is None:
-            logging.error(f"Unable to get server target IQN from {config.KV['LIO_SAVE_FILE']}, aborting")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue
+    return 0 if result.ok else 1
 
-        logging.info(f"Detected {target_iqn} as LIO server IQN")
+def count_projected(lio_save: dict) -> list:
 
-        fileio_backstores = list(lio.extract_fileio_backstores(lio_save))
-        logging.info(f"Counted {len(fileio_backstores)} LIO target fileio backstores")
+    """Return the fileio backstores of a LIO configuration, counting them
+    and the LUNs"""
 
-        # Walk through fileio backstores, remove any that do not exist in S3FS
-        # If we don't, attempting to add backstores may fail
+    fileio_backstores = list(lio.extract_fileio_backstores(lio_save))
+    logging.info(f"Counted {len(fileio_backstores)} LIO target fileio backstores")
 
-        for fileio_backstore in fileio_backstores:
+    target_luns = list(lio.extract_fileio_target_luns(lio_save))
+    logging.info(f"Counted {len(target_luns)} LIO target LUNs")
 
-            if not os.path.exists(fileio_backstore["dev"]):
+    metrics.PROJECTED.set(len(fileio_backstores), kind="backstores")
+    metrics.PROJECTED.set(len(target_luns), kind="luns")
 
-                try:
-                    lio.delete_fileio_backstore(fileio_backstore["name"])
-                except Exception as err:
-                    logging.error(
-                        f"Unable to remove LIO fileio backstore for {fileio_backstore['dev']}, received -> {str(err)}")            
+    return fileio_backstores
 
-                try:
-                    lio.save_config()
-                except Exception as err:
-                    logging.error(f"Unable save LIO configuration, received -> {str(err)}")
+def resolve_rootfs_projections(s3_client, s3_index: dict, ims_images: list,
+                               manifest_cache: cache.ManifestCache, scoped: bool,
+                               phases: metrics.PhaseTimer) -> tuple:
 
-        # Reload the fileio backstores and load LUN state after stale S3FS purge
-                    
-        fileio_backstores = list(lio.extract_fileio_backstores(lio_save))
-        logging.info(f"Counted {len(fileio_backstores)} LIO target fileio backstores after stale S3FS purge")
+    """Resolve IMS images to rootfs projections backed by a matching S3
+    object, before checking s3fs. Returns (projections, complete), complete
+    is False if an image was skipped because its manifest was not
+    retrieved. In scoped mode the rootfs objects are added to s3_index."""
 
-        target_luns = list(lio.extract_fileio_target_luns(lio_save))
-        logging.info(f"Counted {len(target_luns)} LIO target LUNs after stale S3FS purge")
+    complete = True
 
-        # Track the WWN products for all valid (new or existing) backstores projected
-        # so we can attempt to clean them up after all projection modifications are 
-        # complete
-        valid_backstores = set()
+    # Check to see if images are marked for projection before spending
+    # anything on their manifests
 
-        ## ----------------------------------------------------------
-        ## Programming Environment Image Synchronization Logic
-        ## ----------------------------------------------------------        
+    if config.KV['IMS_TAGGING']:
+        marked = [ i for i in ims_images if ims.is_marked_for_projection(i) ]
+        logging.info(f"Counted {len(marked)} of {len(ims_images)} IMS images marked for projection.")
+        ims_images = marked
 
-        pe_images = [ x for x in s3_objects if x['Key'].startswith("PE/") ]
-        logging.info(f"Counted {len(pe_images)} S3, PE images in boot-images bucket. Starting PE image reconciliation.")
+    # Retrieve the IMS manifests concurrently, results come back in IMS order
 
-        for s3_object in pe_images:
+    phases.start("manifest_fetch")
 
-            # Create an s3 normalized path to generate LIO device attributes (wwn, product)
-            # e.g., s3://boot-images/PE/CPE-nvidia.x86_64-23.05.squashfs
-            pe_s3_path = "s3://" + config.KV['S3_BUCKET'] + '/' + s3_object['Key']
+    manifests = fetch_manifests(s3_client, ims_images, manifest_cache,
+                                config.KV['MANIFEST_WORKERS'])
 
-            # Where does the object exist in s3fs (as locally mounted)
-            pe_s3fs_path = os.path.join(config.KV['SQUASHFS_S3FS_MOUNT'], s3_object['Key'])        
+    phases.start("rootfs_reconcile")
 
-            pe_product = lio.generate_lun_product(pe_s3_path)
-            pe_wwn = lio.generate_lun_wwn(pe_s3_path)
-            size = s3_object['Size']
+    rootfs_artifacts = []
 
-            valid_backstores.add(pe_product)
+    for ims_image, (manifest, err) in zip(ims_images, manifests):
 
-            # Check LIO saveconfig data to see if the device exists
+        # Verify the manifest was retrieved along with its required attributes
 
-            # dev == the s3fs path for a fileio backstore
-            # name == product
-            # wwn == wwn
+        # "s3://boot-images/1fb58f4e-ad23-489b-89b7-95868fca7ee6/manifest.json"
+        m = planner.s3_key(ims_image["link"]["path"], config.KV['S3_BUCKET'])
 
-            found_backstore = False
-            for fileio_backstore in fileio_backstores:
-                if fileio_backstore["dev"] == pe_s3fs_path:
-                    if fileio_backstore["name"] == pe_product:
-                        if fileio_backstore["wwn"] == pe_wwn:
-                            found_backstore = lio.fileio_size(fileio_backstore, size)        
+        if err is not None:
+            logging.error(f"Unable to obtain manifest for IMS image {m}, received -> {str(err)}")
+            complete = False
+            continue
 
-            if found_backstore:
-                continue # backstore already exists, assume LUN does as well
+        # Attempt to retrieve the path and etag for the rootfs artifact cited
+        # in the manifest. If unable to retrieve either, will be unable to project.
 
-            logging.info(f"ADD PE LIO fileio backstore: s3_path: {pe_s3fs_path}, s3fs_path: {pe_s3fs_path}, lun_wwn: {pe_wwn}, lun_product: [{pe_product}")
-            try:
-                lio.create_fileio_backstore(pe_product, pe_s3fs_path, pe_wwn)
-            except Exception as err:
-                logging.error(f"Unable to create PE LIO fileio backstore for {pe_s3fs_path}, received -> {str(err)}")
+        rootfs_s3_path, rootfs_s3_etag = planner.rootfs_artifact(manifest)
 
-            try:
-                lio.create_lun(pe_product, target_iqn)
-            except Exception as err:
-                logging.error(f"Unable to create PE LIO LUN for {pe_s3fs_path}, received -> {str(err)}")
+        if rootfs_s3_path is None or rootfs_s3_etag is None:
+            logging.error(f"path or etag missing in IMS manifest -> {m}")
+            continue
 
-            try:
-                lio.save_config()
-            except Exception as err:
-                logging.error(f"Unable save to LIO configuration for PE, received -> {str(err)}")
+        rootfs_artifacts.append((rootfs_s3_path, rootfs_s3_etag, ims_image.get("id")))
 
-        ## ----------------------------------------------------------
-        ## Rootfs Image Synchronization Logic
-        ## ----------------------------------------------------------
+    # In scoped mode, look up only the rootfs objects the manifests cite
 
-        # Attempt to query IMS API for its image inventory
+    if scoped:
+        keys = sorted(set([planner.s3_key(p, config.KV['S3_BUCKET']) for p, _, _ in rootfs_artifacts]))
+        rootfs_objects = s3.head_objects(s3_client, config.KV['S3_BUCKET'], keys,
+                                         config.KV['MANIFEST_WORKERS'])
+        logging.info(f"Found {len(rootfs_objects)} of {len(keys)} rootfs S3 objects.")
+        s3_index.update(rootfs_objects)
 
-        try:
-            spire_jwt = auth.get_spire_svid_jwt() # use Spire Auth
-        except Exception as err:
-            logging.error(f"Unable to retrieve a spire token, received -> {str(err)}")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
+    candidates = []
+
+    for rootfs_s3_path, rootfs_s3_etag, image_id in rootfs_artifacts:
+
+        # Verify that the image exists in s3
+
+        projection = planner.rootfs_projection(rootfs_s3_path,
+                                               rootfs_s3_etag,
+                                               s3_index,
+                                               config.KV['S3_BUCKET'],
+                                               config.KV['SQUASHFS_S3FS_MOUNT'],
+                                               image_id)
+        if projection is None:
+            logging.info(f"Matching S3 object not found for {rootfs_s3_path} with etag {rootfs_s3_etag}")
             continue
 
-        ims_url = urllib.parse.urljoin(config.KV['API_GATEWAY'], 
-                                       config.KV['IMS_URI'])
-        
-        logging.info(f"Using IMS URL: {ims_url}")
+        candidates.append(projection)
 
-        try:
-            ims_images = list(ims.images(ims_url, 
-                                         spire_jwt, 
-                                         config.KV['IMS_TIMEOUT']))
-            
-        except Exception as err:
-            logging.error(f"Unable to list IMS images, received -> {str(err)}")
-            time.sleep(config.KV['SCAN_FREQUENCY'])
-            continue     
-        
-        logging.info(f"Counted {len(ims_images)} IMS images. Starting rootfs image reconciliation.")
-        for ims_image in ims_images:
+    return candidates, complete
 
-            # Retrieve the IMS manifest for the image and verify required attributes
+def present_projections(candidates: list, probe: s3fs.S3fsProbe) -> tuple:
 
-            try:
-                # "s3://boot-images/1fb58f4e-ad23-489b-89b7-95868fca7ee6/manifest.json"
-                m = ims_image["link"]["path"].replace("s3://" + config.KV['S3_BUCKET'] + "/", "")
-                ims_image_id = m.split("/")[0]
-                manifest = s3.get_s3_object(s3_client, config.KV['S3_BUCKET'], m)
-                manifest = json.load(manifest)
-            except Exception as err:
-                logging.error(f"Unable to obtain manifest for IMS image {m}, received -> {str(err)}")
-                continue
-
-            # Attempt to retrieve the path and etag for the rootfs artifact cited
-            # in the manifest. If unable to retrieve either, will be unable to project.
-
-            rootfs_s3_path = None
-            rootfs_s3_etag = None
-
-            for artifact in manifest["artifacts"]:
-                if artifact["type"] == "application/vnd.cray.image.rootfs.squashfs" and \
-                    'link' in artifact and artifact['link'] is not None and \
-                    'path' in artifact['link'] and 'etag' in artifact['link']:
-                    # Expects a normalized s3 path for link->path, e.g., 
-                    # s3://boot-images/00d18ed1-20a3-4df2-affb-a88fda00b6f6/rootfs
-                    rootfs_s3_path = artifact["link"]["path"]
-                    rootfs_s3_etag = artifact["link"]["etag"]
-
-            if rootfs_s3_path is None or rootfs_s3_etag is None:
-                logging.error(f"path or etag missing in IMS manifest -> {m}")
-                continue
-            
-            if config.KV['IMS_TAGGING']:
-
-                # Check to see if image is marked for projection
-                # If the metadata key does not exist, we assume that the 
-                # version of IMS in use doesn't support image tagging
-
-                if 'metadata' in ims_image.keys():
-                    if 'sbps-project' not in ims_image['metadata'].keys():
-                        logging.info(f"No sbps-project key value, so image is not marked for projection")
-                        continue
-                    else:
-                        try:
-                            if ims_image['metadata']['sbps-project'] != "true":
-                                logging.info(f"Image is not marked for projection in IMS {m}")
-                                continue
-                        except KeyError:
-                            pass
-
-            # Calculate WWN (input) and product name
-
-            digest_data = rootfs_s3_path + "|" + rootfs_s3_etag
-            rootfs_wwn = lio.generate_lun_wwn(digest_data)
-            rootfs_product = lio.generate_lun_product(digest_data)
-
-            # Verify that the image exists in s3
-
-            ims_in_s3 = False
-            for s3_object in s3_objects:
-                k = rootfs_s3_path.replace("s3://" + config.KV['S3_BUCKET'] + "/", "")
-                if s3_object['Key'] == k:
-                    if s3_object["ETag"].replace('"','') == rootfs_s3_etag:
-                        ims_in_s3 = True
-                        break
-            else:
-                logging.info(f"Matching S3 object not found for {rootfs_s3_path} with etag {rootfs_s3_etag}")
-                continue
+    """Drop the rootfs projections s3fs does not have (yet). Returns
+    (projections, present), present holds the s3fs answers by path and
+    projections s3fs did not answer for are included, see build_plan."""
 
-            # Verify that the image exists in s3fs
-            
-            s3fs_path = os.path.join(config.KV['SQUASHFS_S3FS_MOUNT'], 
-                                rootfs_s3_path.replace("s3://" + config.KV['S3_BUCKET'] + "/", ""))
-            
-            if not os.path.isfile(s3fs_path):
-                logging.info(f"S3 object for rootfs not found in s3fs, path: {s3fs_path}")
-                continue
+    # Verify that the images exist in s3fs
 
-            valid_backstores.add(rootfs_product)
+    present = probe.probe([(p.dev, p.etag) for p in candidates])
 
-            # Check LIO saveconfig data to see if the device exists
-            # dev == s3fspath, name == product, wwn == wwn
+    projections = []
 
-            size_r = s3_object['Size']
-            found_backstore = False
-            for fileio_backstore in fileio_backstores:
-                if fileio_backstore["dev"] == s3fs_path:
-                    if fileio_backstore["name"] == rootfs_product:
-                        if fileio_backstore["wwn"] ==rootfs_wwn:
-                            found_backstore = lio.fileio_size(fileio_backstore, size_r)
+    for projection in candidates:
 
-            ## TODO: should we guard against other S3FS corner cases here, like transient cache state? 
+        if present.get(projection.dev) is False:
+            logging.info(f"S3 object for rootfs not found in s3fs, path: {projection.dev}")
+            continue
 
-            # If a backstore was not found for the rootfs image, add it and create a lun
+        projections.append(projection)
 
-            if not found_backstore:
-                
-                logging.info(f"ADD rootfs LIO fileio backstore: s3_path: {rootfs_s3_path}, s3_etag: {rootfs_s3_etag}, s3fs_path: {s3fs_path}, lun_wwn: {rootfs_wwn}, lun_product: {rootfs_product}")
+    return projections, present
 
-                try:
-                    lio.create_fileio_backstore(rootfs_product, s3fs_path, rootfs_wwn)
-                except Exception as err:
-                    logging.error(f"Unable to create LIO fileio backstore for {rootfs_s3_path}, received -> {str(err)}")
+def list_ims_images(ims_client: ims.ImsClient, svids: auth.SvidProvider) -> list:
 
-                try:
-                    lio.create_lun(rootfs_product, target_iqn)
-                except Exception as err:
-                    logging.error(f"Unable to create LIO LUN for {rootfs_s3_path}, received -> {str(err)}")
+    """List IMS images with the cached SVID, fetching a fresh one and
+    retrying once if IMS rejects it"""
 
-                try:
-                    lio.save_config()
-                except Exception as err:
-                    logging.error(f"Unable save LIO configuration, received -> {str(err)}")
+    try:
+        return list(ims_client.images(svids.get()))
+    except requests.HTTPError as err:
+        if err.response is None or err.response.status_code != 401:
+            raise
+        logging.warning(f"IMS rejected the cached SPIRE token, fetching a new one")
+
+    svids.invalidate()
+    return list(ims_client.images(svids.get()))
+
+def fetch_manifests(s3_client, ims_images: list, manifest_cache: cache.ManifestCache,
+                    workers: int) -> list:
+
+    """Fetch and parse the manifest of every IMS image on a bounded thread
+    pool. Returns (manifest, error) tuples in the order of ims_images.
+    Manifests are immutable for a given etag, so they are served from the
+    cache unless the image changed. Running out of request budget is raised,
+    a partial set of manifests must not prune projections."""
+
+    def fetch(ims_image):
+        path = ims_image["link"]["path"]
+        key = planner.s3_key(path, config.KV['S3_BUCKET'])
+        try:
+            with trace.span("manifest", image=ims_image.get("id", ""), path=path):
+                manifest = manifest_cache.get_or_fetch(
+                    path,
+                    ims_image["link"].get("etag"),
+                    lambda: s3.get_s3_json(s3_client, config.KV['S3_BUCKET'], key))
+        except ratelimit.BudgetExceeded:
+            raise
+        except Exception as err:
+            return None, err
+        return manifest, None
 
-        # If fileio backstores exist that we didn't scan as valid at this point, 
-        # attempt to remove them
-        for fileio_backstore in fileio_backstores:
-            if fileio_backstore["name"] not in valid_backstores:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(fetch, ims_images))
 
-                logging.info(f"Attempting to remove fileio backstore {fileio_backstore} as it wasn't validated in this scan period")
+def reconcile(backend: lio.LioBackend, desired: list, fileio_backstores: list,
+              target_iqn: str, prune: bool, probe: s3fs.S3fsProbe, present: dict = None,
+              prefetcher: prefetch.Prefetcher = None):
 
-                try:
-                    lio.delete_fileio_backstore(fileio_backstore["name"])
-                except Exception as err:
-                    logging.error(f"Unable to remove LIO fileio backstore for {fileio_backstore['name']}, received -> {str(err)}")            
+    """Plan the LIO changes for desired projections and apply them in a
+    single transaction, logging the operations that failed. Backstore devs
+    are checked on s3fs unless present (path to answer) already has them.
+    Images of new or recreated LUNs are handed to prefetcher, if any."""
 
-                try:
-                    lio.save_config()
-                except Exception as err:
-                    logging.error(f"Unable to save LIO configuration, received -> {str(err)}")
+    present = dict(present or {})
+    present.update(probe.probe([(b["dev"], None) for b in fileio_backstores if b["dev"] not in present]))
 
-        logging.info("END SCAN")
+    plan = planner.build_plan(desired, fileio_backstores, exists=lambda path: present.get(path, True), prune=prune)
+
+    for b in plan.delete:
+        logging.info(f"DELETE LIO fileio backstore {b['name']} for {b['dev']}")
+    for p in plan.resize:
+        logging.info(f"RESIZE LIO fileio backstore: s3_path: {p.s3_path}, s3fs_path: {p.dev}, size: {p.size}, lun_wwn: {p.wwn}, lun_product: {p.product}")
+    for p in plan.add:
+        logging.info(f"ADD LIO fileio backstore: s3_path: {p.s3_path}, s3_etag: {p.etag}, s3fs_path: {p.dev}, lun_wwn: {p.wwn}, lun_product: {p.product}")
+
+    if not len(plan):
+        return plan
 
-        lio.load_state()
+    txn = backend.transaction()
+    plan.queue(txn, target_iqn)
 
-        # Restart the target service only once after the first SCAN is complete
-        if not lio.state["initialized"]:
-            # one-time initialization
-            logging.info(f"Restart target.service")
-            lio.tgt_service_restart()
+    logging.info(f"Applying {len(txn)} LIO operations")
+
+    for op in txn.commit():
+        if op["error"] is not None:
+            plan.failed.append(op)
+            logging.error(f"Unable to {op['op']} for {op['name']}, received -> {op['error']}")
+
+    if prefetcher is not None:
+        failed = set([op["name"] for op in plan.failed])
+        for p in plan.resize + plan.add:
+            if p.product not in failed:
+                prefetcher.submit(p.dev)
+
+    try:
+        lio_save = backend.load_config()
+        metrics.PROJECTED.set(len(list(lio.extract_fileio_backstores(lio_save))), kind="backstores")
+        metrics.PROJECTED.set(len(list(lio.extract_fileio_target_luns(lio_save))), kind="luns")
+    except Exception as err:
+        logging.warning(f"Unable to reload LIO configuration, received -> {str(err)}")
 
-        time.sleep(config.KV['SCAN_FREQUENCY'])
+    return plan
 
 def run_command(cmd):
     try:
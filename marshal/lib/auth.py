@@ -24,11 +24,16 @@
 
 """Simple authN and authZ client module"""
 
+import base64
+import functools
 import json
 import os
 import subprocess
 import logging
+import threading
+import time
 import lib.config as config
+import lib.trace as trace
 
 def get_s3fs_creds(file_path: str) -> tuple:
 
@@ -43,6 +48,19 @@ def get_s3fs_creds(file_path: str) -> tuple:
     
     raise ValueError("Unable to parse credentials")
 
+@functools.lru_cache(maxsize=None)
+def get_xname() -> str:
+
+    """Return the node xname, read once from /etc/cray/xname"""
+
+    try:
+        with open("/etc/cray/xname", "r") as file:
+            return file.read().rstrip()
+    except FileNotFoundError as e:
+        logging.warning(f"/etc/cray/xname not found")
+        return None
+
+@trace.traced("auth.get_spire_svid_jwt")
 def get_spire_svid_jwt() -> str:
 
     """Attempt to retrieve a Spire JWT for the SPBS agent workload and parse
@@ -63,16 +81,7 @@ def get_spire_svid_jwt() -> str:
 
     entries = json.loads(p.stdout)
 
-    xname = None
-
-    try:
-        file = open("/etc/cray/xname", "r")
-        xname = file.read().rstrip() 
-        file.close()
-
-    except FileNotFoundError as e:
-        logging.warn(f"/etc/cray/xname not found") 
-        pass 
+    xname = get_xname()
 
     for e in entries:
         if 'svids' in e.keys():
@@ -83,3 +92,85 @@ def get_spire_svid_jwt() -> str:
                     return svid['svid']
  
     raise ValueError("Could not find valid SVID")
+
+def jwt_expiry(token: str) -> float:
+
+    """Return the 'exp' claim (epoch seconds) of a JWT, None if absent"""
+
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    claims = json.loads(base64.urlsafe_b64decode(payload))
+    return claims.get('exp')
+
+class SvidProvider:
+
+    """Cache the SPIRE JWT-SVID and refresh it in the background shortly
+    before it expires, so scans rarely wait on the spire-agent CLI. The
+    cached SVID is only handed out until refresh_margin seconds before it
+    expires, after that (e.g., the background refresh failed) get() fetches
+    a new one."""
+
+    def __init__(self, fetch=get_spire_svid_jwt, refresh_margin: int = 60):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.expiry = 0
+        self.timer = None
+
+    def get(self) -> str:
+
+        """Return the cached SVID unless it is about to expire, otherwise
+        fetch one synchronously"""
+
+        with self.lock:
+            if self.token is not None and time.time() < self.expiry - self.refresh_margin:
+                return self.token
+
+        return self.refresh()
+
+    def invalidate(self):
+
+        """Drop the cached SVID, e.g., after IMS rejected it"""
+
+        with self.lock:
+            self.token = None
+            self.expiry = 0
+
+    def refresh(self) -> str:
+
+        """Fetch a new SVID and schedule its background refresh"""
+
+        token = self.fetch()
+
+        try:
+            expiry = jwt_expiry(token) or 0
+        except Exception as err:
+            logging.warning(f"Unable to decode SVID expiry, not caching it, received -> {str(err)}")
+            expiry = 0
+
+        with self.lock:
+            self.token = token
+            self.expiry = expiry
+            self._schedule(expiry - self.refresh_margin - time.time())
+
+        return token
+
+    def _schedule(self, delay: float):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if delay <= 0:
+            return
+        self.timer = threading.Timer(delay, self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+            logging.debug(f"Refreshed SPIRE SVID in the background")
+        except Exception as err:
+            logging.warning(f"Unable to refresh SPIRE SVID in the background, received -> {str(err)}")
+            with self.lock:
+                self._schedule(min(30, self.expiry - time.time()))
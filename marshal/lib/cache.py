@@ -0,0 +1,152 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module with an etag keyed cache for IMS image manifests"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+class ManifestCache:
+
+    """LRU cache of parsed IMS manifests keyed by (path, etag), optionally
+    backed by a directory so entries survive agent restarts.
+
+    A manifest is immutable for a given etag, so entries never need to be
+    revalidated against S3. Safe to share between threads."""
+
+    def __init__(self, max_entries: int = 4096, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        self.stats = collections.Counter(hits=0, disk_hits=0, misses=0, evictions=0)
+        self.lock = threading.RLock()
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _file(self, key: tuple) -> str:
+        digest = hashlib.sha224(bytes("|".join(key).encode('utf-8'))).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".json")
+
+    def _insert(self, key: tuple, manifest: dict):
+        self.entries[key] = manifest
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, path: str, etag: str) -> dict:
+
+        """Return a cached manifest or None"""
+
+        key = (path, etag)
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key]
+
+        if self.cache_dir:
+            try:
+                with open(self._file(key), 'r') as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                logging.warning(f"Ignoring unreadable cached manifest for {path}, received -> {str(err)}")
+            else:
+                with self.lock:
+                    self._insert(key, manifest)
+                    self.stats["disk_hits"] += 1
+                return manifest
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, path: str, etag: str, manifest: dict):
+
+        """Cache a manifest in memory and, if configured, on disk"""
+
+        key = (path, etag)
+
+        with self.lock:
+            self._insert(key, manifest)
+
+        if not self.cache_dir:
+            return
+
+        file_path = self._file(key)
+        try:
+            with open(file_path + ".tmp", 'w') as f:
+                json.dump(manifest, f)
+            os.replace(file_path + ".tmp", file_path)
+        except Exception as err:
+            logging.warning(f"Unable to persist manifest for {path}, received -> {str(err)}")
+
+    def get_or_fetch(self, path: str, etag: str, fetch) -> dict:
+
+        """Return the manifest for (path, etag), calling fetch() on a miss.
+        Manifests without an etag are never cached."""
+
+        if not etag:
+            with self.lock:
+                self.stats["misses"] += 1
+            return fetch()
+
+        manifest = self.get(path, etag)
+        if manifest is None:
+            manifest = fetch()
+            self.put(path, etag, manifest)
+
+        return manifest
+
+    def retain(self, keys: set):
+
+        """Drop entries (memory and disk) not in keys, a set of (path, etag)
+        tuples for the images currently known to IMS"""
+
+        keys = set([k for k in keys if k[1]])
+
+        with self.lock:
+            for key in [k for k in self.entries if k not in keys]:
+                del self.entries[key]
+
+        if not self.cache_dir:
+            return
+
+        live = set([os.path.basename(self._file(k)) for k in keys])
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json") and name not in live:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
@@ -131,9 +131,299 @@ if os.environ.get(_env_prefix + 'LIO_SAVE_FILE') is not None:
 else:
     KV['LIO_SAVE_FILE'] = '/etc/target/saveconfig.json'
 
+# Where LIO state is read from: 'saveconfig' (LIO_SAVE_FILE) or 'configfs'
+# (live, from LIO_CONFIGFS_ROOT)
+
+if os.environ.get(_env_prefix + 'LIO_STATE_SOURCE') is not None:
+    KV['LIO_STATE_SOURCE'] = os.environ.get(_env_prefix + 'LIO_STATE_SOURCE')
+else:
+    KV['LIO_STATE_SOURCE'] = 'saveconfig'
+
+if os.environ.get(_env_prefix + 'LIO_CONFIGFS_ROOT') is not None:
+    KV['LIO_CONFIGFS_ROOT'] = os.environ.get(_env_prefix + 'LIO_CONFIGFS_ROOT')
+else:
+    KV['LIO_CONFIGFS_ROOT'] = '/sys/kernel/config/target'
+
 # Path to the LIO targetcli executable
 
 if os.environ.get(_env_prefix + 'TARGETCLI_BIN') is not None:
     KV['TARGETCLI_BIN'] = os.environ.get(_env_prefix + 'TARGETCLI_BIN')
 else:
     KV['TARGETCLI_BIN'] = '/usr/bin/targetcli'
+
+# LIO backend used to read and change LIO state: targetcli, rtslib (needs
+# the rtslib-fb package, see requirements.txt) or fake
+
+if os.environ.get(_env_prefix + 'LIO_BACKEND') is not None:
+    KV['LIO_BACKEND'] = os.environ.get(_env_prefix + 'LIO_BACKEND')
+else:
+    KV['LIO_BACKEND'] = 'targetcli'
+
+# Maximum number of IMS manifests held in memory
+
+if os.environ.get(_env_prefix + 'MANIFEST_CACHE_SIZE') is not None:
+    KV['MANIFEST_CACHE_SIZE'] = int(os.environ.get(_env_prefix + 'MANIFEST_CACHE_SIZE'))
+else:
+    KV['MANIFEST_CACHE_SIZE'] = 4096
+
+# Directory where IMS manifests are persisted across restarts (empty to disable)
+
+if os.environ.get(_env_prefix + 'MANIFEST_CACHE_DIR') is not None:
+    KV['MANIFEST_CACHE_DIR'] = os.environ.get(_env_prefix + 'MANIFEST_CACHE_DIR')
+else:
+    KV['MANIFEST_CACHE_DIR'] = '/var/lib/sbps-marshal/manifests'
+
+# Number of threads (and pooled S3 connections) used to fetch IMS manifests
+
+if os.environ.get(_env_prefix + 'MANIFEST_WORKERS') is not None:
+    KV['MANIFEST_WORKERS'] = int(os.environ.get(_env_prefix + 'MANIFEST_WORKERS'))
+else:
+    KV['MANIFEST_WORKERS'] = 8
+
+# S3 inventory mode: 'full' lists the whole bucket, 'scoped' lists only the
+# PE/ prefix and HEADs the rootfs objects named by IMS manifests
+
+if os.environ.get(_env_prefix + 'S3_INVENTORY_MODE') is not None:
+    KV['S3_INVENTORY_MODE'] = os.environ.get(_env_prefix + 'S3_INVENTORY_MODE')
+else:
+    KV['S3_INVENTORY_MODE'] = 'full'
+
+# Seconds before SPIRE JWT-SVID expiry at which it is refreshed in the
+# background, and after which it is no longer used
+
+if os.environ.get(_env_prefix + 'SPIRE_REFRESH_MARGIN') is not None:
+    KV['SPIRE_REFRESH_MARGIN'] = int(os.environ.get(_env_prefix + 'SPIRE_REFRESH_MARGIN'))
+else:
+    KV['SPIRE_REFRESH_MARGIN'] = 60
+
+# Longest delay between scans when consecutive scans change nothing
+# (seconds). Nothing wakes the agent when IMS or S3 change, so raising it
+# above SCAN_FREQUENCY delays new images on idle nodes by up to this long.
+
+if os.environ.get(_env_prefix + 'SCAN_IDLE_FREQUENCY') is not None:
+    KV['SCAN_IDLE_FREQUENCY'] = int(os.environ.get(_env_prefix + 'SCAN_IDLE_FREQUENCY'))
+else:
+    KV['SCAN_IDLE_FREQUENCY'] = KV['SCAN_FREQUENCY']
+
+# Delay before retrying after a failed scan, backed off exponentially (seconds)
+
+if os.environ.get(_env_prefix + 'SCAN_RETRY_FREQUENCY') is not None:
+    KV['SCAN_RETRY_FREQUENCY'] = int(os.environ.get(_env_prefix + 'SCAN_RETRY_FREQUENCY'))
+else:
+    KV['SCAN_RETRY_FREQUENCY'] = 10
+
+# Spread the first scan after startup over this many seconds, by a hash of
+# the hostname, so nodes started together do not scan in lockstep
+
+if os.environ.get(_env_prefix + 'SCAN_START_SPREAD') is not None:
+    KV['SCAN_START_SPREAD'] = int(os.environ.get(_env_prefix + 'SCAN_START_SPREAD'))
+else:
+    KV['SCAN_START_SPREAD'] = 30
+
+# Force a full reconciliation at least this often even if scan inputs are
+# unchanged (seconds, 0 reconciles on every scan)
+
+if os.environ.get(_env_prefix + 'FULL_SCAN_INTERVAL') is not None:
+    KV['FULL_SCAN_INTERVAL'] = int(os.environ.get(_env_prefix + 'FULL_SCAN_INTERVAL'))
+else:
+    KV['FULL_SCAN_INTERVAL'] = 900
+
+# Number of times an IMS request is retried on a 5xx response
+
+if os.environ.get(_env_prefix + 'IMS_RETRIES') is not None:
+    KV['IMS_RETRIES'] = int(os.environ.get(_env_prefix + 'IMS_RETRIES'))
+else:
+    KV['IMS_RETRIES'] = 3
+
+# Query string added to IMS image requests when IMS_TAGGING is on, so the
+# server only returns images tagged for projection (empty to disable). The
+# first listing checks that the server applies it, see README.
+
+if os.environ.get(_env_prefix + 'IMS_QUERY') is not None:
+    KV['IMS_QUERY'] = os.environ.get(_env_prefix + 'IMS_QUERY')
+else:
+    KV['IMS_QUERY'] = 'metadata.sbps-project=true'
+
+# Number of images per IMS request, 0 requests the whole list at once
+
+if os.environ.get(_env_prefix + 'IMS_PAGE_SIZE') is not None:
+    KV['IMS_PAGE_SIZE'] = int(os.environ.get(_env_prefix + 'IMS_PAGE_SIZE'))
+else:
+    KV['IMS_PAGE_SIZE'] = 0
+
+# Follow the node's iscsi=sbps label with a Kubernetes API watch instead of
+# running kubectl every scan (kubectl is still used until the watch syncs)
+
+if os.environ.get(_env_prefix + 'K8S_LABEL_WATCH') is not None:
+    KV['K8S_LABEL_WATCH'] = os.environ.get(_env_prefix + 'K8S_LABEL_WATCH') == "true"
+else:
+    KV['K8S_LABEL_WATCH'] = True
+
+# kubeconfig used for node label lookups
+
+if os.environ.get(_env_prefix + 'KUBECONFIG') is not None:
+    KV['KUBECONFIG'] = os.environ.get(_env_prefix + 'KUBECONFIG')
+else:
+    KV['KUBECONFIG'] = '/etc/kubernetes/admin.conf'
+
+# How long a target.service 'active' result is trusted before re-checking (seconds)
+
+if os.environ.get(_env_prefix + 'TARGET_STATUS_TTL') is not None:
+    KV['TARGET_STATUS_TTL'] = int(os.environ.get(_env_prefix + 'TARGET_STATUS_TTL'))
+else:
+    KV['TARGET_STATUS_TTL'] = 300
+
+# Port for the Prometheus /metrics listener, 0 disables it
+
+if os.environ.get(_env_prefix + 'METRICS_PORT') is not None:
+    KV['METRICS_PORT'] = int(os.environ.get(_env_prefix + 'METRICS_PORT'))
+else:
+    KV['METRICS_PORT'] = 0
+
+# Address the metrics listener binds to
+
+if os.environ.get(_env_prefix + 'METRICS_ADDR') is not None:
+    KV['METRICS_ADDR'] = os.environ.get(_env_prefix + 'METRICS_ADDR')
+else:
+    KV['METRICS_ADDR'] = ''
+
+# Per-scan trace output: '' disables tracing, 'log' logs phase and slowest
+# call timings, anything else is a directory receiving one JSON file per scan
+
+if os.environ.get(_env_prefix + 'TRACE_OUTPUT') is not None:
+    KV['TRACE_OUTPUT'] = os.environ.get(_env_prefix + 'TRACE_OUTPUT')
+else:
+    KV['TRACE_OUTPUT'] = ''
+
+# Format of trace files: 'tree' (nested timing tree) or 'otlp' (OTLP/JSON)
+
+if os.environ.get(_env_prefix + 'TRACE_FORMAT') is not None:
+    KV['TRACE_FORMAT'] = os.environ.get(_env_prefix + 'TRACE_FORMAT')
+else:
+    KV['TRACE_FORMAT'] = 'tree'
+
+# Number of trace files kept in the trace directory
+
+if os.environ.get(_env_prefix + 'TRACE_KEEP') is not None:
+    KV['TRACE_KEEP'] = int(os.environ.get(_env_prefix + 'TRACE_KEEP'))
+else:
+    KV['TRACE_KEEP'] = 20
+
+# s3fs presence checks: concurrent stats, seconds before a stat is given up
+# on (its projection is then left alone), and seconds answers are cached
+
+if os.environ.get(_env_prefix + 'S3FS_PROBE_WORKERS') is not None:
+    KV['S3FS_PROBE_WORKERS'] = int(os.environ.get(_env_prefix + 'S3FS_PROBE_WORKERS'))
+else:
+    KV['S3FS_PROBE_WORKERS'] = 16
+
+if os.environ.get(_env_prefix + 'S3FS_PROBE_TIMEOUT') is not None:
+    KV['S3FS_PROBE_TIMEOUT'] = float(os.environ.get(_env_prefix + 'S3FS_PROBE_TIMEOUT'))
+else:
+    KV['S3FS_PROBE_TIMEOUT'] = 10
+
+if os.environ.get(_env_prefix + 'S3FS_PROBE_TTL') is not None:
+    KV['S3FS_PROBE_TTL'] = float(os.environ.get(_env_prefix + 'S3FS_PROBE_TTL'))
+else:
+    KV['S3FS_PROBE_TTL'] = 30
+
+# Warm the s3fs cache for newly projected images: read the squashfs metadata
+# and the leading bytes through the mount, on a few workers and capped at
+# bytes per second (0 for no cap)
+
+if os.environ.get(_env_prefix + 'PREFETCH') is not None:
+    KV['PREFETCH'] = os.environ.get(_env_prefix + 'PREFETCH') == "true"
+else:
+    KV['PREFETCH'] = False
+
+if os.environ.get(_env_prefix + 'PREFETCH_WORKERS') is not None:
+    KV['PREFETCH_WORKERS'] = int(os.environ.get(_env_prefix + 'PREFETCH_WORKERS'))
+else:
+    KV['PREFETCH_WORKERS'] = 2
+
+if os.environ.get(_env_prefix + 'PREFETCH_LEADING_BYTES') is not None:
+    KV['PREFETCH_LEADING_BYTES'] = int(os.environ.get(_env_prefix + 'PREFETCH_LEADING_BYTES'))
+else:
+    KV['PREFETCH_LEADING_BYTES'] = 64 << 20
+
+if os.environ.get(_env_prefix + 'PREFETCH_BANDWIDTH') is not None:
+    KV['PREFETCH_BANDWIDTH'] = int(os.environ.get(_env_prefix + 'PREFETCH_BANDWIDTH'))
+else:
+    KV['PREFETCH_BANDWIDTH'] = 50 << 20
+
+# How scan inputs (S3 inventory, LIO state, IMS inventory) are fetched:
+# 'sequential', or 'concurrent' with each allowed SCAN_INPUT_TIMEOUT seconds
+
+if os.environ.get(_env_prefix + 'SCAN_MODE') is not None:
+    KV['SCAN_MODE'] = os.environ.get(_env_prefix + 'SCAN_MODE')
+else:
+    KV['SCAN_MODE'] = 'sequential'
+
+if os.environ.get(_env_prefix + 'SCAN_INPUT_TIMEOUT') is not None:
+    KV['SCAN_INPUT_TIMEOUT'] = float(os.environ.get(_env_prefix + 'SCAN_INPUT_TIMEOUT'))
+else:
+    KV['SCAN_INPUT_TIMEOUT'] = 120
+
+# Share the resolved projection set between agents: 'none', 'publish' (write
+# a snapshot after each full scan) or 'consume' (reconcile LIO from the
+# snapshot only). SNAPSHOT_LOCATION is s3://bucket/key,
+# configmap://namespace/name or a file path. Consumers refuse snapshots
+# older than SNAPSHOT_MAX_AGE seconds, publishers rewrite unchanged ones
+# every third of that.
+
+if os.environ.get(_env_prefix + 'SNAPSHOT_MODE') is not None:
+    KV['SNAPSHOT_MODE'] = os.environ.get(_env_prefix + 'SNAPSHOT_MODE')
+else:
+    KV['SNAPSHOT_MODE'] = 'none'
+
+if os.environ.get(_env_prefix + 'SNAPSHOT_LOCATION') is not None:
+    KV['SNAPSHOT_LOCATION'] = os.environ.get(_env_prefix + 'SNAPSHOT_LOCATION')
+else:
+    KV['SNAPSHOT_LOCATION'] = ''
+
+if os.environ.get(_env_prefix + 'SNAPSHOT_MAX_AGE') is not None:
+    KV['SNAPSHOT_MAX_AGE'] = int(os.environ.get(_env_prefix + 'SNAPSHOT_MAX_AGE'))
+else:
+    KV['SNAPSHOT_MAX_AGE'] = 900
+
+# Client-side limits on S3 (RGW) and IMS requests: RATE requests per second
+# with bursts of BURST (0: no limit, BURST 0: same as RATE), and at most
+# REQUEST_BUDGET requests per scan (0: no limit). A scan that runs out of
+# budget fails without removing projections, manifests already fetched are
+# cached so the next scan gets further. Throttled S3 requests are tried up
+# to S3_MAX_ATTEMPTS times.
+
+if os.environ.get(_env_prefix + 'S3_RATE') is not None:
+    KV['S3_RATE'] = float(os.environ.get(_env_prefix + 'S3_RATE'))
+else:
+    KV['S3_RATE'] = 0
+
+if os.environ.get(_env_prefix + 'S3_BURST') is not None:
+    KV['S3_BURST'] = float(os.environ.get(_env_prefix + 'S3_BURST'))
+else:
+    KV['S3_BURST'] = 0
+
+if os.environ.get(_env_prefix + 'S3_REQUEST_BUDGET') is not None:
+    KV['S3_REQUEST_BUDGET'] = int(os.environ.get(_env_prefix + 'S3_REQUEST_BUDGET'))
+else:
+    KV['S3_REQUEST_BUDGET'] = 0
+
+if os.environ.get(_env_prefix + 'S3_MAX_ATTEMPTS') is not None:
+    KV['S3_MAX_ATTEMPTS'] = int(os.environ.get(_env_prefix + 'S3_MAX_ATTEMPTS'))
+else:
+    KV['S3_MAX_ATTEMPTS'] = 5
+
+if os.environ.get(_env_prefix + 'IMS_RATE') is not None:
+    KV['IMS_RATE'] = float(os.environ.get(_env_prefix + 'IMS_RATE'))
+else:
+    KV['IMS_RATE'] = 0
+
+if os.environ.get(_env_prefix + 'IMS_BURST') is not None:
+    KV['IMS_BURST'] = float(os.environ.get(_env_prefix + 'IMS_BURST'))
+else:
+    KV['IMS_BURST'] = 0
+
+if os.environ.get(_env_prefix + 'IMS_REQUEST_BUDGET') is not None:
+    KV['IMS_REQUEST_BUDGET'] = int(os.environ.get(_env_prefix + 'IMS_REQUEST_BUDGET'))
+else:
+    KV['IMS_REQUEST_BUDGET'] = 0
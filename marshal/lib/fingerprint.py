@@ -0,0 +1,90 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module to fingerprint scan inputs so unchanged scans can be skipped"""
+
+import collections
+import hashlib
+import json
+import time
+
+
+def digest(*parts) -> str:
+
+    """Return a SHA224 hex digest over JSON serializable parts"""
+
+    return hashlib.sha224(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def s3_index_digest(s3_index: dict) -> str:
+
+    """Digest an S3 inventory (key to s3.S3Object), listing order is stable"""
+
+    h = hashlib.sha224()
+    for o in s3_index.values():
+        h.update(f"{o.key}|{o.size}|{o.etag}\n".encode('utf-8'))
+    return h.hexdigest()
+
+def ims_images_digest(ims_images: list) -> str:
+
+    """Digest an IMS image list"""
+
+    return digest(ims_images)
+
+class ScanFingerprints:
+
+    """Remember the input fingerprint of the last complete scan.
+
+    A scan whose fingerprint matches can skip reconciliation, except when
+    the last full scan is older than full_scan_interval seconds (0 disables
+    skipping altogether)."""
+
+    def __init__(self, full_scan_interval: int):
+        self.full_scan_interval = full_scan_interval
+        self.last = None
+        self.last_full_scan = 0
+        self.stats = collections.Counter(skipped=0, full=0)
+
+    def unchanged(self, fingerprint: str) -> bool:
+
+        """Return True, and count a skipped scan, if reconciliation can be
+        skipped for fingerprint, otherwise count a full scan"""
+
+        if self.full_scan_interval > 0 and fingerprint == self.last and \
+            time.monotonic() - self.last_full_scan < self.full_scan_interval:
+            self.stats["skipped"] += 1
+            return True
+
+        self.stats["full"] += 1
+        return False
+
+    def record(self, fingerprint: str):
+
+        """Record the fingerprint of a full scan that left nothing pending"""
+
+        self.last = fingerprint
+        self.last_full_scan = time.monotonic()
+
+    def invalidate(self):
+        self.last = None
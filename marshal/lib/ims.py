@@ -24,8 +24,17 @@
 
 """Module to support IMS image querying"""
 
+import codecs
+import collections
 import json
+import logging
 import requests
+import requests.adapters
+import urllib.parse
+import urllib3.util
+import lib.metrics as metrics
+import lib.ratelimit as ratelimit
+import lib.trace as trace
 
 from _collections_abc import Iterable
 
@@ -81,18 +90,271 @@ from _collections_abc import Iterable
     ]
     } """
 
-def images(ims_url: str, access_token: str, timeout: int=10) -> Iterable:
+def iter_json_array(chunks: Iterable) -> Iterable:
 
-    """Query IMS for a list of images in JSON format"""
+    """Incrementally decode a top level JSON array from byte chunks, yielding
+    each element as soon as it is complete. Malformed arrays (e.g., empty
+    elements, a trailing comma) raise ValueError, so a damaged response is
+    never taken for a shorter list."""
 
-    headers = {"Authorization": "Bearer " + access_token}
-    response = requests.get(ims_url, headers=headers, verify=False, timeout=timeout)
-    response.raise_for_status()
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ""
+
+    # What comes next: the opening bracket, the first element (or the
+    # closing bracket), an element after a comma, or a separator
+
+    expect = "array"
+
+    for chunk in chunks:
+        buf += utf8.decode(chunk)
+        pos = 0
+
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+
+            c = buf[pos]
+
+            if expect == "array":
+                if c != '[':
+                    raise ValueError("Expected a JSON array")
+                expect = "first"
+                pos += 1
+                continue
+
+            if expect == "separator":
+                if c == ',':
+                    expect = "element"
+                    pos += 1
+                    continue
+                if c == ']':
+                    return
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {c!r}")
+
+            if c == ']' and expect == "first":
+                return
+            if c in ',]':
+                raise ValueError("Empty element in JSON array")
+
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # element not complete yet
+
+            expect = "separator"
+            yield obj
+
+        buf = buf[pos:]
+
+    raise ValueError("Truncated JSON array")
+
+def _has_link_path(i) -> bool:
+    try:
+        _ = i["link"]["path"]
+    except (KeyError, TypeError):
+        return False
+    return True
+
+def _identity(i: dict) -> tuple:
+    return i.get("id"), i["link"]["path"]
+
+def is_marked_for_projection(ims_image: dict) -> bool:
+
+    """Check the IMS sbps-project tag. Images without metadata are assumed
+    to come from a version of IMS that doesn't support image tagging"""
+
+    if 'metadata' not in ims_image.keys():
+        return True
+
+    if 'sbps-project' not in ims_image['metadata'].keys():
+        return False
+
+    return ims_image['metadata']['sbps-project'] == "true"
+
+class ImsClient:
+
+    """IMS image client keeping a pooled session across scans.
+
+    Requests are conditional (If-None-Match / If-Modified-Since), so an
+    unchanged inventory comes back as a 304 and is served from the previous
+    response. Bodies are parsed incrementally, and 5xx and 429 responses
+    are retried with exponential backoff, or after Retry-After.
+
+    Each request (not each retry) takes a slot from limiter, if any. A
+    request still throttled after its retries pauses the limiter.
+
+    params are added to every query (e.g., a server side sbps-project
+    filter) and page_size > 0 requests the list in limit/offset pages.
+    Servers that ignore either are handled: callers must still filter, a
+    page larger than requested ends paging, and a page repeating the
+    previous one falls back to a single full request. Paged queries are
+    not conditional.
+
+    With matches, the predicate params are meant to apply, the first
+    listing checks the server: params are only used from then on if the
+    server returned exactly the images matches accepts."""
+
+    def __init__(self, ims_url: str, timeout: int = 10, retries: int = 3, backoff_factor: float = 0.5,
+                 params: dict = None, page_size: int = 0, limiter: ratelimit.Limiter = None,
+                 matches=None):
+        self.ims_url = ims_url
+        self.timeout = timeout
+        self.params = dict(params or {})
+        self.matches = matches
+        self.filtering = None if self.params and matches is not None else bool(self.params)
+        self.page_size = page_size
+        self.limiter = limiter
+        self.backoff_factor = backoff_factor
+
+        retry = urllib3.util.Retry(total=retries,
+                                   backoff_factor=backoff_factor,
+                                   status_forcelist=(429, 500, 502, 503, 504),
+                                   allowed_methods=frozenset(['GET']),
+                                   respect_retry_after_header=True,
+                                   raise_on_status=False)
+
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry))
+        self.session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retry))
+
+        self.etag = None
+        self.last_modified = None
+        self.cached = None
+        self.stats = collections.Counter(requests=0, not_modified=0)
+
+    def _get(self, headers: dict, params: dict) -> requests.Response:
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self.stats["requests"] += 1
+        with metrics.IMS_REQUEST_SECONDS.time(), \
+             trace.span("ims.images", url=self.ims_url, params=str(params or {})) as s:
+            response = self.session.get(self.ims_url, headers=headers, params=params,
+                                        timeout=self.timeout, stream=True)
+            if s is not None:
+                s.attributes["status"] = response.status_code
+        self._throttled(response)
+        return response
+
+    def _throttled(self, response: requests.Response):
+
+        """Count the throttled attempts behind a response, and pause the
+        limiter when the last one was throttled too"""
+
+        history = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+        throttled = len([h for h in history if h.status in (429, 503)])
+        if throttled:
+            metrics.THROTTLED_REQUESTS.inc(throttled, endpoint="ims", reason="throttled")
+
+        if response.status_code in (429, 503) and self.limiter is not None:
+            self.limiter.backoff(ratelimit.retry_after(response.headers.get("Retry-After"),
+                                                       self.backoff_factor * 2 ** max(1, throttled)))
+
+    def images(self, access_token: str) -> Iterable:
+
+        """Query IMS for a list of images, yielding them as they arrive"""
+
+        headers = {"Authorization": "Bearer " + access_token}
+
+        if self.filtering is None:
+            yield from self._check_filter(headers)
+            return
+
+        if self.page_size > 0:
+            yield from self._paged_images(headers)
+            return
+
+        if self.cached is not None:
+            if self.etag is not None:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                headers["If-Modified-Since"] = self.last_modified
+
+        with self._get(headers, self._query()) as response:
+
+            if response.status_code == 304 and self.cached is not None:
+                self.stats["not_modified"] += 1
+                logging.debug(f"IMS image list not modified since {self.etag or self.last_modified}")
+                yield from self.cached
+                return
+
+            response.raise_for_status()
+
+            images = []
+            for i in iter_json_array(response.iter_content(chunk_size=65536)):
+                if _has_link_path(i):
+                    images.append(i)
+                    yield i
+
+            self.cached = images
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+
+    def _paged_images(self, headers: dict) -> Iterable:
+
+        offset = 0
+        previous_first = None
+
+        while True:
+            params = dict(self._query(), limit=self.page_size, offset=offset)
+
+            with self._get(headers, params) as response:
+                response.raise_for_status()
+                page = list(iter_json_array(response.iter_content(chunk_size=65536)))
+
+            if page and previous_first is not None and page[0] == previous_first:
+
+                # The server honours limit but not offset, fetch the whole
+                # list once and continue from where paging left off
+
+                logging.debug(f"IMS ignored the page offset, requesting the full image list")
+                page = self._list(headers, self._query())[offset:]
+                yield from [ i for i in page if _has_link_path(i) ]
+                return
+
+            for i in page:
+                if _has_link_path(i):
+                    yield i
+
+            if len(page) != self.page_size:
+                return  # last page, or pagination not supported at all
+
+            previous_first = page[0]
+            offset += len(page)
+
+    def _query(self) -> dict:
+        return self.params if self.filtering else {}
+
+    def _list(self, headers: dict, params: dict) -> list:
+        with self._get(headers, params) as response:
+            response.raise_for_status()
+            return list(iter_json_array(response.iter_content(chunk_size=65536)))
+
+    def _check_filter(self, headers: dict) -> Iterable:
+
+        """List the images with and without params and keep using params only
+        if the server returned exactly the images matches accepts, e.g., not
+        an older IMS ignoring the query. Yields the full list."""
+
+        full = [ i for i in self._list(headers, {}) if _has_link_path(i) ]
+        expected = set([_identity(i) for i in full if self.matches(i)])
+        query = urllib.parse.urlencode(self.params)
 
-    for i in json.loads(response.content):
         try:
-            _ = i["link"]["path"]
-        except (KeyError, TypeError):
-            continue
+            filtered = [ _identity(i) for i in self._list(headers, self.params) if _has_link_path(i) ]
+        except requests.HTTPError as err:
+            if err.response is None or err.response.status_code not in (400, 422):
+                raise
+            logging.warning(f"IMS rejected the image query {query}, listing all images instead, received -> {str(err)}")
+            self.filtering = False
         else:
-            yield i
\ No newline at end of file
+            self.filtering = len(filtered) == len(expected) and set(filtered) == expected
+            if self.filtering:
+                logging.info(f"IMS applies the image query {query}, it returns {len(filtered)} of {len(full)} images")
+            else:
+                logging.warning(f"IMS returned {len(filtered)} images for the image query {query} instead of {len(expected)}, listing all images instead")
+
+        yield from full
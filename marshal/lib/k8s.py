@@ -0,0 +1,202 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module to follow this node's Kubernetes labels through the API server"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import requests
+import yaml
+
+
+# Certificates and keys embedded in kubeconfigs are written to a single
+# private directory per process, removed when the process exits
+
+_material_lock = threading.Lock()
+_material_dir = None
+
+def _material_file(key: str, data: bytes) -> str:
+
+    """Return a private file holding data, written once per process"""
+
+    global _material_dir
+    with _material_lock:
+        if _material_dir is None:
+            _material_dir = tempfile.TemporaryDirectory(prefix="sbps-marshal-k8s-")
+        file_path = os.path.join(_material_dir.name, key + "-" + hashlib.sha224(data).hexdigest()[:16])
+        if not os.path.exists(file_path):
+            with open(os.open(file_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(data)
+        return file_path
+
+class KubeApi:
+
+    """Minimal Kubernetes API client built from a kubeconfig file"""
+
+    def __init__(self, server: str, verify=True, cert: tuple = None, token: str = None):
+        self.server = server.rstrip('/')
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.cert = cert
+        if token is not None:
+            self.session.headers["Authorization"] = "Bearer " + token
+
+    @classmethod
+    def from_kubeconfig(cls, path: str) -> "KubeApi":
+
+        """Use the current context of a kubeconfig, e.g. /etc/kubernetes/admin.conf.
+        Embedded certificate data is written to the process' private temporary
+        directory, and removed at exit."""
+
+        with open(path, 'r') as f:
+            kubeconfig = yaml.safe_load(f)
+
+        def named(section, name):
+            for entry in kubeconfig.get(section, []):
+                if entry["name"] == name:
+                    return entry
+            raise ValueError(f"No {section} entry named {name} in {path}")
+
+        context = named("contexts", kubeconfig["current-context"])["context"]
+        cluster = named("clusters", context["cluster"])["cluster"]
+        user = named("users", context["user"])["user"]
+
+        def material(section, key):
+            if key + "-data" in section:
+                return _material_file(key, base64.b64decode(section[key + "-data"]))
+            return section.get(key)
+
+        verify = material(cluster, "certificate-authority") or True
+        if cluster.get("insecure-skip-tls-verify"):
+            verify = False
+
+        cert = None
+        client_cert = material(user, "client-certificate")
+        client_key = material(user, "client-key")
+        if client_cert and client_key:
+            cert = (client_cert, client_key)
+
+        return cls(cluster["server"], verify, cert, user.get("token"))
+
+    def get(self, path: str, params: dict, timeout: float, stream: bool = False) -> requests.Response:
+        response = self.session.get(self.server + path, params=params, timeout=timeout, stream=stream)
+        response.raise_for_status()
+        return response
+
+    def send(self, method: str, path: str, body: dict, timeout: float,
+             content_type: str = "application/json") -> requests.Response:
+        response = self.session.request(method, self.server + path, data=json.dumps(body), timeout=timeout,
+                                        headers={ "Content-Type" : content_type })
+        response.raise_for_status()
+        return response
+
+class NodeLabelWatcher:
+
+    """Track whether this node carries label key=value with a list-then-watch
+    on the node selected by kubernetes.io/hostname. The watch is restarted
+    (with a fresh list) on errors, expiry, or every resync seconds.
+
+    labelled is None until the first list succeeds, and again while the
+    API server can't be reached, so callers can fall back to polling."""
+
+    def __init__(self, api: KubeApi, hostname: str, key: str = "iscsi", value: str = "sbps",
+                 on_change=None, resync: int = 300, timeout: int = 10):
+        self.api = api
+        self.key = key
+        self.value = value
+        self.on_change = on_change
+        self.resync = resync
+        self.timeout = timeout
+        self.params = { "labelSelector" : f"kubernetes.io/hostname={hostname}" }
+        self.nodes = dict()
+        self.labelled = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="node-label-watch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _update(self):
+        labelled = any([labels.get(self.key) == self.value for labels in self.nodes.values()])
+        previous, self.labelled = self.labelled, labelled
+        if previous is not None and previous != labelled:
+            logging.info(f"Node label {self.key}={self.value} {'added' if labelled else 'removed'}")
+            if self.on_change is not None:
+                self.on_change(labelled)
+
+    def _list(self) -> str:
+        nodes = self.api.get("/api/v1/nodes", self.params, self.timeout).json()
+        self.nodes = { n["metadata"]["name"] : n["metadata"].get("labels", {}) for n in nodes["items"] }
+        self._update()
+        return nodes["metadata"]["resourceVersion"]
+
+    def _watch(self, resource_version: str):
+        params = dict(self.params, watch="true", resourceVersion=resource_version,
+                      allowWatchBookmarks="true", timeoutSeconds=self.resync)
+
+        with self.api.get("/api/v1/nodes", params, self.resync + self.timeout, stream=True) as response:
+            for line in response.iter_lines():
+                if self.stopped.is_set():
+                    return
+                if not line:
+                    continue
+
+                event = json.loads(line)
+                metadata = event["object"].get("metadata", {})
+
+                if event["type"] == "ERROR":
+                    logging.debug(f"Node watch ended with {event['object'].get('message')}, relisting")
+                    return
+                if event["type"] == "BOOKMARK":
+                    continue
+                if event["type"] == "DELETED":
+                    self.nodes.pop(metadata["name"], None)
+                else:
+                    self.nodes[metadata["name"]] = metadata.get("labels", {})
+
+                self._update()
+
+    def _run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                self._watch(self._list())
+                failures = 0
+                self.stopped.wait(1)
+            except Exception as err:
+                failures += 1
+                self.labelled = None
+                delay = min(60, 2 ** failures)
+                logging.warning(f"Node label watch failed, retrying in {delay}s, received -> {str(err)}")
+                self.stopped.wait(delay)
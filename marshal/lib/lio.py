@@ -24,12 +24,19 @@
 
 """Module with LIO helpers"""
 
+import abc
+import collections
+import copy
 import hashlib
 import subprocess
 import logging
 import json
 import os
+import re
+import time
 import lib.config as config
+import lib.metrics as metrics
+import lib.trace as trace
 
 from _collections_abc import Iterable
 
@@ -100,68 +107,527 @@ def get_lio_target_iqn(target_config: dict) -> str:
     except IndexError as err:
         return None
 
-# targetcli: create name file_or_dev [size] [write_back] [sparse] [wwn]
+class Transaction:
 
-def create_fileio_backstore(vendor: str, file_path: str, wwn: str):
-    
-    """Try to create a fileio backstore using targetcli"""
+    """Collect the LIO operations of a scan and apply them with a backend in
+    one go, saving the configuration once at the end"""
 
-    ctx = f"/backstores/fileio create {vendor} {file_path} 0 false true {wwn}"
-    subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
+    def __init__(self, backend: "LioBackend" = None):
+        self.backend = backend if backend is not None else TargetcliBackend()
+        self.operations = []
 
-def create_lun(vendor: str, iqn: str):
+    def __len__(self) -> int:
+        return len(self.operations)
 
-    """Try to create a LUN using targetcli, backstore must already exist"""
-    
-    ctx = f"/iscsi/{iqn}/tpg1/luns create /backstores/fileio/{vendor}"
-    subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
+    def _queue(self, op: str, name: str, expect: dict = None, **args):
+        self.operations.append({
+            "op" : op,
+            "name" : name,
+            "args" : args,
+            "expect" : expect or {},
+            "error" : None
+        })
 
-# targetcli: delete name [save] 
+    def create_fileio_backstore(self, vendor: str, file_path: str, wwn: str, size: int = None):
 
-def delete_fileio_backstore(product: str):
-    
-    """Try to delete a backstore using targetcli"""
-    
-    ctx = f"/backstores/fileio delete {product}"
-    subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
+        """Queue creation of a fileio backstore. size is the size the
+        backstore is expected to get from its file, when known."""
 
-def save_config():
-    
-    """Try to save the targetcli configuration"""
+        expect = { "dev" : file_path, "wwn" : wwn }
+        if size is not None:
+            expect["size"] = size
 
-    ctx = f"saveconfig"
-    subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
+        self._queue("create_fileio_backstore", vendor, expect,
+                    vendor=vendor, file_path=file_path, wwn=wwn)
 
-def fileio_size(product: str, size: int):
-   
-    if product["size"] == size:
-        found_backstore = True
+    def create_lun(self, vendor: str, iqn: str):
+
+        """Queue creation of a LUN, backstore must exist by the time it runs"""
+
+        self._queue("create_lun", vendor, vendor=vendor, iqn=iqn)
+
+    def delete_fileio_backstore(self, product: str):
+
+        """Queue deletion of a backstore, repeated deletes are collapsed"""
+
+        for queued in reversed(self.operations):
+            if queued["name"] != product:
+                continue
+            if queued["op"] == "delete_fileio_backstore":
+                return
+            break
+
+        self._queue("delete_fileio_backstore", product, product=product)
+
+    def commit(self) -> list:
+
+        """Apply the queued operations and return them with 'error' set for
+        every operation that did not take effect"""
+
+        operations, self.operations = self.operations, []
+
+        if operations:
+            self.backend.apply(operations)
+
+        for o in operations:
+            metrics.LIO_OPERATIONS.inc(op=o["op"], result="ok" if o["error"] is None else "error")
+
+        return operations
+
+def _verify_operations(operations: list, target_config: dict, returncode: int = 0):
+
+    """Set 'error' on operations whose effect is missing from target_config.
+
+    Only the last backstore (or LUN) operation for a given name is checked,
+    earlier ones (e.g., the delete half of a resize) share its outcome. A
+    created backstore must have the attributes it was created with (dev,
+    wwn, size), so a resize whose delete failed, or a create that found the
+    name taken, is not mistaken for success. A LUN fails along with the
+    backstore it was created for."""
+
+    backstores = { b["name"] : b for b in extract_fileio_backstores(target_config) }
+    luns = set([l["storage_object"] for l in extract_fileio_target_luns(target_config)])
+
+    last = dict()
+    for o in operations:
+        last[(o["op"] == "create_lun", o["name"])] = o
+
+    def outcome(final: dict) -> str:
+        b = backstores.get(final["name"])
+
+        if final["op"] == "create_fileio_backstore":
+            if b is None:
+                return f"{final['op']} {final['name']} not applied by targetcli (exit {returncode})"
+            for attribute, value in final.get("expect", {}).items():
+                if b.get(attribute) != value:
+                    return (f"{final['op']} {final['name']} not applied by targetcli (exit {returncode}), "
+                            f"{attribute} is {b.get(attribute)} instead of {value}")
+            return None
+
+        if final["op"] == "create_lun":
+            backstore = last.get((False, final["name"]))
+            if backstore is not None and backstore["op"] == "create_fileio_backstore" and outcome(backstore) is not None:
+                return f"{final['op']} {final['name']} not applied, its backstore was not created as requested"
+            if b is None or f"/backstores/fileio/{final['name']}" not in luns:
+                return f"{final['op']} {final['name']} not applied by targetcli (exit {returncode})"
+            return None
+
+        if b is not None:
+            return f"{final['op']} {final['name']} not applied by targetcli (exit {returncode})"
+        return None
+
+    for o in operations:
+        error = outcome(last[(o["op"] == "create_lun", o["name"])])
+        if error is not None:
+            o["error"] = error
+
+## --------------------------------------------------------------
+## Live LIO state from configfs
+## --------------------------------------------------------------
+
+# configfs HBA directory prefixes to targetcli backstore plugin names
+
+CONFIGFS_PLUGINS = { "fileio" : "fileio", "iblock" : "block", "rd_mcp" : "ramdisk", "pscsi" : "pscsi" }
+
+_FILEIO_INFO = re.compile(r"File:\s*(?P<dev>\S+)\s+Size:\s*(?P<size>\d+)\s+Mode:\s*(?P<mode>\S+)")
+
+def _read_attribute(path: str) -> str:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def read_configfs(root: str = "/sys/kernel/config/target") -> dict:
+
+    """Return live LIO state, read from configfs, in the targetcli
+    saveconfig.json format. Only what the agent uses is filled in: fileio
+    storage objects (name, dev, size, wwn, write_back) and iSCSI targets
+    with their TPGs and LUNs. root can point at a copy of the tree."""
+
+    storage_objects = []
+    core = os.path.join(root, "core")
+
+    for hba in sorted(os.listdir(core)) if os.path.isdir(core) else []:
+        if not hba.startswith("fileio_"):
+            continue
+        hba_path = os.path.join(core, hba)
+        for name in sorted(os.listdir(hba_path)):
+            so_path = os.path.join(hba_path, name)
+            if not os.path.isdir(so_path):
+                continue
+            info = _FILEIO_INFO.search(_read_attribute(os.path.join(so_path, "info")))
+            serial = _read_attribute(os.path.join(so_path, "wwn", "vpd_unit_serial"))
+            storage_objects.append({
+                "plugin" : "fileio",
+                "name" : name,
+                "dev" : info.group("dev") if info else _read_attribute(os.path.join(so_path, "udev_path")),
+                "size" : int(info.group("size")) if info else 0,
+                "wwn" : serial.split(":", 1)[-1].strip(),
+                "write_back" : bool(info) and info.group("mode") != "O_DSYNC"
+            })
+
+    targets = []
+    iscsi = os.path.join(root, "iscsi")
+
+    for iqn in sorted(os.listdir(iscsi)) if os.path.isdir(iscsi) else []:
+        target_path = os.path.join(iscsi, iqn)
+        if not iqn.startswith("iqn.") or not os.path.isdir(target_path):
+            continue
+        tpgs = []
+        for tpgt in sorted(os.listdir(target_path)):
+            if not tpgt.startswith("tpgt_"):
+                continue
+            tpg_path = os.path.join(target_path, tpgt)
+            luns = []
+            luns_path = os.path.join(tpg_path, "lun")
+            for lun in os.listdir(luns_path) if os.path.isdir(luns_path) else []:
+                lun_path = os.path.join(luns_path, lun)
+                for entry in os.listdir(lun_path):
+                    link = os.path.join(lun_path, entry)
+                    if not os.path.islink(link):
+                        continue
+                    hba, name = os.readlink(link).rstrip("/").split("/")[-2:]
+                    plugin = CONFIGFS_PLUGINS.get(hba.rsplit("_", 1)[0], hba.rsplit("_", 1)[0])
+                    luns.append({ "index" : int(lun.split("_", 1)[1]),
+                                  "storage_object" : f"/backstores/{plugin}/{name}" })
+            tpgs.append({
+                "tag" : int(tpgt.split("_", 1)[1]),
+                "enable" : _read_attribute(os.path.join(tpg_path, "enable")) == "1",
+                "luns" : sorted(luns, key=lambda l: l["index"])
+            })
+        targets.append({ "fabric" : "iscsi", "wwn" : iqn, "tpgs" : tpgs })
+
+    return { "storage_objects" : storage_objects, "targets" : targets }
+
+## --------------------------------------------------------------
+## LIO backends
+## --------------------------------------------------------------
+
+class LioBackend(abc.ABC):
+
+    """Interface used by the agent to read and change LIO state"""
+
+    name = None
+
+    @property
+    def source(self) -> str:
+
+        """Where load_config() reads LIO state from, for messages"""
+
+        return f"the {self.name} LIO backend"
+
+    @abc.abstractmethod
+    def load_config(self) -> dict:
+
+        """Return LIO state in the targetcli saveconfig.json format"""
+
+    def state_token(self) -> str:
+
+        """Return a value that changes whenever LIO state changes"""
+
+        return hashlib.sha224(json.dumps(self.load_config(), sort_keys=True).encode('utf-8')).hexdigest()
+
+    @abc.abstractmethod
+    def apply(self, operations: list):
+
+        """Apply transaction operations in order, set 'error' on failures and
+        persist the configuration"""
+
+    @abc.abstractmethod
+    def disable_target(self, iqn: str):
+        pass
+
+    @abc.abstractmethod
+    def enable_target(self, iqn: str):
+        pass
+
+    def transaction(self) -> Transaction:
+        return Transaction(self)
+
+class TargetcliBackend(LioBackend):
+
+    """Drive LIO with the targetcli executable.
+
+    targetcli reads commands from stdin when it is not attached to a tty, so
+    a transaction is written as a single batch script. Because targetcli
+    keeps going after a failed command, the outcome of each operation is
+    verified against the configuration saved at the end of the batch.
+
+    State is read from LIO_SAVE_FILE, or live from configfs when
+    LIO_STATE_SOURCE is 'configfs'."""
+
+    name = "targetcli"
+
+    def __init__(self):
+        self.saved = None
+        self.saved_identity = None
+        self.configfs = config.KV['LIO_STATE_SOURCE'] == "configfs"
+
+    @property
+    def source(self) -> str:
+        return config.KV['LIO_CONFIGFS_ROOT'] if self.configfs else config.KV['LIO_SAVE_FILE']
+
+    def state_token(self) -> str:
+        if self.configfs:
+            return super().state_token()
+        st = os.stat(config.KV['LIO_SAVE_FILE'])
+        return f"{st.st_dev}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+
+    def load_config(self) -> dict:
+
+        """Read live state from configfs, or parse LIO_SAVE_FILE, reusing
+        the last result while the file is unchanged. The returned dict must
+        not be modified."""
+
+        if self.configfs:
+            return read_configfs(config.KV['LIO_CONFIGFS_ROOT'])
+
+        identity = self.state_token()
+        if identity != self.saved_identity:
+            with open(config.KV['LIO_SAVE_FILE'], 'r') as f:
+                self.saved = json.load(f)
+            self.saved_identity = identity
+
+        return self.saved
+
+    # targetcli: create name file_or_dev [size] [write_back] [sparse] [wwn]
+    #           delete name
+
+    @staticmethod
+    def _command(o: dict) -> str:
+        a = o["args"]
+        if o["op"] == "create_fileio_backstore":
+            return f"/backstores/fileio create {a['vendor']} {a['file_path']} 0 false true {a['wwn']}"
+        if o["op"] == "create_lun":
+            return f"/iscsi/{a['iqn']}/tpg1/luns create /backstores/fileio/{a['vendor']}"
+        return f"/backstores/fileio delete {a['product']}"
+
+    def apply(self, operations: list):
+
+        script = "\n".join([self._command(o) for o in operations] + ["saveconfig", "exit"]) + "\n"
 
-    else:
-        found_backstore = False
         try:
-            delete_fileio_backstore(product["name"])
+            with trace.span("lio.targetcli_batch", operations=len(operations)):
+                p = subprocess.run([config.KV['TARGETCLI_BIN']], input=script,
+                                   capture_output=True, text=True, check=False)
         except Exception as err:
-            logging.error(
-                f"Unable to remove LIO fileio backstore for {product["dev"]}, received -> {str(err)}")
-        
+            for o in operations:
+                o["error"] = str(err)
+            return
+
+        logging.debug(f"targetcli batch of {len(operations)} operations exited {p.returncode}, "
+                      f"stdout -> {p.stdout.strip()}, stderr -> {p.stderr.strip()}")
+
+        try:
+            saved = self.load_config()
+        except Exception as err:
+            for o in operations:
+                o["error"] = f"unable to verify targetcli batch, received -> {str(err)}"
+            return
+
+        _verify_operations(operations, saved, p.returncode)
+
+    def disable_target(self, iqn: str):
+        disable_target(iqn)
+
+    def enable_target(self, iqn: str):
+        enable_target(iqn)
+
+class RtslibBackend(LioBackend):
+
+    """Drive LIO in-process through rtslib-fb (configfs), avoiding a targetcli
+    process per change"""
+
+    name = "rtslib"
+
+    def __init__(self):
         try:
-            save_config()
+            import rtslib_fb
+        except ImportError as err:
+            raise ImportError(f"The {self.name} LIO backend needs the rtslib-fb package (see requirements.txt), received -> {str(err)}") from err
+        self.rtslib = rtslib_fb
+
+    def load_config(self) -> dict:
+        return self.rtslib.RTSRoot().dump()
+
+    def _tpg(self, iqn: str):
+        target = self.rtslib.Target(self.rtslib.FabricModule("iscsi"), iqn, mode="lookup")
+        return self.rtslib.TPG(target, 1, mode="lookup")
+
+    def _create_fileio_backstore(self, vendor: str, file_path: str, wwn: str):
+        self.rtslib.FileIOStorageObject(vendor, dev=file_path, write_back=False, wwn=wwn)
+
+    def _create_lun(self, vendor: str, iqn: str):
+        self.rtslib.LUN(self._tpg(iqn), storage_object=self.rtslib.FileIOStorageObject(vendor))
+
+    def _delete_fileio_backstore(self, product: str):
+        self.rtslib.FileIOStorageObject(product).delete()
+
+    @trace.traced("lio.rtslib_apply")
+    def apply(self, operations: list):
+
+        for o in operations:
+            try:
+                getattr(self, "_" + o["op"])(**o["args"])
+            except Exception as err:
+                o["error"] = str(err)
+
+        try:
+            self.rtslib.RTSRoot().save_to_file(config.KV['LIO_SAVE_FILE'])
         except Exception as err:
             logging.error(f"Unable to save LIO configuration, received -> {str(err)}")
 
-    return found_backstore
+    def disable_target(self, iqn: str):
+        self._tpg(iqn).enable = False
+
+    def enable_target(self, iqn: str):
+        self._tpg(iqn).enable = True
+
+class FakeBackend(LioBackend):
+
+    """In-memory LIO stand-in for tests and benchmarks, keeps state in the
+    saveconfig.json format and counts calls. Backstores are sized from
+    sizes (dev to size, 0 when missing) when given, instead of the file."""
+
+    name = "fake"
 
+    def __init__(self, iqn: str = None, target_config: dict = None, sizes: dict = None):
+        if target_config is None:
+            target_config = {
+                "storage_objects" : [],
+                "targets" : []
+            }
+            if iqn is not None:
+                target_config["targets"].append({
+                    "fabric" : "iscsi",
+                    "wwn" : iqn,
+                    "enable" : True,
+                    "tpgs" : [ { "tag" : 1, "enable" : True, "luns" : [] } ]
+                })
+        self.target_config = target_config
+        self.sizes = sizes
+        self.calls = collections.Counter()
+        self.version = 0
+
+        # Indexes so large (benchmark) configurations stay cheap to change
+
+        self.objects = { o["name"] : o for o in target_config["storage_objects"] if o["plugin"] == "fileio" }
+        self.lun_objects = collections.defaultdict(set)
+        self.next_lun = collections.Counter()
+        for target in target_config["targets"]:
+            for tpg in target["tpgs"]:
+                self.lun_objects[target["wwn"]].update([l["storage_object"] for l in tpg["luns"]])
+                self.next_lun[target["wwn"]] = max([l["index"] + 1 for l in tpg["luns"]], default=0)
+
+    def state_token(self) -> str:
+        return str(self.version)
+
+    def load_config(self) -> dict:
+        self.calls["load_config"] += 1
+        return copy.deepcopy(self.target_config)
+
+    def _storage_object(self, name: str) -> dict:
+        return self.objects.get(name)
+
+    def _tpg(self, iqn: str) -> dict:
+        for target in self.target_config["targets"]:
+            if target["wwn"] == iqn:
+                return target["tpgs"][0]
+        raise ValueError(f"No such target {iqn}")
+
+    def _create_fileio_backstore(self, vendor: str, file_path: str, wwn: str):
+        if self._storage_object(vendor) is not None:
+            raise ValueError(f"Storage object fileio/{vendor} exists")
+        if self.sizes is not None:
+            size = self.sizes.get(file_path, 0)
+        else:
+            size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        self.objects[vendor] = {
+            "plugin" : "fileio",
+            "name" : vendor,
+            "dev" : file_path,
+            "size" : size,
+            "wwn" : wwn,
+            "write_back" : False
+        }
+        self.target_config["storage_objects"].append(self.objects[vendor])
+
+    def _create_lun(self, vendor: str, iqn: str):
+        if self._storage_object(vendor) is None:
+            raise ValueError(f"No such storage object fileio/{vendor}")
+        luns = self._tpg(iqn)["luns"]
+        storage_object = f"/backstores/fileio/{vendor}"
+        if storage_object in self.lun_objects[iqn]:
+            raise ValueError(f"LUN for {storage_object} exists")
+        luns.append({ "index" : self.next_lun[iqn], "storage_object" : storage_object })
+        self.next_lun[iqn] += 1
+        self.lun_objects[iqn].add(storage_object)
+
+    def _delete_fileio_backstore(self, product: str):
+        stor_obj = self._storage_object(product)
+        if stor_obj is None:
+            raise ValueError(f"No such storage object fileio/{product}")
+        self.target_config["storage_objects"].remove(stor_obj)
+        del self.objects[product]
+        storage_object = f"/backstores/fileio/{product}"
+        for target in self.target_config["targets"]:
+            if storage_object in self.lun_objects[target["wwn"]]:
+                self.lun_objects[target["wwn"]].discard(storage_object)
+                for tpg in target["tpgs"]:
+                    tpg["luns"] = [l for l in tpg["luns"] if l["storage_object"] != storage_object]
+
+    def apply(self, operations: list):
+
+        for o in operations:
+            self.calls[o["op"]] += 1
+            try:
+                getattr(self, "_" + o["op"])(**o["args"])
+            except Exception as err:
+                o["error"] = str(err)
+
+        self.version += 1
+        self.calls["save_config"] += 1
+
+    def disable_target(self, iqn: str):
+        self.calls["disable_target"] += 1
+        self._tpg(iqn)["enable"] = False
+
+    def enable_target(self, iqn: str):
+        self.calls["enable_target"] += 1
+        self._tpg(iqn)["enable"] = True
+
+BACKENDS = {
+    TargetcliBackend.name : TargetcliBackend,
+    RtslibBackend.name : RtslibBackend,
+    FakeBackend.name : FakeBackend
+}
+
+def get_backend(name: str, iqn: str = None) -> LioBackend:
+
+    """Return an LIO backend instance by name"""
+
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LIO backend {name}, expected one of {', '.join(BACKENDS)}")
+
+    if name == FakeBackend.name:
+        return FakeBackend(iqn)
+
+    return BACKENDS[name]()
+
+@trace.traced("lio.disable_target", "iqn")
 def disable_target(iqn: str):
 
     ctx = f"/iscsi/{iqn}/tpg1 disable"
     subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
 
+@trace.traced("lio.enable_target", "iqn")
 def enable_target(iqn: str):
 
     ctx = f"/iscsi/{iqn}/tpg1 enable"
     subprocess.run([config.KV['TARGETCLI_BIN'], ctx], check=True)
 
+@trace.traced("lio.get_tgtp_status", "iqn")
 def get_tgtp_status(iqn: str):
 
     try:
@@ -182,6 +648,33 @@ def get_tgtp_status(iqn: str):
         logging.error(f"Error running targetcli: {e.stderr}")
         return None
 
+class TargetService:
+
+    """Ensure target.service is running, trusting an 'active' result for ttl
+    seconds so systemctl is not run every scan"""
+
+    def __init__(self, ttl: int = 300):
+        self.ttl = ttl
+        self.checked = None
+
+    def invalidate(self):
+        self.checked = None
+
+    def ensure_active(self):
+        if self.checked is not None and time.monotonic() - self.checked < self.ttl:
+            return
+
+        with trace.span("lio.target_service_check"):
+            p = subprocess.run(["systemctl", "is-active", "target.service"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+
+        if p.stdout.strip() != "active":
+            logging.info(f"Target service is not active, starting")
+            subprocess.run(["systemctl", "start", "target.service"], check=True)
+
+        self.checked = time.monotonic()
+
 def load_state():
 
     """ Get current status of the target.service restart """
@@ -195,7 +688,7 @@ def load_state():
 
 def save_state():
 
-    """ Save current status of the target.service restart """
+    """ Save current status of the target.service restart and the projection ledger """
 
     # ensure parent directory exists
     parent_dir = os.path.dirname(STATE_FILE)
@@ -205,6 +698,71 @@ def save_state():
     with open(STATE_FILE, "w") as f:
         json.dump(state, f)
 
+def ledger_entries(projections: list, target_config: dict) -> list:
+
+    """Return ledger entries for the projections live in target_config:
+    image id (None for PE images), S3 path, etag, size, WWN, product
+    (backstore name), dev and LUN index. Projections that are not (or not fully) projected are
+    left out."""
+
+    backstores = { b["name"] : b for b in extract_fileio_backstores(target_config) }
+    luns = { l["storage_object"] : l["index"] for l in extract_fileio_target_luns(target_config) }
+
+    entries = []
+    for p in projections:
+        b = backstores.get(p.product)
+        lun = luns.get(f"/backstores/fileio/{p.product}")
+        if b is None or lun is None or b["dev"] != p.dev:
+            continue
+        entries.append({
+            "image" : p.image,
+            "s3_path" : p.s3_path,
+            "etag" : p.etag,
+            "size" : b["size"],
+            "wwn" : b["wwn"],
+            "product" : p.product,
+            "dev" : p.dev,
+            "lun" : lun
+        })
+
+    return sorted(entries, key=lambda e: e["product"])
+
+def update_ledger(entries: list) -> bool:
+
+    """Persist the projection ledger when it changed, return True if written"""
+
+    if state.get("projections") == entries:
+        return False
+
+    state["projections"] = entries
+    save_state()
+    return True
+
+def validate_ledger(target_config: dict):
+
+    """Compare the projection ledger with live LIO state. Returns None when
+    there is no ledger (e.g., state written by an older agent), otherwise
+    whether every ledger entry is projected as recorded and LIO serves
+    nothing the ledger does not know about."""
+
+    entries = state.get("projections")
+    if entries is None:
+        return None
+
+    luns = { l["storage_object"] : l["index"] for l in extract_fileio_target_luns(target_config) }
+
+    recorded = set([(e["product"], e["dev"], e["wwn"], e["size"], e["lun"]) for e in entries])
+    live = set([(b["name"], b["dev"], b["wwn"], b["size"], luns.get(f"/backstores/fileio/{b['name']}"))
+                for b in extract_fileio_backstores(target_config)])
+
+    if recorded != live:
+        logging.info(f"Projection ledger differs from live LIO: {len(recorded - live)} recorded projections missing or changed, "
+                     f"{len(live - recorded)} unrecorded")
+        return False
+
+    return True
+
+@trace.traced("lio.tgt_service_restart")
 def tgt_service_restart():
 
     """ Restart target.service on first scan completion of the sbps marshal agent """
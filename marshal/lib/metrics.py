@@ -0,0 +1,267 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module with a small Prometheus metrics registry and HTTP exporter"""
+
+import http.server
+import logging
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v))
+
+class _Metric:
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple([labels.get(n, "") for n in self.labelnames])
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: tuple, value) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(_Metric):
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = dict()
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+
+        """Compute the value with function() at exposition time"""
+
+        with self.lock:
+            self.functions[self._key(labels)] = function
+
+    def expose(self) -> list:
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                continue
+            if value is not None:
+                with self.lock:
+                    self.values[key] = value
+        return super().expose()
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def _samples(self, key: tuple, value) -> list:
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+class _Timer:
+
+    """Context manager observing elapsed seconds on a histogram"""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+        return False
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+SCAN_PHASE_SECONDS = REGISTRY.register(Histogram(
+    "sbps_marshal_scan_phase_seconds", "Time spent in each scan phase", ("phase",)))
+SCANS = REGISTRY.register(Counter(
+    "sbps_marshal_scans_total", "Scans by result (full, skipped, failed)", ("result",)))
+LAST_SUCCESSFUL_SCAN = REGISTRY.register(Gauge(
+    "sbps_marshal_last_successful_scan_age_seconds", "Seconds since the last successful scan"))
+LIO_OPERATIONS = REGISTRY.register(Counter(
+    "sbps_marshal_lio_operations_total", "LIO operations by type and result", ("op", "result")))
+S3_REQUESTS = REGISTRY.register(Counter(
+    "sbps_marshal_s3_requests_total", "S3 requests by type (list_page, get, head, put)", ("type",)))
+IMS_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "sbps_marshal_ims_request_seconds", "IMS image list request latency until headers"))
+PROJECTED = REGISTRY.register(Gauge(
+    "sbps_marshal_projected", "Fileio backstores and LUNs configured in LIO", ("kind",)))
+MANIFEST_CACHE = REGISTRY.register(Gauge(
+    "sbps_marshal_manifest_cache", "Manifest cache statistics", ("stat",)))
+PREFETCH_IMAGES = REGISTRY.register(Counter(
+    "sbps_marshal_prefetch_images_total", "Images prefetched into the s3fs cache by result", ("result",)))
+PREFETCH_BYTES = REGISTRY.register(Counter(
+    "sbps_marshal_prefetch_bytes_total", "Bytes read through s3fs to warm its cache"))
+PREFETCH_QUEUE = REGISTRY.register(Gauge(
+    "sbps_marshal_prefetch_queue", "Images queued or being prefetched"))
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.register(Counter(
+    "sbps_marshal_rate_limit_wait_seconds_total", "Seconds requests waited on client-side rate limits, by endpoint", ("endpoint",)))
+THROTTLED_REQUESTS = REGISTRY.register(Counter(
+    "sbps_marshal_throttled_requests_total", "Requests throttled by the server or refused by the scan's request budget", ("endpoint", "reason")))
+SNAPSHOT_OPERATIONS = REGISTRY.register(Counter(
+    "sbps_marshal_snapshot_operations_total", "Projection snapshots published or fetched by result", ("op", "result")))
+SNAPSHOT_AGE = REGISTRY.register(Gauge(
+    "sbps_marshal_snapshot_age_seconds", "Age of the last projection snapshot published or fetched"))
+
+class PhaseTimer:
+
+    """Time consecutive scan phases: start() ends the running phase and
+    begins the next one, stop() ends the running phase. Listeners are
+    called with each new phase name, and None on stop()"""
+
+    def __init__(self, histogram: Histogram = SCAN_PHASE_SECONDS, listeners: list = ()):
+        self.histogram = histogram
+        self.listeners = list(listeners)
+        self.phase = None
+        self.started = None
+
+    def start(self, phase: str):
+        self._end()
+        self.phase = phase
+        self.started = time.monotonic()
+        for listener in self.listeners:
+            listener(phase)
+
+    def stop(self):
+        self._end()
+        for listener in self.listeners:
+            listener(None)
+
+    def _end(self):
+        if self.phase is not None:
+            self.histogram.observe(time.monotonic() - self.started, phase=self.phase)
+        self.phase = None
+
+def mark_successful_scan():
+
+    """Record now as the time of the last successful scan"""
+
+    finished = time.time()
+    LAST_SUCCESSFUL_SCAN.set_function(lambda: time.time() - finished)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics: {format % args}")
+
+def start_http_server(port: int, addr: str = "") -> http.server.ThreadingHTTPServer:
+
+    """Serve /metrics from a daemon thread"""
+
+    server = http.server.ThreadingHTTPServer((addr, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
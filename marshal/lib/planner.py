@@ -0,0 +1,221 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module to plan LIO changes by comparing desired projections against
+the fileio backstores LIO already has"""
+
+import collections
+import os
+import lib.lio as lio
+
+
+ROOTFS_ARTIFACT_TYPE = "application/vnd.cray.image.rootfs.squashfs"
+
+# A fileio backstore (and LUN) the agent wants to exist
+#   product == backstore name, dev == s3fs path, size == S3 object size
+
+Projection = collections.namedtuple("Projection",
+                                    ["product", "wwn", "dev", "size", "s3_path", "etag", "image"],
+                                    defaults=(None,))
+
+def s3_key(s3_path: str, bucket: str) -> str:
+
+    """Strip the normalized s3://bucket/ prefix from an S3 path"""
+
+    prefix = "s3://" + bucket + "/"
+    if s3_path.startswith(prefix):
+        return s3_path[len(prefix):]
+    return s3_path
+
+def index_backstores(backstores: list) -> tuple:
+
+    """Index fileio backstores by name (product) and by dev (s3fs path)"""
+
+    by_name = dict()
+    by_dev = dict()
+
+    for b in backstores:
+        by_name[b["name"]] = b
+        by_dev.setdefault(b["dev"], []).append(b)
+
+    return by_name, by_dev
+
+def pe_projections(s3_index: dict, bucket: str, mount: str) -> list:
+
+    """Return projections for the PE images found in the S3 index (key to
+    s3.S3Object)"""
+
+    projections = []
+
+    for key, s3_object in s3_index.items():
+        if not key.startswith("PE/"):
+            continue
+
+        # e.g., s3://boot-images/PE/CPE-nvidia.x86_64-23.05.squashfs
+        s3_path = "s3://" + bucket + "/" + key
+
+        projections.append(Projection(
+            product=lio.generate_lun_product(s3_path),
+            wwn=lio.generate_lun_wwn(s3_path),
+            dev=os.path.join(mount, key),
+            size=s3_object.size,
+            s3_path=s3_path,
+            etag=None))
+
+    return projections
+
+def rootfs_artifact(manifest: dict) -> tuple:
+
+    """Return the (path, etag) of the rootfs artifact cited in an IMS
+    manifest, (None, None) when either is missing"""
+
+    rootfs_s3_path = None
+    rootfs_s3_etag = None
+
+    for artifact in manifest["artifacts"]:
+        if artifact["type"] == ROOTFS_ARTIFACT_TYPE and \
+            'link' in artifact and artifact['link'] is not None and \
+            'path' in artifact['link'] and 'etag' in artifact['link']:
+            # Expects a normalized s3 path for link->path, e.g.,
+            # s3://boot-images/00d18ed1-20a3-4df2-affb-a88fda00b6f6/rootfs
+            rootfs_s3_path = artifact["link"]["path"]
+            rootfs_s3_etag = artifact["link"]["etag"]
+
+    return rootfs_s3_path, rootfs_s3_etag
+
+def rootfs_projection(rootfs_s3_path: str, rootfs_s3_etag: str,
+                      s3_index: dict, bucket: str, mount: str, image: str = None) -> Projection:
+
+    """Return the projection for a rootfs artifact, None when no S3 object
+    with a matching etag exists"""
+
+    key = s3_key(rootfs_s3_path, bucket)
+    s3_object = s3_index.get(key)
+
+    if s3_object is None or s3_object.etag != rootfs_s3_etag:
+        return None
+
+    digest_data = rootfs_s3_path + "|" + rootfs_s3_etag
+
+    return Projection(
+        product=lio.generate_lun_product(digest_data),
+        wwn=lio.generate_lun_wwn(digest_data),
+        dev=os.path.join(mount, key),
+        size=s3_object.size,
+        s3_path=rootfs_s3_path,
+        etag=rootfs_s3_etag,
+        image=image)
+
+class Plan:
+
+    """Minimal set of LIO changes: backstores to delete, projections to
+    recreate (size or attribute drift) and projections to add. Operations
+    that failed to apply are collected in failed."""
+
+    def __init__(self):
+        self.delete = []
+        self.resize = []
+        self.add = []
+        self.failed = []
+
+    def __len__(self) -> int:
+        return len(self.delete) + len(self.resize) + len(self.add)
+
+    def queue(self, txn: lio.Transaction, iqn: str):
+
+        """Queue the plan on a transaction, deletes first"""
+
+        for b in self.delete:
+            txn.delete_fileio_backstore(b["name"])
+
+        for p in self.resize:
+            txn.delete_fileio_backstore(p.product)
+            txn.create_fileio_backstore(p.product, p.dev, p.wwn, p.size)
+            txn.create_lun(p.product, iqn)
+
+        for p in self.add:
+            txn.create_fileio_backstore(p.product, p.dev, p.wwn, p.size)
+            txn.create_lun(p.product, iqn)
+
+def build_plan(desired: list, backstores: list, exists=os.path.exists, prune: bool = True) -> Plan:
+
+    """Compare desired projections against existing fileio backstores.
+
+    Backstores whose dev no longer exists in s3fs are always deleted (and
+    not recreated until a later scan). Backstores that are not desired are
+    only deleted when prune is set, so a partial view of the desired state
+    (e.g., IMS unavailable) never removes projections.
+
+    exists may answer None (unknown, e.g., s3fs did not respond): such
+    backstores are left alone and such projections are not added."""
+
+    plan = Plan()
+    by_name, by_dev = index_backstores(backstores)
+
+    stale = set()
+    unknown = set()
+    for b in backstores:
+        present = exists(b["dev"])
+        if present is None:
+            unknown.add(b["name"])
+        elif not present:
+            stale.add(b["name"])
+            plan.delete.append(b)
+
+    wanted = dict()
+    for p in desired:
+        wanted.setdefault(p.product, p)
+
+    for p in wanted.values():
+
+        b = by_name.get(p.product)
+
+        if b is None and exists(p.dev) is None:
+            continue
+
+        if b is None:
+
+            # Another backstore serving the same dev (e.g., a previous etag)
+            # has to go before this one is created
+
+            for other in by_dev.get(p.dev, []):
+                if other["name"] not in wanted and other["name"] not in stale and other["name"] not in unknown:
+                    stale.add(other["name"])
+                    plan.delete.append(other)
+
+            plan.add.append(p)
+
+        elif b["name"] in stale or b["name"] in unknown:
+            continue
+
+        elif b["dev"] != p.dev or b["wwn"] != p.wwn or b["size"] != p.size:
+            plan.resize.append(p)
+
+    if prune:
+        for b in backstores:
+            if b["name"] not in wanted and b["name"] not in stale and b["name"] not in unknown:
+                plan.delete.append(b)
+
+    return plan
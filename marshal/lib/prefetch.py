@@ -0,0 +1,150 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Module warming the s3fs cache for newly projected squashfs images"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import struct
+import threading
+import lib.metrics as metrics
+import lib.ratelimit as ratelimit
+import lib.trace as trace
+
+
+# squashfs 4.0 superblock: magic, inode count, mtime, block size, fragment
+# count, compressor, block log, flags, id count, version major/minor, then
+# root inode, bytes used and the id, xattr, inode, directory, fragment and
+# export table offsets
+
+SQUASHFS_MAGIC = 0x73717368
+SUPERBLOCK = struct.Struct("<5I6H8Q")
+
+def squashfs_ranges(superblock: bytes, leading_bytes: int) -> list:
+
+    """Return the (offset, length) byte ranges worth reading for a boot:
+    the leading bytes, and the metadata (inode, directory, fragment, export
+    and id tables), which squashfs stores after the data blocks, from the
+    inode table to the end of the filesystem. Not a squashfs image: only
+    the leading bytes."""
+
+    ranges = [(0, leading_bytes)]
+
+    if len(superblock) < SUPERBLOCK.size:
+        return ranges
+
+    fields = SUPERBLOCK.unpack_from(superblock)
+    if fields[0] != SQUASHFS_MAGIC:
+        return ranges
+
+    bytes_used = fields[12]
+    inode_table_start = fields[15]
+
+    if inode_table_start < bytes_used:
+        ranges.append((inode_table_start, bytes_used - inode_table_start))
+
+    # Merge overlapping ranges
+
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1] = (merged[-1][0], end - merged[-1][0])
+        else:
+            merged.append((offset, length))
+
+    return merged
+
+class Prefetcher:
+
+    """Read the boot-critical parts of newly projected images through the
+    s3fs mount in the background, so s3fs has them cached before the first
+    initiators do. Reads run on a bounded pool, share a bandwidth cap
+    (bytes per second, 0 for none) and are chunked."""
+
+    def __init__(self, workers: int = 2, leading_bytes: int = 64 << 20,
+                 bandwidth: int = 0, chunk_size: int = 1 << 20):
+        self.leading_bytes = leading_bytes
+        self.chunk_size = chunk_size
+        self.limiter = ratelimit.TokenBucket(bandwidth, burst=max(chunk_size, bandwidth))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                          thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.stats = collections.Counter(images=0, failed=0, bytes=0)
+
+        metrics.PREFETCH_QUEUE.set_function(lambda: len(self.queued))
+
+    def submit(self, path: str):
+
+        """Queue path for prefetching unless it already is"""
+
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+
+        self.pool.submit(self._prefetch, path)
+
+    def _prefetch(self, path: str):
+        try:
+            with trace.span("prefetch", path=path):
+                read = self.prefetch(path)
+            self.stats["images"] += 1
+            metrics.PREFETCH_IMAGES.inc(result="ok")
+            logging.info(f"Prefetched {read} bytes of {path}")
+        except Exception as err:
+            self.stats["failed"] += 1
+            metrics.PREFETCH_IMAGES.inc(result="failed")
+            logging.warning(f"Unable to prefetch {path}, received -> {str(err)}")
+        finally:
+            with self.lock:
+                self.queued.discard(path)
+
+    def prefetch(self, path: str) -> int:
+
+        """Read the squashfs ranges of path, return the bytes read"""
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            superblock = os.pread(fd, SUPERBLOCK.size, 0)
+            read = 0
+            for offset, length in squashfs_ranges(superblock, self.leading_bytes):
+                end = min(offset + length, size)
+                while offset < end:
+                    n = min(self.chunk_size, end - offset)
+                    self.limiter.acquire(n)
+                    data = os.pread(fd, n, offset)
+                    if not data:
+                        break
+                    offset += len(data)
+                    read += len(data)
+                    self.stats["bytes"] += len(data)
+                    metrics.PREFETCH_BYTES.inc(len(data))
+            return read
+        finally:
+            os.close(fd)
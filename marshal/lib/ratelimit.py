@@ -0,0 +1,145 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Module with thread-safe rate limiters"""
+
+import email.utils
+import logging
+import threading
+import time
+import lib.metrics as metrics
+
+
+class TokenBucket:
+
+    """Allow rate tokens per second on average, with bursts up to burst
+    tokens. A rate of 0 (or less) disables limiting."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1) -> float:
+
+        """Take tokens, sleeping until they are available. Requests larger
+        than burst are let through once the bucket is full, running it into
+        debt. Returns the seconds waited."""
+
+        if self.rate <= 0:
+            return 0
+
+        waited = 0
+        with self.lock:
+            self._refill(time.monotonic())
+            needed = min(tokens, self.burst)
+            if self.tokens < needed:
+                waited = (needed - self.tokens) / self.rate
+            self.tokens -= tokens
+
+        if waited > 0:
+            time.sleep(waited)
+
+        return waited
+
+class BudgetExceeded(Exception):
+
+    """The request budget of the current scan is used up"""
+
+class Limiter:
+
+    """Client-side limits on requests to one endpoint (e.g., s3, ims),
+    shared by every thread calling it:
+
+    - a token bucket of rate requests per second (0 for no limit)
+    - a per-scan budget of requests (0 for no limit), reset by begin_scan(),
+      past which requests raise BudgetExceeded
+    - a pause for everyone after the server throttled a request, see backoff()
+
+    Time spent waiting is counted per endpoint in metrics."""
+
+    def __init__(self, endpoint: str, rate: float = 0, burst: float = None, budget: int = 0):
+        self.endpoint = endpoint
+        self.bucket = TokenBucket(rate, burst)
+        self.budget = budget
+        self.used = 0
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def begin_scan(self):
+        with self.lock:
+            self.used = 0
+
+    def acquire(self):
+
+        """Wait for a request slot, raising BudgetExceeded when the scan has
+        none left"""
+
+        with self.lock:
+            if self.budget > 0 and self.used >= self.budget:
+                metrics.THROTTLED_REQUESTS.inc(endpoint=self.endpoint, reason="budget")
+                raise BudgetExceeded(f"Request budget of {self.budget} {self.endpoint} requests for this scan is used up")
+            self.used += 1
+            paused = self.paused_until - time.monotonic()
+
+        waited = 0
+        if paused > 0:
+            time.sleep(paused)
+            waited += paused
+
+        waited += self.bucket.acquire()
+
+        if waited > 0:
+            metrics.RATE_LIMIT_WAIT_SECONDS.inc(waited, endpoint=self.endpoint)
+
+    def backoff(self, delay: float, reason: str = "throttled"):
+
+        """Hold every request for delay seconds after the server asked to
+        slow down"""
+
+        metrics.THROTTLED_REQUESTS.inc(endpoint=self.endpoint, reason=reason)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logging.warning(f"{self.endpoint} is throttling requests, pausing them for {delay:.1f}s")
+
+def retry_after(value: str, default: float = None) -> float:
+
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds"""
+
+    if not value:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
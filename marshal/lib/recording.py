@@ -0,0 +1,330 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Module recording what one scan consumed (S3, IMS, manifests, LIO and
+s3fs state) and serving it back, so slow scans can be replayed and
+profiled off the node without touching RGW, IMS or LIO"""
+
+import botocore.exceptions
+import io
+import json
+import logging
+import os
+import threading
+import time
+import types
+import lib.config as config
+import lib.lio as lio
+import lib.planner as planner
+
+from _collections_abc import Iterable
+
+
+# Configuration that shapes a scan, saved with a recording and restored on
+# replay
+
+SCAN_CONFIG = [ 'S3_BUCKET',
+                'SQUASHFS_S3FS_MOUNT',
+                'LIO_SAVE_FILE',
+                'IMS_TAGGING',
+                'S3_INVENTORY_MODE',
+                'MANIFEST_WORKERS' ]
+
+class Recorder:
+
+    """Collect the inputs of a scan and write them to a directory:
+
+    - meta.json: host, time and scan configuration
+    - s3.json: listing pages (by prefix) and HEAD results
+    - manifests.json: IMS manifests by S3 key, including cache hits
+    - ims.json: the IMS image list
+    - saveconfig.json: the LIO configuration seen at the start of the scan
+    - s3fs.json: s3fs stat results and how long each took (stats that
+      never returned are missing, and unknown on replay)
+    - sizes.json: sizes LIO gave the backstores the scan created, by dev
+    - scan-*.json: the scan trace (call timings), see lib.trace"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.pages = dict()
+        self.heads = dict()
+        self.manifests = dict()
+        self.ims_images = None
+        self.saveconfig = None
+        self.s3fs = dict()
+        self.sizes = dict()
+
+    # Wrappers around the agent's dependencies
+
+    def s3_client(self, client) -> "RecordingS3Client":
+        return RecordingS3Client(client, self)
+
+    def s3_clients(self, holder):
+        return types.SimpleNamespace(get=lambda: self.s3_client(holder.get()))
+
+    def ims_client(self, client) -> "RecordingImsClient":
+        return RecordingImsClient(client, self)
+
+    def backend(self, backend: lio.LioBackend) -> "RecordingBackend":
+        return RecordingBackend(backend, self)
+
+    def manifest_cache(self, manifest_cache) -> "RecordingManifestCache":
+        return RecordingManifestCache(manifest_cache, self)
+
+    def isfile(self, isfile):
+        def recorded(path: str) -> bool:
+            started = time.monotonic()
+            result = isfile(path)
+            with self.lock:
+                self.s3fs[path] = [result, round(time.monotonic() - started, 6)]
+            return result
+        return recorded
+
+    def save(self, hostname: str):
+
+        """Write the recording"""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        documents = {
+            "meta.json" : {
+                "hostname" : hostname,
+                "recorded" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "config" : { k : config.KV[k] for k in SCAN_CONFIG }
+            },
+            "s3.json" : { "pages" : self.pages, "heads" : self.heads },
+            "manifests.json" : self.manifests,
+            "ims.json" : self.ims_images,
+            "saveconfig.json" : self.saveconfig,
+            "s3fs.json" : self.s3fs,
+            "sizes.json" : self.sizes
+        }
+
+        for name, document in documents.items():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                json.dump(document, f)
+
+        logging.info(f"Recorded scan inputs to {self.directory}: {sum([len(p) for p in self.pages.values()])} S3 listing pages, "
+                     f"{len(self.heads)} HEADs, {len(self.manifests)} manifests, {len(self.ims_images or [])} IMS images, "
+                     f"{len(self.s3fs)} s3fs checks")
+
+class RecordingS3Client:
+
+    def __init__(self, client, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def get_paginator(self, operation: str):
+        paginator = self.client.get_paginator(operation)
+        recorder = self.recorder
+
+        def paginate(**kwargs):
+            pages = []
+            with recorder.lock:
+                recorder.pages[kwargs.get("Prefix") or ""] = pages
+            for page in paginator.paginate(**kwargs):
+                pages.append([ { "Key" : o["Key"], "Size" : o["Size"], "ETag" : o["ETag"] }
+                               for o in page.get("Contents", []) ])
+                yield page
+
+        return types.SimpleNamespace(paginate=paginate)
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        try:
+            response = self.client.head_object(Bucket=Bucket, Key=Key)
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                with self.recorder.lock:
+                    self.recorder.heads[Key] = None
+            raise
+        with self.recorder.lock:
+            self.recorder.heads[Key] = { "ContentLength" : response["ContentLength"], "ETag" : response["ETag"] }
+        return response
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        return self.client.get_object(Bucket=Bucket, Key=Key)
+
+class RecordingImsClient:
+
+    def __init__(self, client, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+        self.ims_url = client.ims_url
+
+    def images(self, access_token: str) -> Iterable:
+        images = list(self.client.images(access_token))
+        self.recorder.ims_images = images
+        return images
+
+class RecordingManifestCache:
+
+    def __init__(self, manifest_cache, recorder: Recorder):
+        self.manifest_cache = manifest_cache
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.manifest_cache, name)
+
+    def get_or_fetch(self, path: str, etag: str, fetch) -> dict:
+        manifest = self.manifest_cache.get_or_fetch(path, etag, fetch)
+        with self.recorder.lock:
+            self.recorder.manifests[planner.s3_key(path, config.KV['S3_BUCKET'])] = manifest
+        return manifest
+
+class RecordingBackend(lio.LioBackend):
+
+    """Pass through to backend, keeping the first configuration loaded and
+    the sizes of created backstores"""
+
+    def __init__(self, backend: lio.LioBackend, recorder: Recorder):
+        self.backend = backend
+        self.recorder = recorder
+        self.name = backend.name
+
+    def load_config(self) -> dict:
+        target_config = self.backend.load_config()
+        if self.recorder.saveconfig is None:
+            self.recorder.saveconfig = target_config
+        return target_config
+
+    @property
+    def source(self) -> str:
+        return self.backend.source
+
+    def state_token(self) -> str:
+        return self.backend.state_token()
+
+    def apply(self, operations: list):
+        self.backend.apply(operations)
+
+        created = set([o["args"]["file_path"] for o in operations
+                       if o["op"] == "create_fileio_backstore" and o["error"] is None])
+        if not created:
+            return
+
+        try:
+            backstores = lio.extract_fileio_backstores(self.backend.load_config())
+        except Exception as err:
+            logging.warning(f"Unable to record backstore sizes, received -> {str(err)}")
+            return
+
+        with self.recorder.lock:
+            self.recorder.sizes.update({ b["dev"] : b["size"] for b in backstores if b["dev"] in created })
+
+    def disable_target(self, iqn: str):
+        self.backend.disable_target(iqn)
+
+    def enable_target(self, iqn: str):
+        self.backend.enable_target(iqn)
+
+## --------------------------------------------------------------
+## Replay
+## --------------------------------------------------------------
+
+class ReplayS3Client:
+
+    """Serve recorded listing pages, HEAD results and manifests"""
+
+    def __init__(self, pages: dict, heads: dict, manifests: dict):
+        self.pages = pages
+        self.heads = heads
+        self.manifests = manifests
+
+    def get_paginator(self, operation: str):
+        return types.SimpleNamespace(
+            paginate=lambda Bucket, Prefix=None: ({ "Contents" : p } for p in self.pages.get(Prefix or "", [])))
+
+    def _missing(self, operation: str, key: str):
+        return botocore.exceptions.ClientError({ "Error" : { "Code" : "404", "Message" : f"{key} not recorded" } },
+                                               operation)
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        if self.heads.get(Key) is None:
+            raise self._missing("HeadObject", Key)
+        return self.heads[Key]
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        if self.manifests.get(Key) is None:
+            raise self._missing("GetObject", Key)
+        return { "Body" : io.BytesIO(json.dumps(self.manifests[Key]).encode()) }
+
+class ReplayImsClient:
+
+    def __init__(self, images: list, ims_url: str = "replay"):
+        self.images_list = images
+        self.ims_url = ims_url
+
+    def images(self, access_token: str) -> Iterable:
+        if self.images_list is None:
+            raise ValueError("IMS image list was not recorded")
+        return iter(self.images_list)
+
+class StaticToken:
+
+    """Stand-in for auth.SvidProvider"""
+
+    def get(self) -> str:
+        return "replay"
+
+    def invalidate(self):
+        pass
+
+def load(directory: str) -> types.SimpleNamespace:
+
+    """Read a recording and restore its scan configuration. Returns the
+    hostname and the stand-ins a scan needs: s3_clients, ims_client, svids,
+    backend (in memory, neither LIO nor s3fs is touched) and isfile."""
+
+    def read(name, default=None):
+        try:
+            with open(os.path.join(directory, name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if default is None:
+                raise
+            return default
+
+    meta = read("meta.json")
+    s3_recording = read("s3.json")
+    s3fs = read("s3fs.json")
+
+    # Created backstores get their recorded size, never that of a file on
+    # this host. Recordings made before sizes.json create empty backstores.
+
+    sizes = read("sizes.json", {})
+
+    config.KV.update(meta["config"])
+
+    s3_client = ReplayS3Client(s3_recording["pages"], s3_recording["heads"], read("manifests.json"))
+
+    return types.SimpleNamespace(
+        hostname=meta["hostname"],
+        s3_clients=types.SimpleNamespace(get=lambda: s3_client),
+        ims_client=ReplayImsClient(read("ims.json")),
+        svids=StaticToken(),
+        backend=lio.FakeBackend(target_config=read("saveconfig.json"), sizes=sizes),
+        isfile=lambda path: s3fs[path][0] if path in s3fs else None,
+        label_watcher=types.SimpleNamespace(labelled=True),
+        target_service=types.SimpleNamespace(ensure_active=lambda: None, invalidate=lambda: None))
@@ -25,47 +25,193 @@
 """Module containing a few s3 helper functions, built upon boto3"""
 
 import boto3
-import datetime
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
 import json
+import logging
+import os
+import random
+import lib.auth as auth
+import lib.metrics as metrics
+import lib.ratelimit as ratelimit
+import lib.trace as trace
 
+from _collections_abc import Iterable
 
-def get_s3_client(s3_url: str, s3_key_id: str, s3_access_key: str) -> boto3.client:
 
-    """Create and return boto3 session"""
+# Error codes RGW (and AWS) use to ask clients to slow down, along with
+# HTTP 429 and 503
+
+THROTTLE_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests')
+MAX_THROTTLE_DELAY = 60
+
+class S3ClientHolder:
+
+    """Keep a single S3 client (and its connection pool) across scans. The
+    credential file is re-read, and the client rebuilt, only when the file's
+    inode, mtime or size changes. Requests of every client go through
+    limiter, see limit_requests()."""
+
+    def __init__(self, s3_url: str, credential_file: str, max_pool_connections: int = 10,
+                 limiter: ratelimit.Limiter = None, max_attempts: int = 5):
+        self.s3_url = s3_url
+        self.credential_file = credential_file
+        self.max_pool_connections = max_pool_connections
+        self.limiter = limiter or ratelimit.Limiter("s3")
+        self.max_attempts = max_attempts
+        self.client = None
+        self.identity = None
+
+    def get(self) -> boto3.client:
+
+        """Return the current client, rebuilding it if credentials changed"""
+
+        st = os.stat(self.credential_file)
+        identity = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+        if self.client is None or identity != self.identity:
+            s3_key_id, s3_access_key = auth.get_s3fs_creds(self.credential_file)
+            self.client = get_s3_client(self.s3_url,
+                                        s3_key_id,
+                                        s3_access_key,
+                                        self.max_pool_connections,
+                                        self.limiter,
+                                        self.max_attempts)
+            self.identity = identity
+            logging.info(f"Created S3 client for {self.s3_url} from {self.credential_file}")
+
+        return self.client
+
+def get_s3_client(s3_url: str, s3_key_id: str, s3_access_key: str,
+                  max_pool_connections: int = 10, limiter: ratelimit.Limiter = None,
+                  max_attempts: int = 5) -> boto3.client:
+
+    """Create and return boto3 session, max_pool_connections should match
+    the number of threads sharing the client"""
     
     session = boto3.Session()
-    return session.client(
+    s3_client = session.client(
         's3',
         aws_access_key_id=s3_key_id,
         aws_secret_access_key=s3_access_key,
         endpoint_url=s3_url,
-        verify=False
+        verify=False,
+        config=botocore.config.Config(max_pool_connections=max_pool_connections,
+                                      retries={ "mode" : "standard", "total_max_attempts" : max_attempts })
     )
 
-def list_bucket_objects(s3_client: boto3.client, bucket: str) -> list:
+    if limiter is not None:
+        limit_requests(s3_client, limiter, max_attempts)
+
+    return s3_client
+
+def limit_requests(s3_client: boto3.client, limiter: ratelimit.Limiter, max_attempts: int = 5):
+
+    """Send every request of s3_client, retries included, through limiter.
+    Throttled requests (429, 503 or a SlowDown error) pause the limiter and
+    are retried after Retry-After seconds, or an exponential backoff when
+    the server does not say, up to max_attempts. Other errors are left to
+    botocore's retries."""
+
+    def before_send(**kwargs):
+        limiter.acquire()
+
+    def needs_retry(response, attempts, **kwargs):
+        if response is None:
+            return None
+
+        http_response, parsed = response
+        code = parsed.get("Error", {}).get("Code")
+        if http_response.status_code not in (429, 503) and code not in THROTTLE_CODES:
+            return None
+
+        delay = ratelimit.retry_after(http_response.headers.get("Retry-After"),
+                                      random.uniform(0.5, 1) * 2 ** attempts)
+        delay = min(MAX_THROTTLE_DELAY, delay)
+        limiter.backoff(delay)
 
-    """List objects in a target S3 bucket"""
+        if attempts >= max_attempts:
+            return None
+        return delay
 
-    def datetime_handler(x):
-        if isinstance(x, datetime.datetime):
-            return x.isoformat()
-        raise TypeError(f"Unknown type: {type(x)}")
+    s3_client.meta.events.register('before-send.s3', before_send)
+    s3_client.meta.events.register_first('needs-retry.s3', needs_retry)
 
-    files = []
-    paginator = s3_client.get_paginator('list_objects')
-    pages = paginator.paginate(Bucket=bucket)
+class S3Object:
+
+    """Compact S3 inventory record, etag is stored without quotes"""
+
+    __slots__ = ("key", "size", "etag")
+
+    def __init__(self, key: str, size: int, etag: str):
+        self.key = key
+        self.size = size
+        self.etag = etag.strip('"')
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, S3Object) and \
+            (self.key, self.size, self.etag) == (other.key, other.size, other.etag)
+
+    def __repr__(self) -> str:
+        return f"S3Object(key={self.key!r}, size={self.size}, etag={self.etag!r})"
+
+def iter_bucket_objects(s3_client: boto3.client, bucket: str, prefix: str = None) -> Iterable:
+
+    """Yield an S3Object per object in a target S3 bucket, optionally only
+    under prefix, one listing page at a time"""
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    if prefix:
+        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    else:
+        pages = paginator.paginate(Bucket=bucket)
 
     for page in pages:
-        if 'Contents' in page:
-            for obj in page['Contents']:
-                files.append(obj)
+        metrics.S3_REQUESTS.inc(type="list_page")
+        for obj in page.get('Contents', []):
+            yield S3Object(obj['Key'], obj['Size'], obj['ETag'])
 
-    return json.loads(json.dumps(files, default=datetime_handler))
+@trace.traced("s3.list_bucket_objects", "bucket", "prefix")
+def list_bucket_objects(s3_client: boto3.client, bucket: str, prefix: str = None) -> dict:
 
+    """List objects in a target S3 bucket, optionally only under prefix,
+    and return them indexed by key"""
 
+    return { o.key : o for o in iter_bucket_objects(s3_client, bucket, prefix) }
+
+@trace.traced("s3.head_objects", "bucket")
+def head_objects(s3_client: boto3.client, bucket: str, keys: list, workers: int = 8) -> dict:
+
+    """HEAD keys concurrently and return S3Objects, indexed by key, for the
+    ones that exist. Errors other than a missing key are raised."""
+
+    def head(key):
+        metrics.S3_REQUESTS.inc(type="head")
+        try:
+            response = s3_client.head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return S3Object(key, response['ContentLength'], response['ETag'])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return { o.key : o for o in pool.map(head, keys) if o is not None }
+
+@trace.traced("s3.get_s3_object", "bucket", "key")
 def get_s3_object(s3_client: boto3.client, bucket: str, key: str) -> bytes:
 
     """Download an S3 object provided by key, from bucket"""
 
+    metrics.S3_REQUESTS.inc(type="get")
     response = s3_client.get_object(Bucket=bucket, Key=key)
-    return response['Body']
\ No newline at end of file
+    return response['Body']
+
+@trace.traced("s3.get_s3_json", "bucket", "key")
+def get_s3_json(s3_client: boto3.client, bucket: str, key: str) -> dict:
+
+    """Download and parse a JSON S3 object provided by key, from bucket"""
+
+    return json.load(get_s3_object(s3_client, bucket, key))
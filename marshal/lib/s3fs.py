@@ -0,0 +1,160 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Module checking rootfs presence on the s3fs mount without letting a slow
+or wedged mount stall the agent"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import stat
+import threading
+import time
+import lib.trace as trace
+
+from _collections_abc import Iterable
+
+
+def isfile(path: str) -> bool:
+
+    """Like os.path.isfile, but only a missing path is False. Other errors
+    (e.g., 'Transport endpoint is not connected') are raised, so an ailing
+    mount is not mistaken for missing images."""
+
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+class S3fsProbe:
+
+    """Check paths on the s3fs mount concurrently. check may also answer
+    None for unknown.
+
+    Each stat runs on a bounded pool and gets timeout seconds once started.
+    Answers are True, False or None (unknown: timed out, or failed with an
+    error other than the path missing). True and False are cached for ttl
+    seconds keyed by (path, etag), unknowns are not cached. A stat that
+    hangs keeps its worker, but is not submitted again while in flight."""
+
+    def __init__(self, check=isfile, workers: int = 16, timeout: float = 10, ttl: float = 30):
+        self.check = check
+        self.timeout = timeout
+        self.ttl = ttl
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                          thread_name_prefix="s3fs-probe")
+        self.lock = threading.Lock()
+        self.cache = dict()
+        self.inflight = dict()
+        self.started = dict()
+        self.stats = collections.Counter(hits=0, probes=0, timeouts=0, errors=0)
+
+    def _probe(self, path: str) -> bool:
+        with self.lock:
+            self.started[path] = time.monotonic()
+        try:
+            return self.check(path)
+        finally:
+            with self.lock:
+                self.started.pop(path, None)
+
+    def _submit(self, path: str) -> concurrent.futures.Future:
+        with self.lock:
+            future = self.inflight.get(path)
+            if future is None or future.done():
+                future = self.pool.submit(self._probe, path)
+                self.inflight[path] = future
+                self.stats["probes"] += 1
+            return future
+
+    def probe(self, items: Iterable) -> dict:
+
+        """Check (path, etag) pairs, returning True, False or None per path"""
+
+        results = dict()
+        pending = dict()
+        now = time.monotonic()
+
+        for path, etag in items:
+            cached = self.cache.get((path, etag))
+            if cached is not None and now - cached[1] < self.ttl:
+                self.stats["hits"] += 1
+                results[path] = cached[0]
+            elif path not in pending:
+                pending[path] = (etag, self._submit(path))
+
+        if not pending:
+            return results
+
+        with trace.span("s3fs.probe", paths=len(pending)):
+
+            # Give up on the rest when nothing completes for a whole timeout,
+            # i.e., every worker is stuck
+
+            stalled = time.monotonic() + self.timeout
+
+            while True:
+                now = time.monotonic()
+
+                for path, (etag, future) in list(pending.items()):
+                    if future.done():
+                        del pending[path]
+                        try:
+                            results[path] = future.result()
+                        except Exception as err:
+                            self.stats["errors"] += 1
+                            logging.warning(f"Unable to check {path} on s3fs, received -> {str(err)}")
+                            results[path] = None
+                        if results[path] is not None:
+                            self.cache[(path, etag)] = (results[path], now)
+                        continue
+
+                    with self.lock:
+                        started = self.started.get(path)
+
+                    if (started is not None and now - started > self.timeout) or now > stalled:
+                        del pending[path]
+                        self.stats["timeouts"] += 1
+                        results[path] = None
+
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait([f for _, f in pending.values()],
+                                                  timeout=min(1, self.timeout),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                if done:
+                    stalled = time.monotonic() + self.timeout
+
+        unknown = [p for p in results if results[p] is None]
+        if unknown:
+            logging.warning(f"s3fs did not answer for {len(unknown)} paths, leaving their projections alone, e.g., {unknown[0]}")
+
+        # Drop expired entries now and then
+
+        if len(self.cache) > 4 * max(1, len(results)):
+            self.cache = { k : v for k, v in self.cache.items() if now - v[1] < self.ttl }
+
+        return results
@@ -0,0 +1,147 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module deciding how long the agent waits between scans"""
+
+import hashlib
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+
+class Scheduler:
+
+    """Pick the delay before the next scan and wait for it.
+
+    - failures back off exponentially from retry_interval up to interval,
+      cheap (local) failures are first retried at retry_interval
+    - scans that change nothing stretch the delay towards idle_interval
+    - every delay gets +/- jitter so nodes drift apart
+    - the wait ends early on wake() (e.g., SIGUSR1) or when a watched file
+      changes, checked every poll_interval seconds"""
+
+    CHEAP_RETRIES = 3
+
+    def __init__(self, interval: float, idle_interval: float = None, retry_interval: float = 10,
+                 jitter: float = 0.1, watch_paths: list = (), poll_interval: float = 2):
+        self.interval = interval
+        self.idle_interval = max(interval, idle_interval or interval)
+        self.retry_interval = min(interval, retry_interval)
+        self.jitter = jitter
+        self.watch_paths = list(watch_paths)
+        self.poll_interval = poll_interval
+        self.failures = 0
+        self.idle_scans = 0
+        self.wakeup = threading.Event()
+        self.wake_reason = None
+
+    def _jittered(self, delay: float) -> float:
+        return max(0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def success(self, changed: bool) -> float:
+
+        """Record a completed scan and return the delay before the next one"""
+
+        self.failures = 0
+
+        if changed:
+            self.idle_scans = 0
+            return self._jittered(self.interval)
+
+        self.idle_scans += 1
+        return self._jittered(min(self.idle_interval, self.interval * 2 ** (self.idle_scans - 1)))
+
+    def failure(self, cheap: bool = False) -> float:
+
+        """Record a failed scan and return the delay before the retry"""
+
+        self.failures += 1
+        self.idle_scans = 0
+
+        if cheap and self.failures <= self.CHEAP_RETRIES:
+            return self._jittered(self.retry_interval)
+
+        return self._jittered(min(self.interval, self.retry_interval * 2 ** self.failures))
+
+    @staticmethod
+    def stagger(key: str, spread: float) -> float:
+
+        """Return a delay in [0, spread) fixed by key (e.g., the hostname), so
+        nodes started at the same time still scan at different times"""
+
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        return spread * int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    def wake(self, reason: str):
+
+        """End the current (or next) wait early"""
+
+        self.wake_reason = reason
+        self.wakeup.set()
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR1):
+
+        """Wake up on signum (SIGUSR1 by default)"""
+
+        signal.signal(signum, lambda signum, frame: self.wake(signal.Signals(signum).name))
+
+    def _snapshot(self) -> dict:
+        snapshot = dict()
+        for path in self.watch_paths:
+            try:
+                st = os.stat(path)
+                snapshot[path] = (st.st_ino, st.st_mtime_ns, st.st_size)
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def sleep(self, delay: float) -> str:
+
+        """Wait up to delay seconds, return why the wait ended"""
+
+        logging.info(f"Next scan in {delay:.0f}s")
+
+        deadline = time.monotonic() + delay
+        baseline = self._snapshot()
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "timer"
+
+            if self.wakeup.wait(min(self.poll_interval, remaining)):
+                self.wakeup.clear()
+                reason, self.wake_reason = self.wake_reason, None
+                logging.info(f"Woken up early by {reason}")
+                return reason
+
+            current = self._snapshot()
+            if current != baseline:
+                changed = [p for p in current if current[p] != baseline[p]]
+                logging.info(f"Woken up early by changes to {', '.join(changed)}")
+                return "watch"
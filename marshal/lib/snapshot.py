@@ -0,0 +1,328 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Module to share the resolved projection set between agents: a publisher
+writes it as a versioned snapshot, consumers reconcile LIO from it without
+listing S3, querying IMS or fetching manifests"""
+
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import botocore.exceptions
+import requests
+import lib.k8s as k8s
+import lib.metrics as metrics
+import lib.planner as planner
+import lib.trace as trace
+
+
+FORMAT_VERSION = 1
+
+# Columns of a snapshot row, key is the projection's dev relative to the
+# s3fs mount (the S3 object key)
+
+FIELDS = ["product", "wwn", "key", "size", "s3_path", "etag", "image"]
+
+class SnapshotError(Exception):
+
+    """A snapshot could not be read, or may not be used"""
+
+class Snapshot:
+
+    """Resolved projections as published. complete is False when the
+    publisher skipped images that may still resolve (e.g., a manifest it
+    could not fetch). digest covers rows and complete, not the publisher
+    or the publication time."""
+
+    def __init__(self, rows: list, complete: bool, publisher: str, published: float):
+        self.rows = rows
+        self.complete = complete
+        self.publisher = publisher
+        self.published = published
+        self.digest = hashlib.sha224(json.dumps([rows, complete], separators=(",", ":")).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_projections(cls, projections: list, complete: bool, mount: str, publisher: str) -> "Snapshot":
+        rows = [[p.product, p.wwn, os.path.relpath(p.dev, mount), p.size, p.s3_path, p.etag, p.image]
+                for p in projections]
+        rows.sort(key=lambda row: (row[0], row[2]))
+        return cls(rows, complete, publisher, time.time())
+
+    def projections(self, mount: str) -> list:
+
+        """Return the rows as projections on the local s3fs mount"""
+
+        return [ planner.Projection(product=r[0], wwn=r[1], dev=os.path.join(mount, r[2]), size=r[3],
+                                    s3_path=r[4], etag=r[5], image=r[6]) for r in self.rows ]
+
+    def age(self) -> float:
+        return max(0, time.time() - self.published)
+
+def encode(snapshot: Snapshot) -> bytes:
+
+    """Serialize a snapshot as gzipped JSON"""
+
+    document = {
+        "version" : FORMAT_VERSION,
+        "publisher" : snapshot.publisher,
+        "published" : snapshot.published,
+        "complete" : snapshot.complete,
+        "digest" : snapshot.digest,
+        "fields" : FIELDS,
+        "projections" : snapshot.rows
+    }
+    return gzip.compress(json.dumps(document, separators=(",", ":")).encode('utf-8'), mtime=0)
+
+def decode(data: bytes) -> Snapshot:
+
+    """Parse and verify a snapshot written by encode()"""
+
+    try:
+        document = json.loads(gzip.decompress(data))
+    except Exception as err:
+        raise SnapshotError(f"Unreadable snapshot, received -> {str(err)}")
+
+    if document.get("version") != FORMAT_VERSION or document.get("fields") != FIELDS:
+        raise SnapshotError(f"Unsupported snapshot version {document.get('version')}, expected {FORMAT_VERSION}")
+
+    snapshot = Snapshot(document["projections"], document["complete"],
+                        document["publisher"], document["published"])
+
+    if snapshot.digest != document["digest"]:
+        raise SnapshotError(f"Snapshot from {snapshot.publisher} does not match its digest")
+
+    return snapshot
+
+class FileStore:
+
+    """Snapshot in a local (or shared filesystem) file, replaced atomically"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.location = path
+
+    def read(self, token=None) -> tuple:
+
+        """Return (data, token), data is None when unchanged since token"""
+
+        st = os.stat(self.path)
+        current = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if current == token:
+            return None, token
+        with open(self.path, 'rb') as f:
+            return f.read(), current
+
+    def write(self, data: bytes):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+class S3Store:
+
+    """Snapshot in an S3 object, re-downloaded only when its etag changes.
+    s3_clients is an s3.S3ClientHolder."""
+
+    def __init__(self, s3_clients, bucket: str, key: str):
+        self.s3_clients = s3_clients
+        self.bucket = bucket
+        self.key = key
+        self.location = f"s3://{bucket}/{key}"
+
+    def read(self, token=None) -> tuple:
+        args = dict(Bucket=self.bucket, Key=self.key)
+        if token is not None:
+            args["IfNoneMatch"] = token
+
+        metrics.S3_REQUESTS.inc(type="get")
+        try:
+            response = self.s3_clients.get().get_object(**args)
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return None, token
+            raise
+
+        return response['Body'].read(), response['ETag']
+
+    def write(self, data: bytes):
+        metrics.S3_REQUESTS.inc(type="put")
+        self.s3_clients.get().put_object(Bucket=self.bucket, Key=self.key, Body=data,
+                                         ContentType="application/gzip")
+
+class ConfigMapStore:
+
+    """Snapshot in the binaryData of a ConfigMap. ConfigMaps are limited to
+    1 MiB, enough for several thousand projections."""
+
+    DATA_KEY = "snapshot"
+
+    def __init__(self, api: k8s.KubeApi, namespace: str, name: str, timeout: int = 10):
+        self.api = api
+        self.namespace = namespace
+        self.name = name
+        self.timeout = timeout
+        self.collection = f"/api/v1/namespaces/{namespace}/configmaps"
+        self.location = f"configmap://{namespace}/{name}"
+
+    def read(self, token=None) -> tuple:
+        configmap = self.api.get(f"{self.collection}/{self.name}", {}, self.timeout).json()
+        current = configmap["metadata"]["resourceVersion"]
+        if current == token:
+            return None, token
+        return base64.b64decode(configmap.get("binaryData", {})[self.DATA_KEY]), current
+
+    def write(self, data: bytes):
+        binary_data = { self.DATA_KEY : base64.b64encode(data).decode('ascii') }
+        try:
+            self.api.send("PATCH", f"{self.collection}/{self.name}", { "binaryData" : binary_data },
+                          self.timeout, "application/merge-patch+json")
+        except requests.HTTPError as err:
+            if err.response is None or err.response.status_code != 404:
+                raise
+            self.api.send("POST", self.collection,
+                          { "apiVersion" : "v1",
+                            "kind" : "ConfigMap",
+                            "metadata" : { "name" : self.name, "namespace" : self.namespace },
+                            "binaryData" : binary_data },
+                          self.timeout)
+
+def open_store(location: str, s3_clients=None, kubeconfig: str = None):
+
+    """Return the store for a location: s3://bucket/key,
+    configmap://namespace/name or a file path"""
+
+    if not location:
+        raise ValueError("No snapshot location configured")
+
+    if location.startswith("s3://"):
+        bucket, _, key = location[len("s3://"):].partition("/")
+        if not bucket or not key:
+            raise ValueError(f"Snapshot location {location} is not s3://bucket/key")
+        return S3Store(s3_clients, bucket, key)
+
+    if location.startswith("configmap://"):
+        namespace, _, name = location[len("configmap://"):].partition("/")
+        if not namespace or not name:
+            raise ValueError(f"Snapshot location {location} is not configmap://namespace/name")
+        return ConfigMapStore(k8s.KubeApi.from_kubeconfig(kubeconfig), namespace, name)
+
+    return FileStore(location)
+
+class SnapshotPublisher:
+
+    """Publish the projection set to a store. A snapshot is written when it
+    changes, and rewritten unchanged every refresh seconds so consumers can
+    tell the publisher is alive."""
+
+    def __init__(self, store, hostname: str, mount: str, refresh: float):
+        self.store = store
+        self.hostname = hostname
+        self.mount = mount
+        self.refresh = refresh
+        self.last = None
+        self.written = None
+
+    def publish(self, projections: list, complete: bool) -> bool:
+
+        """Publish projections unless unchanged and recently written.
+        Returns whether the snapshot was written."""
+
+        snapshot = Snapshot.from_projections(projections, complete, self.mount, self.hostname)
+        if self.last is not None and snapshot.digest == self.last.digest:
+            return self.keepalive()
+        return self._write(snapshot)
+
+    def keepalive(self) -> bool:
+
+        """Rewrite the last snapshot if refresh seconds have passed"""
+
+        if self.last is None or time.monotonic() - self.written < self.refresh:
+            return False
+        return self._write(Snapshot(self.last.rows, self.last.complete, self.hostname, time.time()))
+
+    def _write(self, snapshot: Snapshot) -> bool:
+        try:
+            with trace.span("snapshot.publish", projections=len(snapshot.rows)):
+                data = encode(snapshot)
+                self.store.write(data)
+        except Exception:
+            metrics.SNAPSHOT_OPERATIONS.inc(op="publish", result="error")
+            raise
+
+        metrics.SNAPSHOT_OPERATIONS.inc(op="publish", result="ok")
+        metrics.SNAPSHOT_AGE.set_function(snapshot.age)
+
+        if self.last is None or snapshot.digest != self.last.digest:
+            logging.info(f"Published snapshot {snapshot.digest[:12]} with {len(snapshot.rows)} projections ({len(data)} bytes) to {self.store.location}")
+
+        self.last = snapshot
+        self.written = time.monotonic()
+        return True
+
+class SnapshotConsumer:
+
+    """Fetch snapshots from a store, keeping the last one while the store
+    reports it unchanged. Snapshots more than max_age seconds old are
+    refused (0 to accept any age): the publisher has stopped, and what it
+    resolved may no longer match IMS and S3."""
+
+    def __init__(self, store, max_age: float):
+        self.store = store
+        self.max_age = max_age
+        self.snapshot = None
+        self.token = None
+
+    def fetch(self) -> Snapshot:
+        try:
+            with trace.span("snapshot.fetch"):
+                data, token = self.store.read(self.token)
+            if data is not None:
+                snapshot = decode(data)
+                if self.snapshot is None or snapshot.digest != self.snapshot.digest:
+                    logging.info(f"Fetched snapshot {snapshot.digest[:12]} with {len(snapshot.rows)} projections from {snapshot.publisher}")
+                self.snapshot = snapshot
+                self.token = token
+        except Exception:
+            metrics.SNAPSHOT_OPERATIONS.inc(op="fetch", result="error")
+            raise
+
+        metrics.SNAPSHOT_OPERATIONS.inc(op="fetch", result="ok" if data is not None else "unchanged")
+        metrics.SNAPSHOT_AGE.set_function(self.snapshot.age)
+
+        if self.max_age and self.snapshot.age() > self.max_age:
+            raise SnapshotError(f"Snapshot from {self.snapshot.publisher} is {self.snapshot.age():.0f}s old, more than {self.max_age}s")
+
+        return self.snapshot
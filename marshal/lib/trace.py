@@ -0,0 +1,260 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+"""Module with lightweight per-scan tracing spans and timing reports"""
+
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import lib.config as config
+
+
+class Span:
+
+    __slots__ = ("name", "attributes", "start", "end", "children", "span_id", "parent_id", "error")
+
+    def __init__(self, name: str, attributes: dict, parent_id: str = None):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.children = []
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def to_tree(self) -> dict:
+        tree = {
+            "name" : self.name,
+            "start" : self.start,
+            "duration_ms" : round(self.duration * 1000, 3)
+        }
+        if self.attributes:
+            tree["attributes"] = self.attributes
+        if self.error is not None:
+            tree["error"] = self.error
+        if self.children:
+            tree["children"] = [c.to_tree() for c in list(self.children)]
+        return tree
+
+class Trace:
+
+    """Span tree of one scan. Phases ('laps') hang off the root span, spans
+    opened by worker threads attach to the current lap."""
+
+    def __init__(self, name: str, attributes: dict):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, attributes)
+        self.lap = None
+        self.lock = threading.Lock()
+
+    def add(self, parent: Span, name: str, attributes: dict) -> Span:
+        span = Span(name, attributes, parent.span_id)
+        with self.lock:
+            parent.children.append(span)
+        return span
+
+    def to_otlp(self) -> dict:
+
+        """Return the trace as an OTLP/JSON ExportTraceServiceRequest"""
+
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue" : v}
+            if isinstance(v, int):
+                return {"intValue" : str(v)}
+            if isinstance(v, float):
+                return {"doubleValue" : v}
+            return {"stringValue" : str(v)}
+
+        spans = []
+        for s in self.root.walk():
+            span = {
+                "traceId" : self.trace_id,
+                "spanId" : s.span_id,
+                "name" : s.name,
+                "kind" : 1,
+                "startTimeUnixNano" : str(int(s.start * 1e9)),
+                "endTimeUnixNano" : str(int((s.end or time.time()) * 1e9)),
+                "attributes" : [{"key" : k, "value" : value(v)} for k, v in s.attributes.items()],
+                "status" : {"code" : 2, "message" : s.error} if s.error is not None else {"code" : 1}
+            }
+            if s.parent_id is not None:
+                span["parentSpanId"] = s.parent_id
+            spans.append(span)
+
+        return {
+            "resourceSpans" : [{
+                "resource" : {"attributes" : [{"key" : "service.name", "value" : {"stringValue" : "sbps-marshal"}}]},
+                "scopeSpans" : [{"scope" : {"name" : "sbps-marshal"}, "spans" : spans}]
+            }]
+        }
+
+_active = None
+_local = threading.local()
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def begin_scan(name: str = "scan", **attributes) -> Trace:
+
+    """Start tracing a scan, ending any scan still open"""
+
+    global _active
+    if _active is not None:
+        end_scan()
+    if not config.KV['TRACE_OUTPUT']:
+        return None
+    _active = Trace(name, attributes)
+    return _active
+
+def end_scan(error: str = None) -> Trace:
+
+    """Finish the current scan trace and export it"""
+
+    global _active
+    trace, _active = _active, None
+    if trace is None:
+        return None
+
+    lap(None, trace)
+    trace.root.end = time.time()
+    trace.root.error = error
+    _stack().clear()
+
+    try:
+        export(trace)
+    except Exception as err:
+        logging.warning(f"Unable to export scan trace, received -> {str(err)}")
+
+    return trace
+
+def lap(name: str, trace: Trace = None):
+
+    """End the current phase span and, unless name is None, start the next"""
+
+    trace = trace or _active
+    if trace is None:
+        return
+    if trace.lap is not None:
+        trace.lap.end = time.time()
+        trace.lap = None
+    if name is not None:
+        trace.lap = trace.add(trace.root, name, {})
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+
+    """Time a block as a child of the innermost open span"""
+
+    trace = _active
+    if trace is None:
+        yield None
+        return
+
+    stack = _stack()
+    parent = stack[-1] if stack else (trace.lap or trace.root)
+    s = trace.add(parent, name, attributes)
+    stack.append(s)
+
+    try:
+        yield s
+    except Exception as err:
+        s.error = f"{type(err).__name__}: {str(err)}"
+        raise
+    finally:
+        s.end = time.time()
+        stack.pop()
+
+def traced(name: str, *arguments):
+
+    """Decorator wrapping calls in a span, recording the named arguments as
+    span attributes"""
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            attributes = dict()
+            if arguments:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                attributes = { a : bound[a] for a in arguments if a in bound and bound[a] is not None }
+            with span(name, **attributes):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def export(trace: Trace):
+
+    """Write a trace where TRACE_OUTPUT points: 'log' logs the phases and the
+    slowest calls, a directory receives one JSON file per scan (a timing
+    tree, or OTLP/JSON when TRACE_FORMAT is 'otlp')"""
+
+    output = config.KV['TRACE_OUTPUT']
+
+    if output == "log":
+        phases = ", ".join([f"{c.name}={c.duration:.3f}s" for c in trace.root.children])
+        logging.info(f"Scan timing {trace.root.duration:.3f}s: {phases}")
+        leaves = [s for s in trace.root.walk() if not s.children and s.parent_id is not None]
+        for s in sorted(leaves, key=lambda s: s.duration, reverse=True)[:10]:
+            logging.info(f"Slow call {s.name} {s.duration:.3f}s {s.attributes}{' error: ' + s.error if s.error else ''}")
+        return
+
+    os.makedirs(output, exist_ok=True)
+
+    if config.KV['TRACE_FORMAT'] == "otlp":
+        document = trace.to_otlp()
+    else:
+        document = dict(trace.root.to_tree(), trace_id=trace.trace_id)
+
+    file_path = os.path.join(output, f"scan-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(trace.root.start))}-{trace.trace_id[:8]}.json")
+    with open(file_path, 'w') as f:
+        json.dump(document, f, default=str)
+
+    # Keep only the most recent TRACE_KEEP scans
+
+    scans = sorted([f for f in os.listdir(output) if f.startswith("scan-") and f.endswith(".json")])
+    for old in scans[:max(0, len(scans) - config.KV['TRACE_KEEP'])]:
+        os.remove(os.path.join(output, old))
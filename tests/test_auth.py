@@ -0,0 +1,152 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""SPIRE JWT-SVID caching and refresh"""
+
+import base64
+import json
+import threading
+import pytest
+import lib.auth as auth
+
+
+def jwt(claims: dict) -> str:
+    def b64(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+    return f"{b64({ 'alg' : 'none' })}.{b64(claims)}.signature"
+
+class Spire:
+
+    """Stand-in for the spire-agent CLI, issuing SVIDs valid for lifetime
+    seconds from the (fake) current time"""
+
+    def __init__(self, clock, lifetime: float = 300):
+        self.clock = clock
+        self.lifetime = lifetime
+        self.issued = 0
+        self.failing = False
+        self.fetched = threading.Event()
+
+    def fetch(self) -> str:
+        if self.failing:
+            raise RuntimeError("spire-agent is not running")
+        self.issued += 1
+        self.fetched.set()
+        return jwt({ "sub" : "spiffe://shasta/ncn/workload/sbps-marshal", "n" : self.issued,
+                     "exp" : self.clock.now + self.lifetime })
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(auth.time, "time", c.time)
+    return c
+
+def test_jwt_expiry():
+    assert auth.jwt_expiry(jwt({ "exp" : 1700000300 })) == 1700000300
+    assert auth.jwt_expiry(jwt({ "sub" : "x" })) is None
+
+    # Any payload length, base64url padding is restored
+
+    for n in range(4):
+        assert auth.jwt_expiry(jwt({ "sub" : "x" * n, "exp" : 5 })) == 5
+
+def test_jwt_expiry_malformed():
+    for token in ["", "not a jwt", "a.!!!.c", "a." + base64.urlsafe_b64encode(b"[]").decode() + ".c"]:
+        with pytest.raises(Exception):
+            auth.jwt_expiry(token)
+
+def test_cached_until_refresh_margin(clock):
+    spire = Spire(clock)
+    svids = auth.SvidProvider(spire.fetch, refresh_margin=60)
+
+    token = svids.get()
+    clock.now += 239
+    assert svids.get() == token
+    assert spire.issued == 1
+
+    # Within refresh_margin of expiry the SVID is fetched again, even though
+    # it has not expired yet
+
+    clock.now += 1
+    assert svids.get() != token
+    assert spire.issued == 2
+    svids._schedule(0)
+
+def test_failed_background_refresh(clock):
+    spire = Spire(clock)
+    svids = auth.SvidProvider(spire.fetch, refresh_margin=60)
+    token = svids.get()
+
+    spire.failing = True
+    clock.now += 240
+    svids._background_refresh()
+    assert svids.token == token
+
+    # Never hand out the nearly expired SVID, fail instead
+
+    with pytest.raises(RuntimeError):
+        svids.get()
+
+    spire.failing = False
+    assert svids.get() != token
+    svids._schedule(0)
+
+def test_background_refresh():
+    clock = Clock()
+    clock.now = auth.time.time()
+    spire = Spire(clock, lifetime=60.2)
+    svids = auth.SvidProvider(spire.fetch, refresh_margin=60)
+
+    svids.get()
+    spire.fetched.clear()
+    assert spire.fetched.wait(5)
+    assert spire.issued == 2
+    svids._schedule(0)
+
+def test_invalidate(clock):
+    spire = Spire(clock)
+    svids = auth.SvidProvider(spire.fetch, refresh_margin=60)
+
+    token = svids.get()
+    svids.invalidate()
+    assert svids.get() != token
+    assert spire.issued == 2
+    svids._schedule(0)
+
+def test_svid_without_expiry_is_not_cached(clock):
+    issued = []
+    svids = auth.SvidProvider(lambda: issued.append(1) or jwt({ "sub" : "x" }), refresh_margin=60)
+    svids.get()
+    svids.get()
+    assert len(issued) == 2
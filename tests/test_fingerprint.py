@@ -0,0 +1,139 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Skipping reconciliation when the scan inputs are unchanged"""
+
+import types
+import bin.agent as agent
+import lib.auth as auth
+import lib.cache as cache
+import lib.fingerprint as fingerprint
+import lib.lio as lio
+import lib.planner as planner
+
+
+IQN = "iqn.2023-06.csm.iscsi:ncn-w001"
+
+S3_INDEX = {
+    "PE/a.squashfs" : types.SimpleNamespace(key="PE/a.squashfs", size=4096, etag="a"),
+    "0f6a/rootfs" : types.SimpleNamespace(key="0f6a/rootfs", size=8192, etag="r"),
+}
+
+IMS_IMAGES = [ { "id" : "0f6a", "link" : { "path" : "s3://boot-images/0f6a/manifest.json", "etag" : "m" } } ]
+
+def inputs(s3_index: dict = S3_INDEX, ims_images: list = IMS_IMAGES,
+           tagging: bool = False, mode: str = "full") -> list:
+    return [ fingerprint.s3_index_digest(s3_index),
+             fingerprint.ims_images_digest(ims_images),
+             tagging,
+             mode ]
+
+def test_unchanged_fingerprint_skips():
+    fingerprints = fingerprint.ScanFingerprints(900)
+    d = fingerprint.digest(inputs(), "0")
+
+    assert not fingerprints.unchanged(d)
+    fingerprints.record(d)
+    assert fingerprints.unchanged(d)
+    assert fingerprints.unchanged(fingerprint.digest(inputs(), "0"))
+    assert fingerprints.stats == { "skipped" : 2, "full" : 1 }
+
+def test_any_input_change_forces_full_scan():
+    fingerprints = fingerprint.ScanFingerprints(900)
+    fingerprints.record(fingerprint.digest(inputs(), "0"))
+
+    resized = dict(S3_INDEX, **{ "0f6a/rootfs" : types.SimpleNamespace(key="0f6a/rootfs", size=4096, etag="r") })
+    retagged = dict(S3_INDEX, **{ "0f6a/rootfs" : types.SimpleNamespace(key="0f6a/rootfs", size=8192, etag="s") })
+    removed = { "PE/a.squashfs" : S3_INDEX["PE/a.squashfs"] }
+    images = [ dict(IMS_IMAGES[0], link=dict(IMS_IMAGES[0]["link"], etag="n")) ]
+
+    changed = [ fingerprint.digest(inputs(resized), "0"),
+                fingerprint.digest(inputs(retagged), "0"),
+                fingerprint.digest(inputs(removed), "0"),
+                fingerprint.digest(inputs(ims_images=images), "0"),
+                fingerprint.digest(inputs(ims_images=[]), "0"),
+                fingerprint.digest(inputs(tagging=True), "0"),
+                fingerprint.digest(inputs(mode="scoped"), "0"),
+                fingerprint.digest(inputs(), "1") ]
+
+    assert [fingerprints.unchanged(d) for d in changed] == [False] * len(changed)
+
+def test_full_scan_interval(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(fingerprint.time, "monotonic", lambda: now[0])
+
+    fingerprints = fingerprint.ScanFingerprints(900)
+    d = fingerprint.digest(inputs(), "0")
+    fingerprints.record(d)
+    now[0] += 899
+    assert fingerprints.unchanged(d)
+    now[0] += 1
+    assert not fingerprints.unchanged(d)
+
+    never = fingerprint.ScanFingerprints(0)
+    never.record(d)
+    assert not never.unchanged(d)
+
+def new_agent(backend: lio.LioBackend) -> agent.Agent:
+    return agent.Agent("ncn-w001",
+                       backend=backend,
+                       s3_clients=types.SimpleNamespace(get=lambda: None),
+                       ims_client=types.SimpleNamespace(),
+                       svids=auth.SvidProvider(fetch=lambda: None),
+                       manifest_cache=cache.ManifestCache(16),
+                       target_service=types.SimpleNamespace(ensure_active=lambda: None, invalidate=lambda: None),
+                       label_watcher=types.SimpleNamespace(labelled=True),
+                       isfile=lambda path: True)
+
+def apply(a: agent.Agent, complete: bool, iqn: str = IQN):
+    p = planner.Projection(product="3c6e1f0b7d2a9e4", wwn="3c6e1f0b7d2a9e41b5f8c0d6e2a7f93",
+                           dev="/var/lib/cps-local/boot-images/PE/a.squashfs", size=0,
+                           s3_path="s3://boot-images/PE/a.squashfs", etag=None)
+    fileio_backstores = list(lio.extract_fileio_backstores(a.backend.load_config()))
+    return a._apply([p], complete, { p.dev : True }, inputs(), fileio_backstores, iqn)
+
+def test_complete_scan_is_recorded():
+    a = new_agent(lio.FakeBackend(iqn=IQN))
+    apply(a, complete=True)
+    assert a.fingerprints.unchanged(fingerprint.digest(inputs(), a.backend.state_token()))
+
+def test_incomplete_scan_is_not_recorded():
+
+    # e.g., some manifests could not be fetched
+
+    a = new_agent(lio.FakeBackend(iqn=IQN))
+    a.fingerprints.record("previous")
+    apply(a, complete=False)
+    assert a.fingerprints.last is None
+
+def test_failed_operations_are_not_recorded():
+
+    # The LUN cannot be created without the target
+
+    a = new_agent(lio.FakeBackend(iqn=IQN))
+    apply(a, complete=True, iqn="iqn.2023-06.csm.iscsi:other")
+    assert a.fingerprints.last is None
+    assert not a.fingerprints.unchanged(fingerprint.digest(inputs(), a.backend.state_token()))
@@ -0,0 +1,140 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""Streaming IMS image list parser, and the server side image query"""
+
+import http.server
+import json
+import threading
+import urllib.parse
+import pytest
+import lib.ims as ims
+
+
+def chunked(text: str, size: int) -> list:
+    data = text.encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_iter_json_array(size):
+    text = ' [ {"id": "a", "name": "x,]"} ,{"id": "b"}\n] '
+    assert list(ims.iter_json_array(chunked(text, size))) == [ { "id" : "a", "name" : "x,]" }, { "id" : "b" } ]
+    assert list(ims.iter_json_array(chunked("[]", size))) == []
+
+@pytest.mark.parametrize("text", [
+    '[{"id": "a"},,,{"id": "b"}]',
+    '[{"id": "a"},]',
+    '[,{"id": "a"}]',
+    '[{"id": "a"} {"id": "b"}]',
+    '[{"id": "a"}',
+    '{"id": "a"}',
+])
+@pytest.mark.parametrize("size", [1, 4096])
+def test_iter_json_array_malformed(text, size):
+    with pytest.raises(ValueError):
+        list(ims.iter_json_array(chunked(text, size)))
+
+def image(n: int, tag: str = None) -> dict:
+    i = { "id" : f"img-{n}", "link" : { "path" : f"s3://boot-images/img-{n}/manifest.json", "etag" : str(n) } }
+    i["metadata"] = { "sbps-project" : tag } if tag is not None else {}
+    return i
+
+IMAGES = [ image(0, "true"), image(1), image(2, "false"), image(3, "true") ]
+
+class StubImsServer(http.server.ThreadingHTTPServer):
+
+    """IMS image listing. query is how the server treats metadata.sbps-project:
+    'filter', 'ignore', 'reject' (400) or 'wrong' (drops a tagged image)"""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), StubImsHandler)
+
+class StubImsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        self.server.requests.append(params)
+
+        images = IMAGES
+        if "metadata.sbps-project" in params:
+            if self.server.query == "reject":
+                self.send_response(400)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if self.server.query == "filter":
+                images = [ i for i in IMAGES if i["metadata"].get("sbps-project") == params["metadata.sbps-project"] ]
+            elif self.server.query == "wrong":
+                images = IMAGES[:1]
+
+        body = json.dumps(images).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def ims_server(request):
+    server = StubImsServer(request.param)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def client(server) -> ims.ImsClient:
+    return ims.ImsClient(f"http://127.0.0.1:{server.server_address[1]}/apis/ims/v3/images",
+                         params={ "metadata.sbps-project" : "true" },
+                         matches=ims.is_marked_for_projection)
+
+def ids(images) -> list:
+    return [ i["id"] for i in images ]
+
+@pytest.mark.parametrize("ims_server", ["filter"], indirect=True)
+def test_query_applied(ims_server):
+    c = client(ims_server)
+    assert ids(c.images("token")) == ids(IMAGES)
+    assert c.filtering is True
+    assert ids(c.images("token")) == ["img-0", "img-3"]
+    assert [r.get("metadata.sbps-project") for r in ims_server.requests] == [None, "true", "true"]
+
+@pytest.mark.parametrize("ims_server", ["ignore", "reject", "wrong"], indirect=True)
+def test_query_not_applied(ims_server):
+    c = client(ims_server)
+    assert ids(c.images("token")) == ids(IMAGES)
+    assert c.filtering is False
+    assert ids(c.images("token")) == ids(IMAGES)
+    assert ims_server.requests[-1] == {}
+
+@pytest.mark.parametrize("ims_server", ["filter"], indirect=True)
+def test_query_without_matches_is_trusted(ims_server):
+    c = ims.ImsClient(f"http://127.0.0.1:{ims_server.server_address[1]}/apis/ims/v3/images",
+                      params={ "metadata.sbps-project" : "true" })
+    assert ids(c.images("token")) == ["img-0", "img-3"]
+    assert len(ims_server.requests) == 1
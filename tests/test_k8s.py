@@ -0,0 +1,126 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""NodeLabelWatcher against a stub API server"""
+
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import lib.k8s as k8s
+
+
+def node(labels: dict) -> dict:
+    return { "metadata" : { "name" : "ncn-w001", "labels" : labels } }
+
+class StubApiServer(http.server.ThreadingHTTPServer):
+
+    """Serve scripted node lists and watch streams in order, repeating
+    the last list and ending further watches at once"""
+
+    def __init__(self, lists: list, watches: list):
+        super().__init__(("127.0.0.1", 0), StubApiHandler)
+        self.lists = list(lists)
+        self.watches = list(watches)
+        self.requests = []
+
+class StubApiHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        self.server.requests.append(params)
+
+        if params.get("watch") == "true":
+            events = self.server.watches.pop(0) if self.server.watches else []
+            body = "".join([json.dumps(e) + "\n" for e in events])
+            if not events:
+                time.sleep(0.2)
+        else:
+            items, resource_version = self.server.lists[0]
+            if len(self.server.lists) > 1:
+                self.server.lists.pop(0)
+            body = json.dumps({ "items" : items, "metadata" : { "resourceVersion" : resource_version } })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_list_watch_relist_and_delete():
+    server = StubApiServer(
+        lists=[ ([node({ "iscsi" : "sbps" })], "1"),
+                ([node({ "iscsi" : "sbps" })], "5"),
+                ([], "9") ],
+        watches=[ [ { "type" : "MODIFIED", "object" : node({}) },
+                    { "type" : "ERROR", "object" : { "kind" : "Status", "code" : 410, "message" : "too old resource version" } } ],
+                  [ { "type" : "BOOKMARK", "object" : { "metadata" : { "resourceVersion" : "7" } } },
+                    { "type" : "DELETED", "object" : node({ "iscsi" : "sbps" }) } ] ])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    changes = []
+    watcher = k8s.NodeLabelWatcher(k8s.KubeApi(f"http://127.0.0.1:{server.server_address[1]}"),
+                                   "ncn-w001", on_change=changes.append, resync=5, timeout=5)
+    try:
+        assert watcher.labelled is None
+        watcher.start()
+
+        # list (labelled), MODIFIED (label removed), ERROR then relist
+        # (labelled again), DELETED (node gone)
+
+        assert wait_for(lambda: len(changes) >= 3)
+        assert changes[:3] == [False, True, False]
+        assert watcher.labelled is False
+
+        lists = [r for r in server.requests if "watch" not in r]
+        watches = [r for r in server.requests if r.get("watch") == "true"]
+        assert lists[0] == { "labelSelector" : "kubernetes.io/hostname=ncn-w001" }
+        assert [w["resourceVersion"] for w in watches[:2]] == ["1", "5"]
+    finally:
+        watcher.stop()
+        server.shutdown()
+
+def test_unreachable_api_server_is_unknown():
+    watcher = k8s.NodeLabelWatcher(k8s.KubeApi("http://127.0.0.1:9"), "ncn-w001", timeout=1)
+    watcher.start()
+    try:
+        time.sleep(0.5)
+        assert watcher.labelled is None
+    finally:
+        watcher.stop()
@@ -0,0 +1,159 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""LIO state parsing and verification of targetcli batches"""
+
+import copy
+import json
+import os
+import sys
+import types
+import pytest
+import bin.agent as agent
+import lib.config as config
+import lib.lio as lio
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+IQN = "iqn.2023-06.csm.iscsi:ncn-w001"
+
+SAVECONFIG = {
+    "storage_objects" : [
+        { "plugin" : "fileio", "name" : "3c6e1f0b7d2a9e4", "dev" : "/var/lib/cps-local/boot-images/PE/a.squashfs",
+          "size" : 4096, "wwn" : "3c6e1f0b7d2a9e41b5f8c0d6e2a7f93", "write_back" : False }
+    ],
+    "targets" : [
+        { "fabric" : "iscsi", "wwn" : IQN,
+          "tpgs" : [ { "tag" : 1, "enable" : True,
+                       "luns" : [ { "index" : 0, "storage_object" : "/backstores/fileio/3c6e1f0b7d2a9e4" } ] } ] }
+    ]
+}
+
+def resize(size: int) -> list:
+    txn = lio.Transaction(lio.FakeBackend())
+    txn.delete_fileio_backstore("3c6e1f0b7d2a9e4")
+    txn.create_fileio_backstore("3c6e1f0b7d2a9e4", "/var/lib/cps-local/boot-images/PE/a.squashfs",
+                                "3c6e1f0b7d2a9e41b5f8c0d6e2a7f93", size)
+    txn.create_lun("3c6e1f0b7d2a9e4", IQN)
+    return txn.operations
+
+def test_verify_applied_resize():
+    saved = copy.deepcopy(SAVECONFIG)
+    saved["storage_objects"][0]["size"] = 8192
+    operations = resize(8192)
+    lio._verify_operations(operations, saved)
+    assert [o["error"] for o in operations] == [None, None, None]
+
+def test_verify_resize_with_failed_delete():
+
+    # The delete failed, so did the create (name taken): the old backstore
+    # is still there under the same name
+
+    operations = resize(8192)
+    lio._verify_operations(operations, SAVECONFIG, 1)
+    assert all([o["error"] is not None for o in operations])
+    assert "size is 4096 instead of 8192" in operations[1]["error"]
+
+def test_verify_create_over_other_dev():
+    txn = lio.Transaction(lio.FakeBackend())
+    txn.create_fileio_backstore("3c6e1f0b7d2a9e4", "/var/lib/cps-local/boot-images/PE/b.squashfs",
+                                "3c6e1f0b7d2a9e41b5f8c0d6e2a7f93")
+    lio._verify_operations(txn.operations, SAVECONFIG, 1)
+    assert "dev is /var/lib/cps-local/boot-images/PE/a.squashfs" in txn.operations[0]["error"]
+
+def test_verify_delete():
+    txn = lio.Transaction(lio.FakeBackend())
+    txn.delete_fileio_backstore("3c6e1f0b7d2a9e4")
+    lio._verify_operations(txn.operations, SAVECONFIG, 1)
+    assert txn.operations[0]["error"] is not None
+
+    empty = { "storage_objects" : [], "targets" : copy.deepcopy(SAVECONFIG["targets"]) }
+    empty["targets"][0]["tpgs"][0]["luns"] = []
+    txn.operations[0]["error"] = None
+    lio._verify_operations(txn.operations, empty)
+    assert txn.operations[0]["error"] is None
+
+def test_read_configfs_matches_saveconfig():
+
+    # fixtures/configfs is the live tree for the LIO state in
+    # fixtures/saveconfig.json
+
+    live = lio.read_configfs(os.path.join(FIXTURES, "configfs"))
+    with open(os.path.join(FIXTURES, "saveconfig.json"), 'r') as f:
+        saved = json.load(f)
+
+    assert list(lio.extract_fileio_backstores(live)) == list(lio.extract_fileio_backstores(saved))
+    assert list(lio.extract_fileio_target_luns(live)) == list(lio.extract_fileio_target_luns(saved))
+    assert lio.get_lio_target_iqn(live) == lio.get_lio_target_iqn(saved)
+    assert [b["write_back"] for b in live["storage_objects"]] == [b["write_back"] for b in saved["storage_objects"]]
+
+def test_read_configfs_without_info_uses_udev_path(tmp_path):
+    so_path = tmp_path / "core" / "fileio_1" / "b0"
+    (so_path / "wwn").mkdir(parents=True)
+    (so_path / "udev_path").write_text("/mnt/s3fs/b0/rootfs\n")
+    (so_path / "wwn" / "vpd_unit_serial").write_text("T10 VPD Unit Serial Number: abc\n")
+
+    assert list(lio.extract_fileio_backstores(lio.read_configfs(str(tmp_path)))) == [
+        { "dev" : "/mnt/s3fs/b0/rootfs", "name" : "b0", "size" : 0, "wwn" : "abc" } ]
+
+def test_incomplete_backend_fails_at_construction():
+
+    class NoTargets(lio.LioBackend):
+
+        def load_config(self) -> dict:
+            return copy.deepcopy(SAVECONFIG)
+
+        def apply(self, operations: list):
+            pass
+
+    with pytest.raises(TypeError, match="enable_target"):
+        NoTargets()
+
+def test_rtslib_backend_without_rtslib(monkeypatch):
+    monkeypatch.setitem(sys.modules, "rtslib_fb", None)
+    with pytest.raises(ImportError, match="rtslib-fb"):
+        lio.get_backend("rtslib", IQN)
+
+def test_missing_iqn_names_configfs_root(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.KV, 'LIO_STATE_SOURCE', 'configfs')
+    monkeypatch.setitem(config.KV, 'LIO_CONFIGFS_ROOT', str(tmp_path))
+    backend = lio.TargetcliBackend()
+    assert backend.source == str(tmp_path)
+
+    scan = types.SimpleNamespace(backend=backend)
+    phases = types.SimpleNamespace(start=lambda phase: None)
+    with pytest.raises(agent.ScanInputError, match=str(tmp_path)):
+        agent.Agent._lio_state(scan, phases)
+
+def test_missing_save_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.KV, 'LIO_STATE_SOURCE', 'saveconfig')
+    monkeypatch.setitem(config.KV, 'LIO_SAVE_FILE', str(tmp_path / "saveconfig.json"))
+
+    scan = types.SimpleNamespace(backend=lio.TargetcliBackend())
+    phases = types.SimpleNamespace(start=lambda phase: None)
+    with pytest.raises(agent.ScanInputError, match="saveconfig.json"):
+        agent.Agent._lio_state(scan, phases)
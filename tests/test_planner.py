@@ -0,0 +1,113 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Reconciliation planning against literal backstores, without LIO"""
+
+import lib.lio as lio
+import lib.planner as planner
+
+
+IQN = "iqn.2023-06.csm.iscsi:ncn-w001"
+
+MOUNT = "/var/lib/cps-local/boot-images"
+
+def projection(product: str, key: str, size: int = 4096, etag: str = None) -> planner.Projection:
+    return planner.Projection(product=product, wwn=product + "0" * 16, dev=MOUNT + "/" + key,
+                              size=size, s3_path="s3://boot-images/" + key, etag=etag)
+
+def backstore(p: planner.Projection) -> dict:
+    return { "name" : p.product, "dev" : p.dev, "wwn" : p.wwn, "size" : p.size }
+
+def present(*devs):
+    return lambda dev: dev in devs
+
+def names(items: list) -> list:
+    return [i["name"] if isinstance(i, dict) else i.product for i in items]
+
+def test_unchanged():
+    a = projection("a", "PE/a.squashfs")
+    plan = planner.build_plan([a], [backstore(a)], present(a.dev))
+    assert len(plan) == 0
+
+def test_missing_dev_is_deleted_and_not_recreated():
+    a = projection("a", "PE/a.squashfs")
+    plan = planner.build_plan([a], [backstore(a)], present())
+    assert names(plan.delete) == ["a"]
+    assert plan.add == [] and plan.resize == []
+
+def test_unknown_existence_is_left_alone():
+
+    # s3fs did not answer: keep what is there, do not add anything new
+
+    a = projection("a", "PE/a.squashfs")
+    b = projection("b", "PE/b.squashfs")
+    plan = planner.build_plan([a, b], [backstore(a)], lambda dev: None)
+    assert len(plan) == 0
+
+def test_previous_etag_is_deleted_before_add():
+    old = projection("old", "0f6a/rootfs", etag="1")
+    new = projection("new", "0f6a/rootfs", etag="2")
+    plan = planner.build_plan([new], [backstore(old)], present(new.dev), prune=False)
+    assert names(plan.delete) == ["old"]
+    assert names(plan.add) == ["new"]
+
+def test_drift_is_resized():
+    a = projection("a", "PE/a.squashfs")
+    b = projection("b", "PE/b.squashfs")
+    drifted = [dict(backstore(a), size=1024), dict(backstore(b), wwn="f" * 32)]
+    plan = planner.build_plan([a, b], drifted, present(a.dev, b.dev))
+    assert names(plan.resize) == ["a", "b"]
+    assert plan.delete == [] and plan.add == []
+
+def test_prune():
+    a = projection("a", "PE/a.squashfs")
+    b = projection("b", "PE/b.squashfs")
+    backstores = [backstore(a), backstore(b)]
+    exists = present(a.dev, b.dev)
+    assert len(planner.build_plan([a], backstores, exists, prune=False)) == 0
+    assert names(planner.build_plan([a], backstores, exists).delete) == ["b"]
+
+def test_queue_deletes_first():
+    a = projection("a", "PE/a.squashfs")
+    b = projection("b", "PE/b.squashfs")
+    c = projection("c", "PE/c.squashfs")
+    plan = planner.Plan()
+    plan.add.append(a)
+    plan.resize.append(b)
+    plan.delete.append(backstore(c))
+
+    txn = lio.Transaction(lio.FakeBackend())
+    plan.queue(txn, IQN)
+
+    assert [(o["op"], o["name"]) for o in txn.operations] == [
+        ("delete_fileio_backstore", "c"),
+        ("delete_fileio_backstore", "b"),
+        ("create_fileio_backstore", "b"),
+        ("create_lun", "b"),
+        ("create_fileio_backstore", "a"),
+        ("create_lun", "a"),
+    ]
+    assert txn.operations[2]["expect"]["size"] == 4096
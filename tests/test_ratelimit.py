@@ -0,0 +1,212 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Client-side rate limits, request budgets and server throttling"""
+
+import email.utils
+import http.server
+import threading
+import time
+import pytest
+import lib.ratelimit as ratelimit
+import lib.s3 as s3
+
+
+class Clock:
+
+    """Stand-in for time.monotonic and time.sleep, sleeping advances it"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", c.monotonic)
+    monkeypatch.setattr(ratelimit.time, "sleep", c.sleep)
+    return c
+
+def test_token_bucket(clock):
+    bucket = ratelimit.TokenBucket(rate=2, burst=2)
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0.5, 0.5]
+    clock.now += 10
+    assert bucket.acquire() == 0
+
+def test_token_bucket_disabled(clock):
+    bucket = ratelimit.TokenBucket(rate=0)
+    assert sum([bucket.acquire() for _ in range(100)]) == 0
+    assert clock.slept == []
+
+def test_budget(clock):
+    limiter = ratelimit.Limiter("s3", budget=3)
+    for _ in range(3):
+        limiter.acquire()
+    with pytest.raises(ratelimit.BudgetExceeded):
+        limiter.acquire()
+
+    limiter.begin_scan()
+    limiter.acquire()
+    assert limiter.used == 1
+
+def test_no_budget(clock):
+    limiter = ratelimit.Limiter("s3")
+    for _ in range(1000):
+        limiter.acquire()
+    assert clock.slept == []
+
+def test_backoff_pauses_acquire(clock):
+    limiter = ratelimit.Limiter("s3")
+    limiter.backoff(5)
+    limiter.acquire()
+    assert clock.slept == [5]
+
+    # The pause is over, and a shorter backoff does not cut a longer one
+
+    limiter.acquire()
+    limiter.backoff(10)
+    limiter.backoff(2)
+    clock.now += 4
+    limiter.acquire()
+    assert clock.slept == [5, 6]
+
+def test_retry_after_seconds():
+    assert ratelimit.retry_after("7") == 7
+    assert ratelimit.retry_after("1.5") == 1.5
+    assert ratelimit.retry_after("-3") == 0
+
+def test_retry_after_http_date():
+    value = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= ratelimit.retry_after(value) <= 30
+    assert ratelimit.retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+def test_retry_after_fallback():
+    assert ratelimit.retry_after(None, 3) == 3
+    assert ratelimit.retry_after("", 3) == 3
+    assert ratelimit.retry_after("soon", 3) == 3
+    assert ratelimit.retry_after("soon") is None
+
+LIST_BUCKET = b'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">' \
+              b'<Name>boot-images</Name><KeyCount>0</KeyCount><IsTruncated>false</IsTruncated></ListBucketResult>'
+
+SLOW_DOWN = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'
+
+class StubS3Server(http.server.ThreadingHTTPServer):
+
+    """Answers the first throttled requests with 503 SlowDown, optionally
+    with a Retry-After header, then lists an empty bucket"""
+
+    def __init__(self, throttled: int, retry_after: str = None):
+        self.throttled = throttled
+        self.retry_after = retry_after
+        self.requests = 0
+        super().__init__(("127.0.0.1", 0), StubS3Handler)
+
+class StubS3Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests <= self.server.throttled:
+            self.send_response(503)
+            if self.server.retry_after is not None:
+                self.send_header("Retry-After", self.server.retry_after)
+            body = SLOW_DOWN
+        else:
+            self.send_response(200)
+            body = LIST_BUCKET
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def s3_server(request):
+    server = StubS3Server(*request.param)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def throttled_client(server, monkeypatch, max_attempts: int = 5):
+
+    """An S3 client against server, recording the seconds slept"""
+
+    slept = []
+    sleep = time.sleep
+    monkeypatch.setattr(time, "sleep", lambda seconds: slept.append(seconds) or sleep(seconds))
+    limiter = ratelimit.Limiter("s3")
+    client = s3.get_s3_client(f"http://127.0.0.1:{server.server_address[1]}", "key", "secret",
+                              limiter=limiter, max_attempts=max_attempts)
+    return client, limiter, slept
+
+@pytest.mark.parametrize("s3_server", [(2, "0.2")], indirect=True)
+def test_s3_honors_retry_after(s3_server, monkeypatch):
+    client, limiter, slept = throttled_client(s3_server, monkeypatch)
+    before = time.monotonic()
+
+    assert s3.list_bucket_objects(client, "boot-images") == {}
+    assert s3_server.requests == 3
+    assert slept == [0.2, 0.2]
+    assert limiter.used == 3
+    assert limiter.paused_until >= before + 0.4
+
+@pytest.mark.parametrize("s3_server", [(1, "600")], indirect=True)
+def test_s3_caps_retry_after(s3_server, monkeypatch):
+    monkeypatch.setattr(s3, "MAX_THROTTLE_DELAY", 0.1)
+    client, limiter, slept = throttled_client(s3_server, monkeypatch)
+    s3.list_bucket_objects(client, "boot-images")
+    assert slept == [0.1]
+
+@pytest.mark.parametrize("s3_server", [(2, None)], indirect=True)
+def test_s3_backs_off_without_retry_after(s3_server, monkeypatch):
+    monkeypatch.setattr(s3.random, "uniform", lambda a, b: 0.05)
+    client, limiter, slept = throttled_client(s3_server, monkeypatch)
+    s3.list_bucket_objects(client, "boot-images")
+    assert slept == [0.1, 0.2]
+
+@pytest.mark.parametrize("s3_server", [(10, "0")], indirect=True)
+def test_s3_gives_up_after_max_attempts(s3_server, monkeypatch):
+    client, limiter, slept = throttled_client(s3_server, monkeypatch, max_attempts=3)
+    with pytest.raises(Exception, match="SlowDown"):
+        s3.list_bucket_objects(client, "boot-images")
+    assert s3_server.requests == 3
+
+@pytest.mark.parametrize("s3_server", [(10, "0")], indirect=True)
+def test_s3_budget(s3_server, monkeypatch):
+    client, limiter, slept = throttled_client(s3_server, monkeypatch)
+    limiter.budget = 2
+    with pytest.raises(ratelimit.BudgetExceeded):
+        s3.list_bucket_objects(client, "boot-images")
+    assert s3_server.requests == 2
@@ -0,0 +1,80 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Replays use what was recorded, never the node they run on"""
+
+import os
+import lib.config as config
+import lib.lio as lio
+import lib.recording as recording
+
+
+IQN = "iqn.2023-06.csm.iscsi:ncn-w001"
+
+def create(backend: lio.LioBackend, dev: str) -> list:
+    txn = backend.transaction()
+    txn.create_fileio_backstore("3c6e1f0b7d2a9e4", dev, "3c6e1f0b7d2a9e41b5f8c0d6e2a7f93")
+    txn.create_lun("3c6e1f0b7d2a9e4", IQN)
+    return txn.commit()
+
+def test_replay_uses_recorded_sizes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "KV", dict(config.KV))
+
+    dev = tmp_path / "s3fs" / "PE" / "a.squashfs"
+    dev.parent.mkdir(parents=True)
+    dev.write_bytes(b"\0" * 4096)
+
+    recorder = recording.Recorder(str(tmp_path / "recording"))
+    backend = recorder.backend(lio.FakeBackend(iqn=IQN))
+    backend.load_config()
+    create(backend, str(dev))
+    recorder.save("ncn-w001")
+
+    assert recorder.sizes == { str(dev) : 4096 }
+
+    # The replay host has no such file, and must not look for one
+
+    dev.unlink()
+    def stat(path):
+        raise AssertionError(f"replay looked at {path}")
+    monkeypatch.setattr(lio.os.path, "isfile", stat)
+    monkeypatch.setattr(lio.os.path, "getsize", stat)
+
+    stand_ins = recording.load(str(tmp_path / "recording"))
+    assert [o["error"] for o in create(stand_ins.backend, str(dev))] == [None, None]
+    assert [b["size"] for b in lio.extract_fileio_backstores(stand_ins.backend.load_config())] == [4096]
+
+def test_replay_without_recorded_sizes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "KV", dict(config.KV))
+
+    recorder = recording.Recorder(str(tmp_path / "recording"))
+    recorder.backend(lio.FakeBackend(iqn=IQN)).load_config()
+    recorder.save("ncn-w001")
+    os.unlink(tmp_path / "recording" / "sizes.json")
+
+    stand_ins = recording.load(str(tmp_path / "recording"))
+    create(stand_ins.backend, "/var/lib/cps-local/boot-images/PE/a.squashfs")
+    assert [b["size"] for b in lio.extract_fileio_backstores(stand_ins.backend.load_config())] == [0]
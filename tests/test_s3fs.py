@@ -0,0 +1,152 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""s3fs presence checks that answer unknown rather than hang or guess"""
+
+import errno
+import threading
+import time
+import bin.agent as agent
+import lib.lio as lio
+import lib.s3fs as s3fs
+
+
+IQN = "iqn.2023-06.csm.iscsi:ncn-w001"
+
+class Mount:
+
+    """Stand-in for the s3fs mount: answers from a dict, counts checks,
+    hangs on paths until released, raises for broken paths"""
+
+    def __init__(self, files: dict):
+        self.files = files
+        self.checks = []
+        self.hung = set()
+        self.broken = set()
+        self.release = threading.Event()
+
+    def isfile(self, path: str) -> bool:
+        self.checks.append(path)
+        if path in self.hung:
+            self.release.wait()
+        if path in self.broken:
+            raise OSError(errno.ENOTCONN, "Transport endpoint is not connected", path)
+        return self.files.get(path, False)
+
+def test_isfile(tmp_path):
+    (tmp_path / "rootfs").write_bytes(b"")
+    assert s3fs.isfile(str(tmp_path / "rootfs"))
+    assert not s3fs.isfile(str(tmp_path / "missing"))
+    assert not s3fs.isfile(str(tmp_path / "rootfs" / "below"))
+    assert not s3fs.isfile(str(tmp_path))
+
+def test_answers():
+    mount = Mount({ "/a" : True })
+    probe = s3fs.S3fsProbe(mount.isfile, workers=4, timeout=1)
+    assert probe.probe([("/a", "1"), ("/b", "2")]) == { "/a" : True, "/b" : False }
+
+def test_timeout_is_unknown():
+    mount = Mount({ "/a" : True, "/b" : True })
+    mount.hung.add("/b")
+    probe = s3fs.S3fsProbe(mount.isfile, workers=4, timeout=0.2)
+
+    try:
+        started = time.monotonic()
+        assert probe.probe([("/a", "1"), ("/b", "2")]) == { "/a" : True, "/b" : None }
+        assert time.monotonic() - started < 2
+        assert probe.stats["timeouts"] == 1
+
+        # Unknowns are not cached, but the hung stat is not submitted again
+
+        assert probe.probe([("/b", "2")]) == { "/b" : None }
+        assert mount.checks.count("/b") == 1
+    finally:
+        mount.release.set()
+
+    # Once the mount recovers the path is checked again
+
+    probe.inflight["/b"].result()
+    assert probe.probe([("/b", "2")]) == { "/b" : True }
+    assert mount.checks.count("/b") == 2
+
+def test_every_worker_stuck_is_unknown():
+    mount = Mount({ "/a" : True, "/b" : True })
+    mount.hung.add("/a")
+    probe = s3fs.S3fsProbe(mount.isfile, workers=1, timeout=0.2)
+
+    # /b never starts, the stall deadline gives up on it too
+
+    try:
+        assert probe.probe([("/a", "1"), ("/b", "2")]) == { "/a" : None, "/b" : None }
+    finally:
+        mount.release.set()
+
+def test_error_is_unknown():
+    mount = Mount({ "/a" : True })
+    mount.broken.add("/a")
+    probe = s3fs.S3fsProbe(mount.isfile, workers=4, timeout=1)
+    assert probe.probe([("/a", "1")]) == { "/a" : None }
+    assert probe.stats["errors"] == 1
+
+    mount.broken.clear()
+    assert probe.probe([("/a", "1")]) == { "/a" : True }
+
+def test_cache():
+    mount = Mount({ "/a" : True })
+    probe = s3fs.S3fsProbe(mount.isfile, workers=4, timeout=1, ttl=0.2)
+
+    assert probe.probe([("/a", "1"), ("/b", None)]) == { "/a" : True, "/b" : False }
+    assert probe.probe([("/a", "1"), ("/b", None)]) == { "/a" : True, "/b" : False }
+    assert mount.checks == ["/a", "/b"]
+    assert probe.stats["hits"] == 2
+
+    # A new etag is a new object, expired answers are checked again
+
+    probe.probe([("/a", "2")])
+    assert mount.checks == ["/a", "/b", "/a"]
+    time.sleep(0.3)
+    probe.probe([("/b", None)])
+    assert mount.checks == ["/a", "/b", "/a", "/b"]
+
+def test_hung_mount_does_not_delete_projections():
+    dev = "/var/lib/cps-local/boot-images/PE/a.squashfs"
+    backend = lio.FakeBackend(iqn=IQN)
+    backend._create_fileio_backstore("3c6e1f0b7d2a9e4", dev, "3c6e1f0b7d2a9e41b5f8c0d6e2a7f93")
+    backend._create_lun("3c6e1f0b7d2a9e4", IQN)
+    fileio_backstores = list(lio.extract_fileio_backstores(backend.load_config()))
+
+    mount = Mount({})
+    mount.hung.add(dev)
+    probe = s3fs.S3fsProbe(mount.isfile, workers=4, timeout=0.2)
+
+    try:
+        plan = agent.reconcile(backend, [], fileio_backstores, IQN, prune=True, probe=probe)
+    finally:
+        mount.release.set()
+
+    assert len(plan) == 0
+    assert backend.calls["delete_fileio_backstore"] == 0
+    assert len(list(lio.extract_fileio_backstores(backend.load_config()))) == 1
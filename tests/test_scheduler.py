@@ -0,0 +1,102 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Delays between scans: backoff, idle stretching, jitter and stagger"""
+
+import threading
+import lib.scheduler as sched
+
+
+def test_changed_scans_use_interval():
+    scheduler = sched.Scheduler(300, jitter=0)
+    assert [scheduler.success(True) for _ in range(3)] == [300, 300, 300]
+
+def test_idle_scans_stretch_to_idle_interval():
+    scheduler = sched.Scheduler(300, idle_interval=1500, jitter=0)
+    assert [scheduler.success(False) for _ in range(5)] == [300, 600, 1200, 1500, 1500]
+    assert scheduler.success(True) == 300
+
+def test_idle_interval_defaults_to_interval():
+    scheduler = sched.Scheduler(300, jitter=0)
+    assert [scheduler.success(False) for _ in range(3)] == [300, 300, 300]
+
+def test_cheap_retries():
+    scheduler = sched.Scheduler(300, retry_interval=10, jitter=0)
+    cheap = [scheduler.failure(cheap=True) for _ in range(sched.Scheduler.CHEAP_RETRIES)]
+    assert cheap == [10] * sched.Scheduler.CHEAP_RETRIES
+
+    # Then the cheap failures back off like any other
+
+    assert scheduler.failure(cheap=True) == 160
+    assert scheduler.failure(cheap=True) == 300
+
+def test_failure_backoff_is_capped_at_interval():
+    scheduler = sched.Scheduler(300, retry_interval=10, jitter=0)
+    assert [scheduler.failure() for _ in range(7)] == [20, 40, 80, 160, 300, 300, 300]
+
+    # A success resets the backoff
+
+    scheduler.success(True)
+    assert scheduler.failure() == 20
+    assert scheduler.failure(cheap=True) == 10
+
+def test_retry_interval_is_at_most_interval():
+    scheduler = sched.Scheduler(5, retry_interval=10, jitter=0)
+    assert scheduler.failure(cheap=True) == 5
+    assert scheduler.failure() == 5
+
+def test_jitter_bounds():
+    scheduler = sched.Scheduler(300, jitter=0.1)
+    delays = [scheduler.success(True) for _ in range(1000)]
+    assert all([270 <= d <= 330 for d in delays])
+    assert min(delays) < 280 and max(delays) > 320
+
+    scheduler = sched.Scheduler(300, retry_interval=10, jitter=0.1)
+    delays = [scheduler.failure() for _ in range(100)]
+    assert all([270 <= d <= 330 for d in delays[10:]])
+
+def test_stagger():
+    spread = 30
+    delays = [sched.Scheduler.stagger(f"ncn-w{i:03d}", spread) for i in range(100)]
+
+    assert delays == [sched.Scheduler.stagger(f"ncn-w{i:03d}", spread) for i in range(100)]
+    assert all([0 <= d < spread for d in delays])
+    assert len(set(delays)) == len(delays)
+    assert min(delays) < spread / 4 and max(delays) > spread * 3 / 4
+    assert sched.Scheduler.stagger("ncn-w001", 0) == 0
+
+def test_wake():
+    scheduler = sched.Scheduler(300)
+    threading.Timer(0.1, scheduler.wake, ["SIGUSR1"]).start()
+    assert scheduler.sleep(60) == "SIGUSR1"
+    assert scheduler.sleep(0.1) == "timer"
+
+def test_watch(tmp_path):
+    path = tmp_path / "credentials"
+    path.write_text("a")
+    scheduler = sched.Scheduler(300, watch_paths=[str(path)], poll_interval=0.05)
+    threading.Timer(0.1, path.write_text, ["bb"]).start()
+    assert scheduler.sleep(60) == "watch"
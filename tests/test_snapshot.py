@@ -0,0 +1,179 @@
+#
+#  MIT License
+#
+#  (C) Copyright 2023-2024 Hewlett Packard Enterprise Development LP
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+#  OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+#  ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+#  OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+"""Publishing and consuming projection snapshots"""
+
+import gzip
+import json
+import time
+import pytest
+import lib.planner as planner
+import lib.snapshot as snapshot
+
+
+MOUNT = "/var/lib/cps-local/boot-images"
+
+PROJECTIONS = [
+    planner.Projection(product="3c6e1f0b7d2a9e4", wwn="3c6e1f0b7d2a9e41b5f8c0d6e2a7f93",
+                       dev=MOUNT + "/PE/a.squashfs", size=4096,
+                       s3_path="s3://boot-images/PE/a.squashfs", etag=None),
+    planner.Projection(product="0d9b5e7c4a1f2e8", wwn="0d9b5e7c4a1f2e86c3a9d0b7e5f1a24",
+                       dev=MOUNT + "/0f6a/rootfs", size=8192,
+                       s3_path="s3://boot-images/0f6a/rootfs", etag="9e1c", image="0f6a"),
+]
+
+def tamper(data: bytes, change) -> bytes:
+    document = json.loads(gzip.decompress(data))
+    change(document)
+    return gzip.compress(json.dumps(document).encode('utf-8'))
+
+def test_round_trip():
+    published = snapshot.Snapshot.from_projections(PROJECTIONS, False, MOUNT, "ncn-w001")
+    decoded = snapshot.decode(snapshot.encode(published))
+
+    assert decoded.digest == published.digest
+    assert (decoded.complete, decoded.publisher, decoded.published) == (False, "ncn-w001", published.published)
+    assert sorted(decoded.projections(MOUNT)) == sorted(PROJECTIONS)
+
+    # Rows are relative to the mount, each node maps them onto its own
+
+    assert decoded.projections("/mnt")[0].dev == "/mnt/0f6a/rootfs"
+
+def test_digest_is_independent_of_order_and_publisher():
+    a = snapshot.Snapshot.from_projections(PROJECTIONS, True, MOUNT, "ncn-w001")
+    b = snapshot.Snapshot.from_projections(PROJECTIONS[::-1], True, MOUNT, "ncn-w002")
+    c = snapshot.Snapshot.from_projections(PROJECTIONS, False, MOUNT, "ncn-w001")
+    assert a.digest == b.digest
+    assert a.digest != c.digest
+
+@pytest.mark.parametrize("change", [
+    lambda d: d["projections"][0].__setitem__(3, 1024),
+    lambda d: d["projections"].pop(),
+    lambda d: d.__setitem__("complete", False),
+])
+def test_digest_mismatch(change):
+    data = snapshot.encode(snapshot.Snapshot.from_projections(PROJECTIONS, True, MOUNT, "ncn-w001"))
+    with pytest.raises(snapshot.SnapshotError, match="digest"):
+        snapshot.decode(tamper(data, change))
+
+@pytest.mark.parametrize("change", [
+    lambda d: d.__setitem__("version", snapshot.FORMAT_VERSION + 1),
+    lambda d: d["fields"].reverse(),
+])
+def test_unsupported_format(change):
+    data = snapshot.encode(snapshot.Snapshot.from_projections(PROJECTIONS, True, MOUNT, "ncn-w001"))
+    with pytest.raises(snapshot.SnapshotError, match="Unsupported"):
+        snapshot.decode(tamper(data, change))
+
+def test_unreadable():
+    data = snapshot.encode(snapshot.Snapshot.from_projections(PROJECTIONS, True, MOUNT, "ncn-w001"))
+    for bad in [b"", b"not gzip", data[:len(data) // 2]]:
+        with pytest.raises(snapshot.SnapshotError, match="Unreadable"):
+            snapshot.decode(bad)
+
+def publish(store, age: float = 0, projections: list = PROJECTIONS):
+    s = snapshot.Snapshot.from_projections(projections, True, MOUNT, "ncn-w001")
+    s.published -= age
+    store.write(snapshot.encode(s))
+    return s
+
+def test_consumer(tmp_path):
+    store = snapshot.FileStore(str(tmp_path / "snapshot.json.gz"))
+    published = publish(store)
+
+    consumer = snapshot.SnapshotConsumer(store, 300)
+    assert consumer.fetch().digest == published.digest
+
+    # Unchanged in the store: the snapshot is kept, not read again
+
+    token = consumer.token
+    assert consumer.fetch().digest == published.digest
+    assert consumer.token == token
+
+def test_consumer_refuses_stale_snapshot(tmp_path):
+    store = snapshot.FileStore(str(tmp_path / "snapshot.json.gz"))
+    publish(store, age=600)
+
+    with pytest.raises(snapshot.SnapshotError, match="old"):
+        snapshot.SnapshotConsumer(store, 300).fetch()
+
+    # 0 accepts any age
+
+    assert snapshot.SnapshotConsumer(store, 0).fetch().age() >= 600
+
+def test_consumer_snapshot_goes_stale(tmp_path, monkeypatch):
+
+    # The publisher stopped: the unchanged snapshot is refused once too old
+
+    store = snapshot.FileStore(str(tmp_path / "snapshot.json.gz"))
+    publish(store)
+    consumer = snapshot.SnapshotConsumer(store, 300)
+    consumer.fetch()
+
+    now = time.time() + 301
+    monkeypatch.setattr(snapshot.time, "time", lambda: now)
+    with pytest.raises(snapshot.SnapshotError, match="old"):
+        consumer.fetch()
+
+def test_consumer_refuses_corrupt_snapshot(tmp_path):
+    store = snapshot.FileStore(str(tmp_path / "snapshot.json.gz"))
+    published = publish(store)
+    consumer = snapshot.SnapshotConsumer(store, 300)
+    consumer.fetch()
+
+    data = snapshot.encode(snapshot.Snapshot.from_projections(PROJECTIONS[:1], True, MOUNT, "ncn-w001"))
+    store.write(tamper(data, lambda d: d.__setitem__("projections", [])))
+
+    with pytest.raises(snapshot.SnapshotError, match="digest"):
+        consumer.fetch()
+    assert consumer.snapshot.digest == published.digest
+
+    # Read again, and used, once a good snapshot replaces it
+
+    fixed = publish(store, projections=PROJECTIONS[:1])
+    assert consumer.fetch().digest == fixed.digest
+
+def test_publisher_writes_changes(tmp_path, monkeypatch):
+    store = snapshot.FileStore(str(tmp_path / "snapshot.json.gz"))
+    publisher = snapshot.SnapshotPublisher(store, "ncn-w001", MOUNT, refresh=100)
+
+    now = [1000.0]
+    monkeypatch.setattr(snapshot.time, "monotonic", lambda: now[0])
+
+    assert publisher.publish(PROJECTIONS, True)
+    assert not publisher.publish(PROJECTIONS[::-1], True)
+    assert publisher.publish(PROJECTIONS[:1], True)
+
+    # Unchanged, rewritten once refresh seconds have passed
+
+    now[0] += 100
+    assert publisher.publish(PROJECTIONS[:1], True)
+    assert not publisher.keepalive()
+    now[0] += 100
+    assert publisher.keepalive()
+
+    consumed = snapshot.SnapshotConsumer(store, 300).fetch()
+    assert consumed.projections(MOUNT) == PROJECTIONS[:1]